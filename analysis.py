@@ -1,30 +1,302 @@
 # analysis.py
-import pandas as pd
 import itertools
 import gc
 import time
 from math import comb
 import sqlite3
-from database import get_db_connection
-import heapq
+import numpy as np
+from database import count_draws
+import ast
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from contextlib import contextmanager
 from config import Config
+import scoring
+import metrics
+import snapshot
+from topl import TopL
 
 def run_analysis(game_type='6_42', j=6, k=3, m='min', l=1, n=0,
                  last_offset=0,
                  progress_callback=None,
-                 should_stop=lambda: False):
+                 should_stop=lambda: False,
+                 engine=None,
+                 workers=None,
+                 phase_callback=None,
+                 budget_seconds=None,
+                 budget_combos=None):
     """
     Run analysis, ignoring the last 'last_offset' draws from the DB.
     If last_offset=0, we use all draws as before.
     If last_offset=5, e.g. we skip the last 5 draws (by sort_order).
+
+    engine selects how combos are scored:
+      'numpy'  - k-subset weights in a flat array indexed by colex rank,
+                 combos scored in batches (ties go to the earlier combo)
+      'prune'  - same weights, but a depth-first enumeration that skips
+                 every prefix whose bound cannot reach the top-l
+      'gray'   - same weights, combos visited in revolving-door order and
+                 scored one at a time from the previous combo's score
+      'python' - the original per-combo dict lookups
+    Defaults to Config.ANALYSIS_ENGINE.
+
+    workers > 1 scores the combo space in a process pool ('numpy' engine
+    only). Defaults to Config.ANALYSIS_WORKERS.
+
+    top_df.attrs records the parameters and the draws used, which
+    update_analysis needs to patch the result after draws are appended.
+
+    phase_callback(name) is called as the run moves through its phases:
+    'load' (draws / subset weights), 'score' (enumeration) and 'build'
+    (result frames).
+
+    budget_seconds (counted from the start of the run) and/or
+    budget_combos make it an anytime run instead (see scan_anytime):
+    combos are scored most promising first, and when the budget runs out
+    or should_stop() fires, the best top-l found so far is returned. The
+    n picks then come from that top-l. top_df.attrs gets 'coverage' (% of
+    combos scored), 'complete' (the top-l is exact), 'stopped' (why it
+    ended early) and 'unseen_bound' (the best score, in m's units, any
+    unscored combo could have; None when complete).
+
+    top_df.attrs['stats'] holds the run's metrics.RunStats: exclusive
+    seconds per phase ('fetch', 'index', 'enumerate', 'topl', 'select',
+    'build'), counts ('combos', top-l admissions/replacements/spills, gc
+    collections) and the run's peak RSS increase.
+    """
+    stats = metrics.RunStats()
+    with metrics.collecting(stats):
+        selected_df, top_df, elapsed = _run_analysis(
+            game_type, j, k, m, l, n, last_offset, progress_callback, should_stop,
+            engine, workers, phase_callback, budget_seconds, budget_combos)
+    if top_df is not None:
+        top_df.attrs['stats'] = stats.as_dict()
+    return selected_df, top_df, elapsed
+
+def _run_analysis(game_type, j, k, m, l, n, last_offset, progress_callback, should_stop,
+                  engine, workers, phase_callback, budget_seconds, budget_combos):
+    start_time = time.time()
+    phase = phase_callback or (lambda name: None)
+    phase('load')
+    engine = engine or Config.ANALYSIS_ENGINE
+    workers = workers or Config.ANALYSIS_WORKERS
+    max_number = Config.GAMES[game_type]['max_number']
+    use_count = draws_in_use(game_type, last_offset)
+    if use_count < 1:
+        return None, None, 0
+    anytime = None
+    rest = None
+    if budget_seconds is not None or budget_combos is not None:
+        engine = 'anytime'
+        weights = load_weights(game_type, k, last_offset)
+        if weights is None or should_stop():
+            return None, None, 0
+        phase('score')
+        deadline = None if budget_seconds is None else start_time + budget_seconds
+        with metrics.timed('enumerate'):
+            sorted_combinations, anytime = _anytime_top_combinations(
+                weights, max_number, j, k, m, l, progress_callback, should_stop,
+                deadline, budget_combos)
+    elif engine == 'python':
+        rows = load_draws(game_type, last_offset)
+        if rows is None or should_stop():
+            return None, None, 0
+        phase('score')
+        with metrics.timed('enumerate'):
+            sorted_combinations = _python_top_combinations(
+                rows, max_number, j, k, m, l, progress_callback, should_stop)
+    elif engine in ('numpy', 'prune', 'gray'):
+        weights = load_weights(game_type, k, last_offset)
+        if weights is None or should_stop():
+            return None, None, 0
+        phase('score')
+        with metrics.timed('enumerate'):
+            sorted_combinations, rest = _numpy_top_combinations(
+                weights, max_number, j, k, m, l, progress_callback, should_stop,
+                workers=workers, engine=engine,
+                extra=Config.SELECT_HEAD_ROWS if n else 0)
+    else:
+        raise ValueError(f"Unknown analysis engine: {engine}")
+    if sorted_combinations is None:
+        return None, None, 0
+    if not anytime:
+        metrics.count('combos', comb(max_number, j))
+
+    phase('build')
+    selected = None
+    selection = None
+    if n and anytime:
+        with metrics.timed('select'):
+            selected = select_non_overlapping(sorted_combinations, n, max_number, k)
+    elif n:
+        if engine == 'python':
+            weights = load_weights(game_type, k, last_offset)
+        with metrics.timed('select'):
+            picked = pick_non_overlapping(weights, max_number, j, k, m, n, sorted_combinations,
+                                          rest=rest, should_stop=should_stop)
+        if picked is None:
+            return None, None, 0
+        selected, selection = picked
+    with metrics.timed('build'):
+        selected_df, top_df = build_result_frames(sorted_combinations, selected)
+    top_df.attrs.update(
+        game_type=game_type, j=j, k=k, m=m, l=l, last_offset=last_offset,
+        engine=engine, draw_count=use_count,
+        draws_digest=snapshot.current(game_type).digest(use_count),
+        update='full', fallback_reason=None
+    )
+    if anytime:
+        top_df.attrs.update(anytime)
+    if selection:
+        top_df.attrs['selection'] = selection
+    elapsed = round(time.time() - start_time)
+    return selected_df, top_df, elapsed
+
+def update_analysis(previous_top_df, game_type='6_42', j=6, k=3, m='min', l=1, n=0,
+                    last_offset=0,
+                    progress_callback=None,
+                    should_stop=lambda: False,
+                    phase_callback=None):
+    """
+    Bring a previous run_analysis result up to date after draws were
+    appended, without re-enumerating every combo when possible.
+
+    Appending a draws raises every subset weight by at most a, so a combo
+    outside the previous top-L can gain at most a (m='min') or
+    a * C(j, k) (m='avg', on the sum) over the previous L-th key. The
+    previous top-L is re-scored with the new weights; if its l-th best
+    still beats that bound, it is the new top-l.
+
+    Otherwise (or if the previous result does not match the parameters,
+    was not produced by the numpy/prune/gray engines, or the earlier draws
+    changed) this falls back to a full run_analysis. The outcome is
+    recorded in top_df.attrs['update'] ('incremental' or 'full') and
+    top_df.attrs['fallback_reason'].
     """
+    stats = metrics.RunStats()
+    with metrics.collecting(stats):
+        selected_df, top_df, elapsed = _update_analysis(
+            previous_top_df, game_type, j, k, m, l, n, last_offset,
+            progress_callback, should_stop, phase_callback)
+    if top_df is not None and top_df.attrs.get('update') == 'incremental':
+        # A full fallback run keeps the stats run_analysis gave it
+        top_df.attrs['stats'] = stats.as_dict()
+    return selected_df, top_df, elapsed
 
+def _update_analysis(previous_top_df, game_type, j, k, m, l, n, last_offset,
+                     progress_callback, should_stop, phase_callback):
     start_time = time.time()
-    conn = get_db_connection(game_type)
-    c = conn.cursor()
+    if phase_callback:
+        phase_callback('update')
+    reason = _incremental_blocker(previous_top_df, game_type, j, k, m, l, last_offset)
+    if reason is None:
+        use_count = draws_in_use(game_type, last_offset)
+        with metrics.timed('enumerate'):
+            result = _incremental_top(previous_top_df, game_type, j, k, m, l, last_offset,
+                                      use_count)
+        if isinstance(result, str):
+            reason = result
+        else:
+            selected = None
+            selection = None
+            if n:
+                weights = load_weights(game_type, k, last_offset)
+                with metrics.timed('select'):
+                    picked = pick_non_overlapping(
+                        weights, Config.GAMES[game_type]['max_number'], j, k, m, n, result,
+                        should_stop=should_stop)
+                if picked is None:
+                    return None, None, 0
+                selected, selection = picked
+            with metrics.timed('build'):
+                selected_df, top_df = build_result_frames(result, selected)
+            top_df.attrs.update(previous_top_df.attrs)
+            top_df.attrs.update(
+                l=l, draw_count=use_count,
+                draws_digest=snapshot.current(game_type).digest(use_count),
+                update='incremental', fallback_reason=None
+            )
+            top_df.attrs.pop('selection', None)
+            if selection:
+                top_df.attrs['selection'] = selection
+            if progress_callback:
+                total_combos = comb(Config.GAMES[game_type]['max_number'], j)
+                progress_callback(total_combos, total_combos)
+            return selected_df, top_df, round(time.time() - start_time)
 
+    selected_df, top_df, elapsed = run_analysis(
+        game_type=game_type, j=j, k=k, m=m, l=l, n=n, last_offset=last_offset,
+        progress_callback=progress_callback, should_stop=should_stop,
+        phase_callback=phase_callback)
+    if top_df is not None:
+        top_df.attrs['fallback_reason'] = reason
+    return selected_df, top_df, elapsed
+
+def _incremental_blocker(previous_top_df, game_type, j, k, m, l, last_offset):
+    """Why the previous result cannot be patched incrementally, or None."""
+    attrs = getattr(previous_top_df, 'attrs', None) or {}
+    if not attrs:
+        return "previous result has no metadata"
+    expected = dict(game_type=game_type, j=j, k=k, m=m, last_offset=last_offset)
+    if any(attrs.get(key) != value for key, value in expected.items()):
+        return "previous result used different parameters"
+    if attrs.get('engine') not in ('numpy', 'prune', 'gray'):
+        return "previous result was not produced by the numpy/prune/gray engines"
+    use_count = draws_in_use(game_type, last_offset)
+    if use_count < attrs['draw_count']:
+        return "draws were removed since the previous result"
+    if snapshot.current(game_type).digest(attrs['draw_count']) != attrs['draws_digest']:
+        return "earlier draws changed since the previous result"
+    return None
+
+def _incremental_top(previous_top_df, game_type, j, k, m, l, last_offset, use_count):
+    """
+    New sorted top-l details from the previous top-L, or a string saying
+    why correctness cannot be guaranteed.
+    """
+    attrs = previous_top_df.attrs
+    prev_l = attrs['l']
+    if l > prev_l:
+        return f"l={l} is larger than the previous l={prev_l}"
+    max_number = Config.GAMES[game_type]['max_number']
+    appended = use_count - attrs['draw_count']
+    subsets_per_combo = comb(j, k)
+    prev_combos = [ast.literal_eval(c) for c in previous_top_df['Combination']]
+    # The previous run saw every combo, so nothing can be missing
+    complete = len(prev_combos) < prev_l or len(prev_combos) >= comb(max_number, j)
+    if not prev_combos:
+        return "previous result is empty"
+
+    weights = load_weights(game_type, k, last_offset)
+    combos = np.array(prev_combos, dtype=np.uint8).reshape(-1, j)
+    sums, mins = scoring.score_batch(combos, weights, scoring.subset_positions(j, k),
+                                     scoring.rank_table(max_number, k))
+    keys = sums if m == 'avg' else mins
+    idx = scoring.top_indices(keys, l)
+    if not complete:
+        if len(idx) < l:
+            return "previous result has fewer than l combos"
+        last = previous_top_df.iloc[-1]
+        if m == 'avg':
+            prev_key = round(last['Average Rank'] * subsets_per_combo)
+            bound = prev_key + appended * subsets_per_combo
+        else:
+            prev_key = int(last['MinValue'])
+            bound = prev_key + appended
+        # Outsiders reaching the bound exactly scored prev_key before, so
+        # they sort after the previous L-th combo and lose ties to anything
+        # lexicographically before it.
+        lth_key = int(keys[idx[-1]])
+        lth_combo = prev_combos[idx[-1]]
+        if lth_key < bound or (lth_key == bound and lth_combo > prev_combos[-1]):
+            return (f"l={l} leaves too little slack: the l-th key {lth_key} does not "
+                    f"clear the bound {bound} for combos outside the previous top-{prev_l}")
+    return combo_details(combos[idx], weights, j, k)
+
+def draws_in_use(game_type, last_offset=0):
+    """Number of draws left after skipping the last 'last_offset' ones."""
     # 1) Count how many total draws
-    row_count = c.execute("SELECT COUNT(*) as cnt FROM draws").fetchone()["cnt"]
+    row_count = count_draws(game_type)
     # clamp offset if bigger than total
     if last_offset < 0:
         last_offset = 0
@@ -32,30 +304,67 @@ def run_analysis(game_type='6_42', j=6, k=3, m='min', l=1, n=0,
         last_offset = row_count
 
     # number of draws to use
-    use_count = row_count - last_offset
-    if use_count < 1:
-        # If offset >= row_count, no draws are used => no analysis
-        conn.close()
-        return None, None, 0
+    return row_count - last_offset
 
-    # 2) Retrieve the first 'use_count' draws by sort_order
-    rows = c.execute(
-        "SELECT number1, number2, number3, number4, number5, number6 FROM draws "
-        "ORDER BY sort_order LIMIT ?",
-        (use_count,)
-    ).fetchall()
-    conn.close()
+# (game_type, k, draw count) -> weights, while shared_weights() is active
+_shared_weights = None
 
-    if should_stop():
-        return None, None, 0
+@contextmanager
+def shared_weights():
+    """
+    Within the block, load_weights hands out the weights it has already
+    loaded for the same game, k and draw count instead of reading them
+    again. For batch runs (batch.py) over draws that do not change meanwhile.
+    """
+    global _shared_weights
+    outer = _shared_weights
+    _shared_weights = {} if outer is None else outer
+    try:
+        yield
+    finally:
+        _shared_weights = outer
 
+def load_weights(game_type, k, last_offset=0):
+    """
+    k-subset weights over the first (total - last_offset) draws, from the
+    game's snapshot (read-only and memory-mapped when over all draws), or
+    None if no draws are left.
+    """
+    with metrics.timed('fetch'):
+        snap = snapshot.current(game_type)
+        use_count = snap.count - min(max(last_offset, 0), snap.count)
+        if use_count < 1:
+            return None
+        key = (game_type, k, use_count)
+        if _shared_weights is not None and key in _shared_weights:
+            return _shared_weights[key]
+        weights = snap.weights(k, use_count)
+        if _shared_weights is not None:
+            _shared_weights[key] = weights
+        return weights
+
+def load_draws(game_type, last_offset=0):
+    """
+    Return the first (total - last_offset) draws by sort_order as tuples of
+    six numbers (None for empty cells), or None if no draws are left.
+    """
+    with metrics.timed('fetch'):
+        snap = snapshot.current(game_type)
+        use_count = snap.count - min(max(last_offset, 0), snap.count)
+        if use_count < 1:
+            # If offset >= row_count, no draws are used => no analysis
+            return None
+        return snap.rows(use_count)
+
+def _python_top_combinations(rows, max_number, j, k, m, l,
+                             progress_callback, should_stop):
     toto_draws = len(rows)
 
     # 3) Build subset occurrence dictionary
     subset_occurrence_dict = {}
     for idx in reversed(range(toto_draws)):
         if should_stop():
-            return None, None, 0
+            return None
         row = rows[idx]
         row_list = [x for x in row if x is not None]
         weight = (toto_draws - 1) - idx
@@ -64,56 +373,529 @@ def run_analysis(game_type='6_42', j=6, k=3, m='min', l=1, n=0,
             if s not in subset_occurrence_dict:
                 subset_occurrence_dict[s] = weight
     gc.collect()
+    metrics.count('gc_collect')
 
     # 4) Evaluate combos
-    max_number = Config.GAMES[game_type]['max_number']
     total_combos = comb(max_number, j)
     count_subsets_in_combo = comb(j, k)
-    top_heap = []
+    top = TopL(l, j)
+    keys, combos = [], []
     processed = 0
+    last_report = time.time()
 
     def all_combos(n, r):
         return itertools.combinations(range(1, n + 1), r)
 
     for combo in all_combos(max_number, j):
         if should_stop():
-            return None, None, 0
+            top.close()
+            return None
         processed += 1
 
-        if progress_callback and processed % 50000 == 0:
+        if progress_callback and processed % 1024 == 0 \
+                and time.time() - last_report >= Config.PROGRESS_INTERVAL:
+            last_report = time.time()
             progress_callback(processed, total_combos)
             if should_stop():
-                return None, None, 0
+                top.close()
+                return None
 
         sum_occurrences = 0
         min_val = float("inf")
-        subsets_with_counts = []
 
         for subset in itertools.combinations(combo, k):
-            s = tuple(sorted(subset))
-            occurrence = subset_occurrence_dict.get(s, 0)
-            subsets_with_counts.append((s, occurrence))
+            occurrence = subset_occurrence_dict.get(subset, 0)
             sum_occurrences += occurrence
             if occurrence < min_val:
                 min_val = occurrence
 
-        avg_rank = sum_occurrences / count_subsets_in_combo
-        sort_field = avg_rank if m == 'avg' else min_val
-
-        if len(top_heap) < l:
-            top_heap.append((sort_field, combo, (avg_rank, min_val), subsets_with_counts))
-        else:
-            if sort_field > top_heap[0][0]:
-                top_heap[0] = (sort_field, combo, (avg_rank, min_val), subsets_with_counts)
-                import heapq
-                heapq.heapify(top_heap)
+        # The sum orders combos exactly like the average
+        keys.append(sum_occurrences if m == 'avg' else min_val)
+        combos.append(combo)
+        if len(keys) == 4096:
+            top.add(np.array(keys, dtype=np.int64), np.array(combos, dtype=np.uint8))
+            keys, combos = [], []
+    if keys:
+        top.add(np.array(keys, dtype=np.int64), np.array(combos, dtype=np.uint8))
 
     if progress_callback:
         progress_callback(total_combos, total_combos)
 
-    top_list = list(top_heap)
-    top_list.sort(key=lambda x: x[0], reverse=True)
-    sorted_combinations = [(item[1], item[2], item[3]) for item in top_list]
+    sorted_combinations = []
+    for _, block in top.iter_sorted():
+        for row in block:
+            combo = tuple(int(x) for x in row)
+            subsets_with_counts = [(s, subset_occurrence_dict.get(s, 0))
+                                   for s in itertools.combinations(combo, k)]
+            counts = [c for _, c in subsets_with_counts]
+            sorted_combinations.append(
+                (combo, (sum(counts) / count_subsets_in_combo, min(counts)), subsets_with_counts))
+    return sorted_combinations
+
+def _numpy_top_combinations(weights, max_number, j, k, m, l,
+                            progress_callback, should_stop, workers=1, engine='numpy',
+                            extra=0):
+    """
+    (top-l details, rest), or (None, None) if stopped. The scan keeps
+    `extra` combos beyond the top-l, and rest holds their (keys, combos)
+    in rank order, for pick_non_overlapping; None without extra.
+    """
+    # 4) Evaluate combos in batches
+    total_combos = comb(max_number, j)
+    if workers > 1 and engine == 'numpy':
+        top = _scan_parallel(weights, max_number, j, k, m, l + extra, workers,
+                             progress_callback, should_stop)
+    else:
+        processed = 0
+
+        def on_batch(size):
+            nonlocal processed
+            processed += size
+            if progress_callback:
+                progress_callback(processed, total_combos)
+
+        scan = {'numpy': scan_combos, 'prune': scan_pruned, 'gray': scan_gray}[engine]
+        top = scan(weights, max_number, j, k, m, l + extra,
+                   on_batch=on_batch, should_stop=should_stop)
+    if top is None:
+        return None, None
+    if not extra:
+        return _top_details(top, weights, j, k), None
+    return _split_top(top, weights, j, k, l)
+
+def _top_details(top, weights, j, k):
+    details = []
+    for _, combos in top.iter_sorted():
+        with metrics.timed('build'):
+            details.extend(combo_details(combos, weights, j, k))
+    return details
+
+def _split_top(top, weights, j, k, l):
+    """Details of the first l rows of a TopL, and (keys, combos) of the rows after them."""
+    details = []
+    rest_keys = [np.empty(0, dtype=np.int64)]
+    rest_combos = [np.empty((0, j), dtype=np.uint8)]
+    seen = 0
+    for keys, combos in top.iter_sorted():
+        head = max(0, min(len(combos), l - seen))
+        if head:
+            with metrics.timed('build'):
+                details.extend(combo_details(combos[:head], weights, j, k))
+        rest_keys.append(np.asarray(keys[head:]))
+        rest_combos.append(np.asarray(combos[head:]))
+        seen += len(combos)
+    return details, (np.concatenate(rest_keys), np.concatenate(rest_combos))
+
+def _anytime_top_combinations(weights, max_number, j, k, m, l,
+                              progress_callback, should_stop, deadline, max_combos):
+    total_combos = comb(max_number, j)
+
+    def on_batch(scored):
+        if progress_callback:
+            progress_callback(scored, total_combos)
+
+    top, info = scan_anytime(weights, max_number, j, k, m, l, deadline=deadline,
+                             max_combos=max_combos, on_batch=on_batch,
+                             should_stop=should_stop)
+    metrics.count('combos', info['scored'])
+    bound = info['bound']
+    if bound is not None and m == 'avg':
+        bound = bound / comb(j, k)
+    anytime = dict(coverage=round(100 * info['scored'] / total_combos, 2),
+                   complete=info['complete'], stopped=info['stopped'],
+                   unseen_bound=bound)
+    return _top_details(top, weights, j, k), anytime
+
+def scan_combos(weights, max_number, j, k, m, l, shard=None,
+                on_batch=None, should_stop=lambda: False, top=None):
+    """
+    Score every combo (or every combo of one shard) into a TopL (a new one
+    unless given) and return it, or None if stopped.
+    """
+    positions = scoring.subset_positions(j, k)
+    table = scoring.rank_table(max_number, k)
+    top = top or TopL(l, j)
+
+    for batch in scoring.iter_combo_batches(max_number, j, shard=shard):
+        if should_stop():
+            top.close()
+            return None
+        sums, mins = scoring.score_batch(batch, weights, positions, table)
+        top.add(sums if m == 'avg' else mins, batch)
+        if on_batch:
+            on_batch(len(batch))
+    return top
+
+def scan_pruned(weights, max_number, j, k, m, l,
+                on_batch=None, should_stop=lambda: False):
+    """
+    Branch-and-bound version of scan_combos; on_batch receives the number
+    of combos scored or skipped.
+    """
+    top = TopL(l, j)
+    seed = scoring.seed_threshold(weights, max_number, j, k, m, l)
+    # The 'min' bound prunes well at every depth; the 'avg' bound is loose,
+    # so its last levels are cheaper to score as flat blocks.
+    flat_width = 3 if m == 'avg' else 1
+    for combos, sums, mins, covered in scoring.iter_pruned_batches(
+            weights, max_number, j, k, m, top.threshold, seed=seed,
+            flat_width=flat_width):
+        if should_stop():
+            top.close()
+            return None
+        top.add(sums if m == 'avg' else mins, combos)
+        if on_batch:
+            on_batch(covered)
+    return top
+
+def scan_gray(weights, max_number, j, k, m, l,
+              on_batch=None, should_stop=lambda: False, block_size=1 << 12):
+    """
+    scan_combos over the revolving-door order: each combo differs from the
+    one before by one number, so only the C(j - 1, k - 1) subsets holding
+    the number that left and the one that came in are looked up. The sum
+    is kept as a running total and the min through a count of every weight
+    in the combo. Seqs are lex ranks, so ties resolve as in the other
+    engines.
+    """
+    top = TopL(l, j, ordered=False)
+    # Subsets are looked up by bitmask of their (0-based) numbers
+    members = np.array(list(itertools.combinations(range(max_number), k)), dtype=np.int64)
+    ranks = scoring.rank_rows(members + 1, scoring.rank_table(max_number, k))
+    masks = (np.int64(1) << members).sum(axis=1)
+    weight_of = dict(zip(masks.tolist(), weights[ranks].tolist()))
+    bits = [1 << v for v in range(max_number)]
+
+    keys = []
+    rows = []
+    for combo, out, new in scoring.revolving_door(max_number, j):
+        if out is None:
+            counts = {}
+            for subset in itertools.combinations(combo, k):
+                w = weight_of[sum(bits[v] for v in subset)]
+                counts[w] = counts.get(w, 0) + 1
+            total = sum(w * c for w, c in counts.items())
+            low = min(counts)
+        else:
+            rest = list(map(sum, itertools.combinations(
+                [bits[v] for v in combo if v != new], k - 1)))
+            out_bit, new_bit = bits[out], bits[new]
+            if m == 'avg':
+                total += (sum([weight_of[mask | new_bit] for mask in rest])
+                          - sum([weight_of[mask | out_bit] for mask in rest]))
+            else:
+                for mask in rest:
+                    gone = weight_of[mask | out_bit]
+                    came = weight_of[mask | new_bit]
+                    if gone == came:
+                        continue
+                    counts[came] = counts.get(came, 0) + 1
+                    if counts[gone] == 1:
+                        del counts[gone]
+                    else:
+                        counts[gone] -= 1
+                    if came < low:
+                        low = came
+                    elif gone == low and gone not in counts:
+                        low = min(counts)
+        keys.append(total if m == 'avg' else low)
+        rows.extend(combo)
+        if len(keys) == block_size:
+            if should_stop():
+                top.close()
+                return None
+            _add_gray_block(top, keys, rows, max_number, j)
+            if on_batch:
+                on_batch(len(keys))
+            keys = []
+            rows = []
+    if keys:
+        _add_gray_block(top, keys, rows, max_number, j)
+        if on_batch:
+            on_batch(len(keys))
+    return top
+
+def _add_gray_block(top, keys, rows, max_number, j):
+    combos = (np.array(rows, dtype=np.uint8) + 1).reshape(-1, j)
+    top.add(np.array(keys, dtype=np.int64), combos, scoring.lex_ranks(combos, max_number))
+
+def scan_anytime(weights, max_number, j, k, m, l, deadline=None, max_combos=None,
+                 on_batch=None, should_stop=lambda: False,
+                 batch_size=scoring.DEFAULT_BATCH_SIZE):
+    """
+    Score combos most promising first, for as long as the budget allows.
+
+    Combos are grouped by their first `depth` numbers, and each group gets
+    the bound iter_pruned_batches uses for a prefix (an upper bound on the
+    key of every combo in it). Groups are scored in decreasing bound order
+    until all are done, the best bound left is below the l-th best key (the
+    top-l is then exact), time.time() passes deadline, max_combos have been
+    scored (rounded up to a whole group) or should_stop() fires.
+
+    Returns (top, info): info has 'scored' (combos scored), 'complete',
+    'stopped' (None, 'deadline', 'combos' or 'cancelled') and 'bound', the
+    best key an unscored combo could have (None when complete). on_batch
+    receives the running number of combos scored.
+    """
+    top = TopL(l, j, ordered=False)
+    table = scoring.rank_table(max_number, k)
+    depth = max(1, min(k, j - 1))
+    t = j - depth
+    prefixes = np.array(list(itertools.combinations(range(1, max_number + 1), depth)),
+                        dtype=np.uint8)
+    last = prefixes[:, -1].astype(np.intp)
+    if depth >= k:
+        sums, mins = scoring.score_batch(prefixes, weights, scoring.subset_positions(depth, k), table)
+    else:
+        sums = np.zeros(len(prefixes), dtype=np.int64)
+        mins = np.full(len(prefixes), np.iinfo(np.int64).max)
+    if t:
+        # Every combo has a subset holding a number above its prefix
+        best_above = scoring.best_weight_above(weights, max_number, k)[last]
+        bounds = sums + (comb(j, k) - comb(depth, k)) * best_above if m == 'avg' \
+            else np.minimum(mins, best_above)
+    else:
+        bounds = sums if m == 'avg' else mins
+    sizes = np.array([comb(max_number - x, t) for x in range(max_number + 1)],
+                     dtype=np.int64)[last]
+    order = np.lexsort((np.arange(len(prefixes)), -bounds))
+    order = order[sizes[order] > 0]
+    scored_after = np.cumsum(sizes[order])
+
+    tails = np.array(list(itertools.combinations(range(1, max_number + 1), t)), dtype=np.uint8)
+    tail_start = (np.searchsorted(tails[:, 0], np.arange(max_number + 1), side='right')
+                  if t else np.zeros(max_number + 1, dtype=np.intp))
+    positions = scoring.subset_positions(j, k)
+    done = 0
+    scored = 0
+    stopped = None
+    while done < len(order):
+        kth = top.threshold()
+        if kth is not None and bounds[order[done]] < kth:
+            break
+        if should_stop():
+            stopped = 'cancelled'
+        elif deadline is not None and time.time() >= deadline:
+            stopped = 'deadline'
+        elif max_combos is not None and scored >= max_combos:
+            stopped = 'combos'
+        if stopped:
+            break
+        end = int(np.searchsorted(scored_after, scored + batch_size)) + 1
+        if max_combos is not None:
+            end = min(end, int(np.searchsorted(scored_after, max_combos, side='right')))
+        end = min(max(end, done + 1), len(order))
+        pieces = []
+        for i in order[done:end]:
+            rest = tails[tail_start[last[i]]:]
+            piece = np.empty((len(rest), j), dtype=np.uint8)
+            piece[:, :depth] = prefixes[i]
+            piece[:, depth:] = rest
+            pieces.append(piece)
+        block = np.concatenate(pieces)
+        sums, mins = scoring.score_batch(block, weights, positions, table)
+        top.add(sums if m == 'avg' else mins, block, scoring.lex_ranks(block, max_number))
+        scored += len(block)
+        done = end
+        if on_batch:
+            on_batch(scored)
+    complete = stopped is None
+    info = dict(scored=scored, complete=complete, stopped=stopped,
+                bound=None if complete else int(bounds[order[done]]))
+    return top, info
+
+# State shared with process-pool workers, set once per worker by _init_worker
+_worker_weights = None
+_worker_progress = None
+_worker_cancel = None
+
+def _init_worker(weights, progress, cancel):
+    global _worker_weights, _worker_progress, _worker_cancel
+    _worker_weights = weights
+    _worker_progress = progress
+    _worker_cancel = cancel
+
+def _scan_shard_worker(max_number, j, k, m, l, shard, shard_index, spill_dir):
+    def on_batch(size):
+        with _worker_progress.get_lock():
+            _worker_progress.value += size
+
+    # Shard i numbers its combos from i << 40, after every earlier shard
+    top = TopL(l, j, spill_dir=spill_dir, seq_base=shard_index << 40)
+    top = scan_combos(_worker_weights, max_number, j, k, m, l, shard=shard,
+                      on_batch=on_batch, should_stop=_worker_cancel.is_set, top=top)
+    return None if top is None else top.export()
+
+def _scan_parallel(weights, max_number, j, k, m, l, workers,
+                   progress_callback, should_stop):
+    """
+    Split the combo space into contiguous shards, score them in a process
+    pool and merge the per-shard top-l lists in shard order.
+    """
+    total_combos = comb(max_number, j)
+    shards = scoring.combo_shards(max_number, j, workers * Config.ANALYSIS_SHARDS_PER_WORKER)
+    ctx = multiprocessing.get_context('spawn')
+    progress = ctx.Value('q', 0)
+    cancel = ctx.Event()
+
+    top = TopL(l, j)
+    spill_dir = top.spill_path()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                             initializer=_init_worker,
+                             initargs=(weights, progress, cancel)) as pool:
+        futures = [pool.submit(_scan_shard_worker, max_number, j, k, m, l, shard, i, spill_dir)
+                   for i, shard in enumerate(shards)]
+        pending = set(futures)
+        while pending:
+            _, pending = wait(pending, timeout=Config.ANALYSIS_POLL_INTERVAL)
+            if progress_callback:
+                progress_callback(progress.value, total_combos)
+            if should_stop():
+                cancel.set()
+                for f in pending:
+                    f.cancel()
+                top.close()
+                return None
+
+        for f in futures:
+            runs = f.result()
+            if runs is None:
+                top.close()
+                return None
+            top.adopt(runs)
+    return top
+
+def run_sweep(game_type='6_42', j=6, k=3, m='min', l=1, n=0,
+              offset_from=0, offset_to=0,
+              progress_callback=None,
+              should_stop=lambda: False):
+    """
+    Backtest: run the analysis for every last_offset in [offset_from, offset_to]
+    and check each offset's picks against its held-out draw (the first draw
+    the offset skips).
+
+    Work is shared across offsets: subset ranks are taken from the
+    snapshot once and the weights are slid from one offset to the next by
+    undoing one draw at a time. Offsets are scored in groups, ranking each
+    batch of combos once for the whole group.
+
+    Yields one dict per offset, in ascending offset order, as soon as its
+    group finishes:
+      offset, draw_count, held_out (numbers or None), elapsed,
+      picks: [{Combination, Average Rank, MinValue, Shared Subsets}],
+      hits (picks sharing at least one k-subset with the held-out draw)
+    Picks are the n-overlap selection when n > 0, made as run_analysis
+    makes it (pick_non_overlapping, which looks past the top-l when it runs
+    short), otherwise the top-l.
+    """
+    start_time = time.time()
+    max_number = Config.GAMES[game_type]['max_number']
+    snap = snapshot.current(game_type)
+    all_rows = snap.rows()
+    row_count = len(all_rows)
+    offsets = [o for o in range(max(offset_from, 0), offset_to + 1) if row_count - o >= 1]
+    if not offsets:
+        return
+
+    # Subset ranks of every draw, plus where each subset was last seen
+    # before it, so draws can be undone in O(C(6, k)) each.
+    use_max = row_count - offsets[0]
+    rank_lists = [ranks[ranks >= 0] for ranks in snap.ranks(k)[:use_max]]
+    last_seen = np.full(comb(max_number, k), -1, dtype=np.int64)
+    previous = []
+    for pos, ranks in enumerate(rank_lists):
+        previous.append(last_seen[ranks].copy())
+        last_seen[ranks] = pos
+    use_count = use_max
+
+    positions = scoring.subset_positions(j, k)
+    table = scoring.rank_table(max_number, k)
+    total_combos = comb(max_number, j)
+    weight_bytes = comb(max_number, k) * 4
+    group_size = max(1, min(Config.SWEEP_GROUP_SIZE,
+                            Config.SWEEP_WEIGHT_BUDGET // weight_bytes))
+    groups = [offsets[i:i + group_size] for i in range(0, len(offsets), group_size)]
+    processed = 0
+
+    for group in groups:
+        group_weights = []
+        for offset in group:
+            while use_count > row_count - offset:
+                use_count -= 1
+                last_seen[rank_lists[use_count]] = previous[use_count]
+            group_weights.append(scoring.weights_from_last_seen(last_seen, use_count))
+
+        tops = [(np.empty(0, dtype=np.int64), np.empty((0, j), dtype=np.uint8))
+                for _ in group]
+        for batch in scoring.iter_combo_batches(max_number, j):
+            if should_stop():
+                return
+            ranks = scoring.batch_ranks(batch, positions, table)
+            for g, weights in enumerate(group_weights):
+                sums, mins = scoring.score_ranks(ranks, weights)
+                keys = sums if m == 'avg' else mins
+                tops[g] = scoring.merge_top(tops[g][0], tops[g][1], keys, batch, l)
+            processed += len(batch)
+            if progress_callback:
+                progress_callback(processed, total_combos * len(groups))
+
+        for offset, weights, (_, top_combos) in zip(group, group_weights, tops):
+            draw_count = row_count - offset
+            details = combo_details(top_combos, weights, j, k)
+            chosen = details
+            if n:
+                picked = pick_non_overlapping(weights, max_number, j, k, m, n, details,
+                                              should_stop=should_stop)
+                if picked is None:
+                    return
+                chosen = picked[0]
+            held_out = None
+            if offset > 0:
+                held_out = [x for x in all_rows[draw_count] if x is not None]
+            picks = []
+            for combo, (avg_rank, min_val), subsets_with_counts in chosen:
+                shared = []
+                if held_out is not None:
+                    held = set(held_out)
+                    shared = [s for s, _ in subsets_with_counts if held.issuperset(s)]
+                picks.append({
+                    'Combination': str(combo),
+                    'Average Rank': avg_rank,
+                    'MinValue': min_val,
+                    'Shared Subsets': shared
+                })
+            yield {
+                'offset': offset,
+                'draw_count': draw_count,
+                'held_out': held_out,
+                'elapsed': round(time.time() - start_time, 3),
+                'picks': picks,
+                'hits': sum(1 for p in picks if p['Shared Subsets'])
+            }
+
+def combo_details(combos, weights, j, k):
+    """
+    Expand scored combos into the (combo, (avg_rank, min_val), subsets_with_counts)
+    tuples used to build the result frames.
+    """
+    count_subsets_in_combo = comb(j, k)
+    details = []
+    for row in combos:
+        combo = tuple(int(x) for x in row)
+        subsets_with_counts = []
+        for s in itertools.combinations(combo, k):
+            subsets_with_counts.append((s, int(weights[scoring.rank_subset(s)])))
+        counts = [c for _, c in subsets_with_counts]
+        avg_rank = sum(counts) / count_subsets_in_combo
+        details.append((combo, (avg_rank, min(counts)), subsets_with_counts))
+    return details
+
+def build_result_frames(sorted_combinations, selected=None):
+    """
+    Build (selected_df, top_df) from (combo, (avg_rank, min_val), subsets_with_counts)
+    tuples: the top-l sorted best-first, and the n-overlap picks (None if n == 0).
+    """
+    import pandas as pd
 
     # 5) Build top_df
     top_data = []
@@ -126,17 +908,12 @@ def run_analysis(game_type='6_42', j=6, k=3, m='min', l=1, n=0,
         })
     top_df = pd.DataFrame(top_data)
 
-    # 6) Overlap logic if n != 0
-    if n == 0:
+    # 6) Overlap picks if n != 0
+    if selected is None:
         selected_df = None
     else:
         selected_data = []
-        seen_subsets = set()
-        number = 0
-        for combo, ranking, subsets_with_counts in sorted_combinations:
-            if any(tuple(sorted(s)) in seen_subsets for s, _ in subsets_with_counts):
-                continue
-            number += 1
+        for number, (combo, ranking, subsets_with_counts) in enumerate(selected, start=1):
             selected_data.append({
                 'Number': number,
                 'Combination': str(combo),
@@ -144,11 +921,137 @@ def run_analysis(game_type='6_42', j=6, k=3, m='min', l=1, n=0,
                 'MinValue': ranking[1],
                 'Subsets': str(subsets_with_counts)
             })
-            for s, _ in subsets_with_counts:
-                seen_subsets.add(tuple(sorted(s)))
-            if number >= n:
-                break
         selected_df = pd.DataFrame(selected_data)
+    return selected_df, top_df
 
-    elapsed = round(time.time() - start_time)
-    return selected_df, top_df, elapsed
+def select_disjoint(blocks, n, max_number, j, k, taken=None):
+    """
+    Greedily pick up to n combos from (count, j) combo blocks, taken in
+    order, that share no k-subset with an earlier pick. Taken subsets are
+    marked in a bitset over colex ranks (`taken`, updated in place, to go
+    on from earlier picks); blocks are only pulled until n picks are found.
+    Returns the picks as a (picks, j) array.
+    """
+    positions = scoring.subset_positions(j, k)
+    table = scoring.rank_table(max_number, k)
+    if taken is None:
+        taken = np.zeros(comb(max_number, k), dtype=bool)
+    picks = []
+    for combos in blocks:
+        ranks = scoring.batch_ranks(combos, positions, table)
+        # Rows already blocked before this block are skipped without a look
+        for i in np.flatnonzero(~taken[ranks].any(axis=1)):
+            row_ranks = ranks[i]
+            if taken[row_ranks].any():
+                continue
+            taken[row_ranks] = True
+            picks.append(combos[i])
+            if len(picks) >= n:
+                return np.array(picks, dtype=np.uint8)
+    return np.array(picks, dtype=np.uint8).reshape(-1, j)
+
+def select_non_overlapping(sorted_combinations, n, max_number, k):
+    """Greedily pick up to n combos, best first, that share no k-subset."""
+    details = {combo: (combo, ranking, subs) for combo, ranking, subs in sorted_combinations}
+    if not details:
+        return []
+    j = len(next(iter(details)))
+    combos = np.array(list(details), dtype=np.uint8).reshape(-1, j)
+    picks = select_disjoint([combos], n, max_number, j, k)
+    return [details[tuple(int(x) for x in row)] for row in picks]
+
+def _pull_pass(weights, max_number, j, k, m, bound, taken, should_stop):
+    """
+    One pass over every combo for pick_non_overlapping: a TopL of the best
+    Config.SELECT_PASS_ROWS combos that rank after `bound` (key, combo) and
+    share no k-subset marked in `taken`. Returns (TopL, exhausted), where
+    exhausted means every such combo fitted, or None if stopped.
+    """
+    positions = scoring.subset_positions(j, k)
+    table = scoring.rank_table(max_number, k)
+    top = TopL(Config.SELECT_PASS_ROWS, j)
+    bound_key, bound_combo = bound
+    past_bound = False
+    for batch in scoring.iter_combo_batches(max_number, j):
+        if should_stop():
+            top.close()
+            return None
+        ranks = scoring.batch_ranks(batch, positions, table)
+        sums, mins = scoring.score_ranks(ranks, weights)
+        keys = sums if m == 'avg' else mins
+        # Equal keys rank in enumeration (lexicographic) order
+        if past_bound:
+            after = keys <= bound_key
+        else:
+            after = keys < bound_key
+            hit = np.flatnonzero((batch == bound_combo).all(axis=1))
+            if len(hit):
+                past_bound = True
+                after |= (keys == bound_key) & (np.arange(len(batch)) > hit[0])
+        after &= ~taken[ranks].any(axis=1)
+        if after.any():
+            top.add(keys[after], batch[after])
+    metrics.count('select_passes')
+    return top, top.threshold() is None
+
+def pick_non_overlapping(weights, max_number, j, k, m, n, sorted_combinations,
+                         rest=None, should_stop=lambda: False):
+    """
+    The n-overlap picks, greedily in score order: the top-l first, then
+    `rest` ((keys, combos) ranked right after it, which the main scan kept),
+    then, while picks run short, passes over every combo that keep only
+    those after the last one considered and not blocked by a pick (see
+    _pull_pass), at most Config.SELECT_MAX_PASSES of them.
+
+    Returns (details like combo_details, info) or None if stopped. info
+    is {'passes', 'capped'}; capped means the pass limit ended the
+    selection with fewer than n picks while unseen combos could remain.
+    """
+    positions = scoring.subset_positions(j, k)
+    table = scoring.rank_table(max_number, k)
+    taken = np.zeros(comb(max_number, k), dtype=bool)
+    head = np.array([combo for combo, _, _ in sorted_combinations],
+                    dtype=np.uint8).reshape(-1, j)
+    blocks = [head] if rest is None else [head, rest[1]]
+    picks = list(select_disjoint(blocks, n, max_number, j, k, taken))
+
+    # The last combo considered so far, where the next pass starts
+    if rest is not None and len(rest[1]):
+        bound = (int(rest[0][-1]), rest[1][-1])
+    elif len(head):
+        sums, mins = scoring.score_batch(head[-1:], weights, positions, table)
+        bound = (int((sums if m == 'avg' else mins)[0]), head[-1])
+    else:
+        bound = None
+    ranked = sum(len(block) for block in blocks)
+    exhausted = bound is None or ranked >= comb(max_number, j)
+    passes = 0
+    while len(picks) < n and not exhausted and passes < Config.SELECT_MAX_PASSES:
+        pulled = _pull_pass(weights, max_number, j, k, m, bound, taken, should_stop)
+        if pulled is None:
+            return None
+        top, exhausted = pulled
+        passes += 1
+        last = None
+
+        def ranked_blocks():
+            nonlocal last
+            for keys, combos in top.iter_sorted():
+                last = (int(keys[-1]), combos[-1])
+                yield combos
+
+        stream = ranked_blocks()
+        try:
+            picks.extend(select_disjoint(stream, n - len(picks), max_number, j, k, taken))
+        finally:
+            stream.close()
+            top.close()
+        if last is None:
+            exhausted = True
+        else:
+            bound = last
+    if should_stop():
+        return None
+    picks = np.array(picks, dtype=np.uint8).reshape(-1, j)
+    info = dict(passes=passes, capped=len(picks) < n and not exhausted)
+    return combo_details(picks, weights, j, k), info
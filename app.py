@@ -1,13 +1,18 @@
 # app.py
-from flask import Flask, render_template, request, make_response, jsonify, redirect, url_for, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, Response, stream_with_context, g, send_file
 from flask_session import Session
 from database import *
-from analysis import run_analysis
-import io
-import pandas as pd
-import threading
-from config import Config
+from analysis import run_sweep
+from jobs import (job_manager, submit_job, cancel_job, cancel_owner_jobs, get_job,
+                  load_result, result_summary, result_page, profile_path, QueueFull)
+import metrics
 import time
+import os
+import json
+import uuid
+from config import Config
+from init_database import import_draws
+from exports import draws_csv, draws_npy, result_csv, result_npy, gzip_chunks
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
@@ -15,14 +20,41 @@ app.config['SESSION_TYPE'] = 'filesystem'
 app.config['SESSION_PERMANENT'] = False
 Session(app)
 
-analysis_in_progress = False
-analysis_processed = 0
-analysis_total = 0
-analysis_selected_df = None
-analysis_top_df = None
-analysis_elapsed = None
-analysis_thread = None
-analysis_cancel_requested = False
+@app.teardown_appcontext
+def release_db_connections(exception=None):
+    release_connections()
+
+# Request metrics: latency per route, and the time each request spent
+# waiting for SQLite write locks. Streamed responses are timed until the
+# response is returned, not until the stream ends.
+
+@app.before_request
+def start_request_metrics():
+    g.request_stats = metrics.RunStats()
+    metrics.activate(g.request_stats)
+
+@app.after_request
+def record_request_metrics(response):
+    stats = g.pop('request_stats', None)
+    if stats is not None:
+        metrics.deactivate(stats)
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.request_seconds.observe(stats.elapsed(), route=route, method=request.method,
+                                        status=response.status_code)
+        metrics.request_lock_wait_seconds.observe(stats.seconds.get('lock_wait', 0.0),
+                                                  route=route)
+    return response
+
+@app.teardown_request
+def drop_request_metrics(exception=None):
+    stats = g.pop('request_stats', None)
+    if stats is not None:
+        metrics.deactivate(stats)
+
+@app.route('/metrics')
+def metrics_route():
+    """This process's metrics in the Prometheus text format."""
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
 
 @app.context_processor
 def utility_processor():
@@ -78,12 +110,30 @@ def analysis_start():
         offset_last=0  # default offset is 0
     )
 
+def _page_cursor(cursor, version, game_type):
+    """(sort_order, id, position) from a cursor issued by /combos_data."""
+    after_sort, after_id, position, cursor_version = cursor.split(':', 3)
+    after_sort, after_id, position = int(after_sort), int(after_id), int(position)
+    if cursor_version != version:
+        # Rows were added or removed since: recount the position of the key
+        position = draw_position(after_sort, after_id, game_type)
+    return after_sort, after_id, position
+
 @app.route('/combos_data', methods=['GET'])
 def combos_data():
     game_type = session.get('game_type', '6_42')
     limit = request.args.get('limit', 20, type=int)
     offset = request.args.get('offset', 0, type=int)
-    draws = get_draws(game_type, limit=limit, offset=offset)
+    cursor = request.args.get('cursor')
+    # Read the version before the rows, so an ETag never labels newer data
+    meta = get_dataset_meta(game_type)
+    after = None
+    if cursor:
+        try:
+            after = _page_cursor(cursor, meta['version'], game_type)
+        except ValueError:
+            return jsonify({"status": "error", "message": "Invalid cursor"}), 400
+    draws = get_draws(game_type, limit=limit, offset=offset, after=after)
     data = []
     for d in draws:
         data.append([
@@ -96,7 +146,18 @@ def combos_data():
             d['number6'],
             d['id']
         ])
-    return jsonify(data)
+    response = jsonify(data)
+    if draws:
+        last = draws[-1]
+        response.headers['X-Next-Cursor'] = (
+            f"{last['sort_order']}:{last['id']}:{int(last['draw_number'])}:{meta['version']}"
+        )
+    # The game comes from the session, so the tag must name it too
+    response.set_etag(f"{game_type}:{meta['version']}")
+    response.last_modified = meta['modified']
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
 
 @app.route('/update_combo_hot', methods=['POST'])
 def update_combo_hot():
@@ -129,39 +190,87 @@ def delete_combos_hot():
     delete_draws(ids, game_type)
     return "OK"
 
+@app.route('/batch_edit_hot', methods=['POST'])
+def batch_edit_hot():
+    game_type = session.get('game_type', '6_42')
+    payload = request.get_json(silent=True) or {}
+    ops = payload.get('ops')
+    if not isinstance(ops, list):
+        return jsonify({"status": "error", "message": "Expected a JSON body with an ops list"}), 400
+    try:
+        ids = apply_draw_ops(ops, game_type)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "ok", "ids": ids})
+
 @app.route('/move_row_hot', methods=['POST'])
 def move_row_hot():
     game_type = session.get('game_type', '6_42')
     new_order = request.form.getlist('new_order[]', type=int)
-    conn = get_db_connection(game_type)
-    c = conn.cursor()
-    for i, id_val in enumerate(new_order, start=1):
-        c.execute("UPDATE draws SET sort_order=? WHERE id=?", (i, id_val))
-    conn.commit()
-    conn.close()
-    renumber_all(game_type)
+    reorder_draws(new_order, game_type)
     return "OK"
 
+@app.route('/upload_draws', methods=['POST'])
+def upload_draws():
+    game_type = request.form.get('game_type', session.get('game_type', '6_42'))
+    mode = request.form.get('mode', 'append')
+    upload = request.files.get('file')
+    if game_type not in Config.GAMES:
+        return jsonify({"status": "error", "message": "Unknown game type"}), 400
+    if mode not in ('replace', 'append'):
+        return jsonify({"status": "error", "message": "mode must be replace or append"}), 400
+    if upload is None:
+        return jsonify({"status": "error", "message": "No file uploaded"}), 400
+    has_header = request.form.get('header', '1') != '0'
+    try:
+        count = import_draws(game_type, upload.stream, mode=mode, has_header=has_header)
+    except ValueError as e:  # includes pandas' ParserError and EmptyDataError
+        return jsonify({"status": "error", "message": str(e)}), 400
+    return jsonify({"status": "ok", "imported": count, "mode": mode})
+
+EXPORT_TYPES = {'csv': 'text/csv', 'npy': 'application/octet-stream'}
+
+def _export_format():
+    fmt = request.args.get('format', 'csv')
+    return fmt if fmt in EXPORT_TYPES else None
+
+def _download(chunks, filename, fmt):
+    """Stream an export; ?gzip=1 compresses it on the fly."""
+    mimetype = EXPORT_TYPES[fmt]
+    filename = f"{filename}.{fmt}"
+    if request.args.get('gzip') in ('1', 'true'):
+        chunks = gzip_chunks(chunks)
+        filename += ".gz"
+        mimetype = 'application/gzip'
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
+
 @app.route('/download_all_combos', methods=['GET'])
 def download_all_combos():
     game_type = session.get('game_type', '6_42')
-    rows = get_all_draws(game_type)
-    df = pd.DataFrame([[
-        row['draw_number'],
-        row['number1'],
-        row['number2'],
-        row['number3'],
-        row['number4'],
-        row['number5'],
-        row['number6']
-    ] for row in rows], columns=['Draw', '#1', '#2', '#3', '#4', '#5', '#6'])
-    output = io.StringIO()
-    df.to_csv(output, index=False)
-    output.seek(0)
-    response = make_response(output.getvalue())
-    response.headers["Content-Disposition"] = "attachment; filename=all_combos.csv"
-    response.headers["Content-type"] = "text/csv"
-    return response
+    fmt = _export_format()
+    if fmt is None:
+        return "Unknown format", 400
+    chunks = draws_csv(game_type) if fmt == 'csv' else draws_npy(game_type)
+    return _download(chunks, "all_combos", fmt)
+
+def _owner():
+    """Id of the browser session that owns analysis jobs."""
+    if 'owner' not in session:
+        session['owner'] = uuid.uuid4().hex
+    return session['owner']
+
+def _owned_job(job_id=None):
+    """The requested (or current) job of this session, or None."""
+    job = get_job(job_id or session.get('job_id'))
+    if job is None or job['owner'] != _owner():
+        return None
+    return job
+
+def _owned_result(job_id=None):
+    job = _owned_job(job_id)
+    return load_result(job['id']) if job else None
 
 @app.route('/analysis', methods=['GET'])
 def analysis_route():
@@ -172,110 +281,288 @@ def analysis_route():
     l = request.args.get('l', 1, type=int)
     n_val = request.args.get('n', 0, type=int)
     offset_last = request.args.get('offset_last', 0, type=int)  # keep offset visible
-    global analysis_selected_df, analysis_top_df, analysis_elapsed
+    result = _owned_result(request.args.get('job_id'))
+    selected_df, top_df, elapsed = result if result else (None, None, None)
 
     return render_template(
         'results.html',
         j=j, k=k, m=m, l=l, n=n_val,
         offset_last=offset_last,
-        selected_df=analysis_selected_df,
-        top_df=analysis_top_df,
-        elapsed=analysis_elapsed,
+        selected_df=selected_df,
+        top_df=top_df,
+        elapsed=elapsed,
         game_config=Config.GAMES[game_type]
     )
 
+def _analysis_params():
+    return dict(
+        j=request.form.get('j', type=int, default=6),
+        k=request.form.get('k', type=int, default=3),
+        m=request.form.get('m', type=str, default='min'),
+        l=request.form.get('l', type=int, default=1),
+        n=request.form.get('n', type=int, default=0),
+        last_offset=request.form.get('offset_last', type=int, default=0)  # new offset param
+    )
+
+def _analysis_budget():
+    """budget_seconds / budget_combos of an anytime run, where the form sets them."""
+    budget = dict(
+        budget_seconds=request.form.get('budget_seconds', type=float),
+        budget_combos=request.form.get('budget_combos', type=int)
+    )
+    return {name: value for name, value in budget.items() if value is not None}
+
+def _submit_analysis(kind, previous_job_id=None, budget=None):
+    """
+    Replace this session's running analysis (other sessions' jobs are left
+    alone) with a new queued job; cached results come back already done.
+    """
+    game_type = session.get('game_type', '6_42')
+    owner = _owner()
+    cancel_owner_jobs(owner)
+    params = dict(_analysis_params(), **(budget or {}))
+    if request.form.get('profile') in ('1', 'true'):
+        params['profile'] = True
+    try:
+        job_id = submit_job(owner, game_type, params, kind=kind,
+                            previous_job_id=previous_job_id)
+    except QueueFull as e:
+        return jsonify({'error': str(e)}), 503
+    session['job_id'] = job_id
+    job_manager.ensure_started()
+    return jsonify({'job_id': job_id})
+
 @app.route('/analysis_run', methods=['POST'])
 def analysis_run():
-    global analysis_in_progress, analysis_processed, analysis_total
-    global analysis_selected_df, analysis_top_df, analysis_elapsed
-    global analysis_thread, analysis_cancel_requested
+    """
+    Queue an analysis. With budget_seconds and/or budget_combos it is an
+    anytime run: it stops with the best result found so far when the
+    budget runs out, and a cancelled run keeps its partial result.
+    """
+    return _submit_analysis('run', budget=_analysis_budget())
 
-    game_type = session.get('game_type', '6_42')
-    j = request.form.get('j', type=int, default=6)
-    k = request.form.get('k', type=int, default=3)
-    m = request.form.get('m', type=str, default='min')
-    l = request.form.get('l', type=int, default=1)
-    n_val = request.form.get('n', type=int, default=0)
-    offset_val = request.form.get('offset_last', type=int, default=0)  # new offset param
-
-    # If there's an existing analysis in progress, cancel it
-    if analysis_in_progress:
-        analysis_cancel_requested = True
-        if analysis_thread and analysis_thread.is_alive():
-            analysis_thread.join()
-        analysis_cancel_requested = False
-        analysis_in_progress = False
-
-    analysis_in_progress = True
-    analysis_processed = 0
-    analysis_total = 0
-    analysis_selected_df = None
-    analysis_top_df = None
-    analysis_elapsed = None
-
-    def progress_callback(processed, total):
-        global analysis_processed, analysis_total
-        analysis_processed = processed
-        analysis_total = total
-
-    def should_stop():
-        return analysis_cancel_requested
-
-    def worker():
-        global analysis_in_progress, analysis_selected_df, analysis_top_df, analysis_elapsed
-        sel_df, top_df, elapsed = run_analysis(
-            game_type=game_type,
-            j=j, k=k, m=m, l=l, n=n_val,
-            last_offset=offset_val,
-            progress_callback=progress_callback,
-            should_stop=should_stop
-        )
-        analysis_selected_df = sel_df
-        analysis_top_df = top_df
-        analysis_elapsed = elapsed
-        analysis_in_progress = False
+@app.route('/analysis_update', methods=['POST'])
+def analysis_update():
+    """
+    Re-run the current analysis after draws were appended, patching the
+    previous top list when that is provably correct (see
+    analysis.update_analysis). /analysis_progress reports which path ran.
+    """
+    previous = _owned_job()
+    if previous is None or previous['status'] != 'done':
+        return "No analysis run yet", 400
+    return _submit_analysis('update', previous_job_id=previous['id'])
 
-    analysis_thread = threading.Thread(target=worker)
-    analysis_thread.start()
+@app.route('/analysis_profile', methods=['GET'])
+def analysis_profile():
+    """
+    cProfile stats of a job submitted with profile=1: the top functions by
+    cumulative time as text, or the raw pstats file with format=prof.
+    """
+    job = _owned_job(request.args.get('job_id'))
+    if job is None:
+        return "No such analysis", 404
+    path = profile_path(job['id'])
+    if not os.path.exists(path):
+        return "No profile for this analysis", 404
+    if request.args.get('format') == 'prof':
+        return send_file(os.path.abspath(path), mimetype='application/octet-stream',
+                         as_attachment=True, download_name=f"analysis-{job['id']}.prof")
+    import io
+    import pstats
+
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(
+        request.args.get('limit', 60, type=int))
+    return Response(out.getvalue(), mimetype='text/plain')
+
+@app.route('/analysis_cancel', methods=['POST'])
+def analysis_cancel():
+    job = _owned_job(request.form.get('job_id'))
+    if job is None:
+        return "No such analysis", 404
+    cancel_job(job['id'])
     return "OK"
 
 @app.route('/analysis_progress', methods=['GET'])
 def analysis_progress():
-    global analysis_in_progress, analysis_processed, analysis_total, analysis_elapsed
+    job_manager.ensure_started()
+    job = _owned_job(request.args.get('job_id'))
+    if job is None:
+        return jsonify({'in_progress': False, 'processed': 0, 'total': 0,
+                        'done': False, 'elapsed': None})
     resp = {
-        'in_progress': analysis_in_progress,
-        'processed': analysis_processed,
-        'total': analysis_total,
-        'done': (not analysis_in_progress) and (analysis_elapsed is not None),
-        'elapsed': analysis_elapsed
+        'job_id': job['id'],
+        'status': job['status'],
+        'phase': job['phase'],
+        'in_progress': job['status'] in ('queued', 'running'),
+        'processed': job['processed'],
+        'total': job['total'],
+        'done': job['status'] == 'done',
+        'elapsed': job['elapsed'],
+        'error': job['error']
     }
+    if job['result_meta']:
+        resp['update'] = job['result_meta'].get('update')
+        resp['fallback_reason'] = job['result_meta'].get('fallback_reason')
+        for key in ('coverage', 'complete', 'stopped', 'unseen_bound', 'selection', 'stats'):
+            if key in job['result_meta']:
+                resp[key] = job['result_meta'][key]
     return jsonify(resp)
 
+def _progress_event(job):
+    processed, total = job['processed'] or 0, job['total'] or 0
+    rate = job['rate'] or 0
+    eta = (total - processed) / rate if rate and total else None
+    return {
+        'job_id': job['id'],
+        'status': job['status'],
+        'phase': job['phase'],
+        'processed': processed,
+        'total': total,
+        'throughput': rate,
+        'eta': eta
+    }
+
+@app.route('/analysis_events', methods=['GET'])
+def analysis_events():
+    """
+    Server-Sent Events stream for the current (or given) job: 'progress'
+    events at most every Config.PROGRESS_INTERVAL seconds while it runs,
+    then a single 'done' event with the final status and summary stats.
+    /analysis_progress remains for clients that poll.
+
+    A response ends after Config.EVENT_STREAM_SECONDS so no request thread
+    is held for a whole job; the browser's EventSource reconnects by itself
+    and sends the job id back as Last-Event-ID, so it keeps following the
+    same job.
+    """
+    job = _owned_job(request.args.get('job_id') or request.headers.get('Last-Event-ID'))
+    if job is None:
+        return "No such analysis", 404
+    job_id = job['id']
+    job_manager.ensure_started()
+
+    def event(name, data):
+        return f"id: {job_id}\nevent: {name}\ndata: {json.dumps(data)}\n\n"
+
+    def generate():
+        last = None
+        deadline = time.monotonic() + Config.EVENT_STREAM_SECONDS
+        # Reconnect delay for the EventSource, in milliseconds
+        yield f"retry: {int(Config.PROGRESS_INTERVAL * 1000)}\n\n"
+        while time.monotonic() < deadline:
+            current = get_job(job_id)
+            if current is None:
+                yield event('done', {'job_id': job_id, 'status': 'expired'})
+                return
+            if current['status'] not in ('queued', 'running'):
+                data = _progress_event(current)
+                data['elapsed'] = current['elapsed']
+                data['error'] = current['error']
+                if current['status'] == 'done':
+                    data.update(result_summary(current))
+                    meta = current['result_meta'] or {}
+                    data['update'] = meta.get('update')
+                    data['fallback_reason'] = meta.get('fallback_reason')
+                yield event('done', data)
+                return
+            data = _progress_event(current)
+            if data != last:
+                yield event('progress', data)
+                last = data
+            else:
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+            time.sleep(Config.PROGRESS_INTERVAL)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/analysis_sweep', methods=['POST'])
+def analysis_sweep():
+    """
+    Backtest over a range of offsets. Streams one JSON object per line
+    (application/x-ndjson), one per offset, as results become available.
+    The response lasts as long as the sweep, which is why the web process
+    runs threaded workers (gunicorn.conf.py).
+    """
+    game_type = session.get('game_type', '6_42')
+    j = request.form.get('j', type=int, default=6)
+    k = request.form.get('k', type=int, default=3)
+    m = request.form.get('m', type=str, default='min')
+    l = request.form.get('l', type=int, default=1)
+    n_val = request.form.get('n', type=int, default=0)
+    offset_from = request.form.get('offset_from', type=int, default=0)
+    offset_to = request.form.get('offset_to', type=int, default=offset_from)
+    if offset_to < offset_from:
+        return "offset_to must be >= offset_from", 400
+
+    def generate():
+        for result in run_sweep(game_type=game_type, j=j, k=k, m=m, l=l, n=n_val,
+                                offset_from=offset_from, offset_to=offset_to):
+            yield json.dumps(result) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def _download_result(kind, filename):
+    job = _owned_job(request.args.get('job_id'))
+    if job is None or job['status'] != 'done':
+        return "No analysis run yet", 400
+    if kind == 'selected' and not (job['result_meta'] or {}).get('has_selected'):
+        return "No analysis run yet", 400
+    fmt = _export_format()
+    if fmt is None:
+        return "Unknown format", 400
+    chunks = result_csv(job, kind) if fmt == 'csv' else result_npy(job, kind)
+    return _download(chunks, filename, fmt)
+
+@app.route('/analysis_results', methods=['GET'])
+def analysis_results():
+    """
+    One page of the current (or ?job_id=) analysis result as JSON, read
+    from the job store (see jobs.result_page):
+
+        ?kind=top|selected &sort=position|avg_rank|min_value &order=desc|asc
+        &contains=3,17 &limit=50 &cursor=<next_cursor of the previous page>
+    """
+    job = _owned_job(request.args.get('job_id'))
+    if job is None or job['status'] != 'done':
+        return jsonify({"status": "error", "message": "No analysis run yet"}), 400
+    kind = request.args.get('kind', 'top')
+    order = request.args.get('order', 'desc')
+    if kind not in ('top', 'selected') or order not in ('desc', 'asc'):
+        return jsonify({"status": "error", "message": "kind must be top or selected, "
+                                                      "order desc or asc"}), 400
+    max_number = Config.GAMES[job['game_type']]['max_number']
+    try:
+        contains = [int(n) for n in request.args.get('contains', '').split(',') if n.strip()]
+    except ValueError:
+        contains = None
+    if contains is None or any(not 1 <= n <= max_number for n in contains):
+        return jsonify({"status": "error",
+                        "message": f"contains must list numbers from 1 to {max_number}"}), 400
+    limit = request.args.get('limit', Config.RESULT_PAGE_SIZE, type=int)
+    limit = min(max(limit, 1), Config.RESULT_PAGE_MAX)
+    try:
+        page = result_page(job, kind, sort=request.args.get('sort', 'position'),
+                           descending=order == 'desc', contains=contains, limit=limit,
+                           cursor=request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    meta = job['result_meta'] or {}
+    page.update(job_id=job['id'], kind=kind, total=meta.get(f'{kind}_count'))
+    return jsonify(page)
+
 @app.route('/download_selected_csv', methods=['GET'])
 def download_selected_csv():
-    global analysis_selected_df
-    if analysis_selected_df is None:
-        return "No analysis run yet", 400
-    output = io.StringIO()
-    analysis_selected_df.to_csv(output, index=False)
-    output.seek(0)
-    response = make_response(output.getvalue())
-    response.headers["Content-Disposition"] = "attachment; filename=selected_combinations.csv"
-    response.headers["Content-type"] = "text/csv"
-    return response
+    return _download_result('selected', "selected_combinations")
 
 @app.route('/download_top_csv', methods=['GET'])
 def download_top_csv():
-    global analysis_top_df
-    if analysis_top_df is None:
-        return "No analysis run yet", 400
-    output = io.StringIO()
-    analysis_top_df.to_csv(output, index=False)
-    output.seek(0)
-    response = make_response(output.getvalue())
-    response.headers["Content-Disposition"] = "attachment; filename=top_combinations.csv"
-    response.headers["Content-type"] = "text/csv"
-    return response
+    return _download_result('top', "top_combinations")
 
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 10000))
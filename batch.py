@@ -0,0 +1,228 @@
+# batch.py
+#
+# Headless analysis runs over a parameter grid, e.g. for the nightly picks.
+#
+#   python batch.py --output DIR [--games 6_42,6_49] [--j 6] [--k 2,3]
+#                   [--m min,avg] [--l 1,1000] [--n 0,5] [--offset 0,10]
+#                   [--grid GRID.json] [--processes N] [--engine numpy]
+#
+# Every combination of the listed values (a grid cell) is one run_analysis
+# call. Cells sharing a game, k and offset are run by the same process
+# under analysis.shared_weights(), so their subset weights are read once.
+# The groups are spread over a process pool, one core each.
+#
+# Each finished cell is written to DIR/<cell>.npz at once, column by column
+# (top_combination, top_avg_rank, top_min_value, the same for selected_,
+# and meta: top_df.attrs as JSON). Running the same command again resumes
+# the grid: cells whose file was computed from the current draws are
+# skipped, the others (missing, or made before draws changed) are run.
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from math import comb, ceil
+import numpy as np
+from config import Config
+
+GRID_DEFAULTS = dict(j=[6], k=[3], m=['min'], l=[1], n=[0], last_offset=[0])
+
+
+def parse_list(text, cast):
+    return [cast(value) for value in text.split(',') if value.strip()]
+
+
+def grid_cells(games, grid):
+    """Param dicts (game_type, j, k, m, l, n, last_offset) of every grid cell."""
+    names = list(GRID_DEFAULTS)
+    cells = []
+    for game_type in games:
+        for values in itertools.product(*(grid[name] for name in names)):
+            cells.append(dict(game_type=game_type, **dict(zip(names, values))))
+    return cells
+
+
+def cell_name(cell):
+    return (f"{cell['game_type']}_j{cell['j']}_k{cell['k']}_{cell['m']}"
+            f"_l{cell['l']}_n{cell['n']}_o{cell['last_offset']}")
+
+
+def cell_path(output, cell):
+    return os.path.join(output, cell_name(cell) + '.npz')
+
+
+def read_meta(path):
+    """The meta dict of a cell file, or None if it is missing or unreadable."""
+    try:
+        with np.load(path) as data:
+            return json.loads(str(data['meta']))
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def pending_cells(cells, output):
+    """
+    Cells that still have to run: no file yet, or a file computed from other
+    draws than the current ones (draw count and digest differ).
+    """
+    from analysis import draws_in_use
+    from database import draws_digest
+
+    current = {}
+    pending = []
+    for cell in cells:
+        meta = read_meta(cell_path(output, cell))
+        if meta is not None:
+            key = (cell['game_type'], cell['last_offset'])
+            if key not in current:
+                use_count = draws_in_use(*key)
+                current[key] = (use_count,
+                                draws_digest(key[0], use_count) if use_count > 0 else None)
+            if (meta.get('draw_count'), meta.get('draws_digest')) == current[key]:
+                continue
+        pending.append(cell)
+    return pending
+
+
+def frame_columns(df, prefix, j):
+    from exports import combination_array
+
+    if df is None:
+        return {}
+    return {f'{prefix}_combination': combination_array(list(df['Combination']), j),
+            f'{prefix}_avg_rank': df['Average Rank'].to_numpy(dtype=np.float64),
+            f'{prefix}_min_value': df['MinValue'].to_numpy(dtype=np.int64)}
+
+
+def write_cell(output, cell, selected_df, top_df, elapsed):
+    """Write a cell's result; the file only appears once it is complete."""
+    if top_df is None:
+        # No draws left at this offset
+        meta = dict(cell, draw_count=0, draws_digest=None)
+    else:
+        meta = dict(top_df.attrs)
+    meta.update(elapsed=elapsed, has_selected=selected_df is not None)
+    columns = frame_columns(top_df, 'top', cell['j'])
+    columns.update(frame_columns(selected_df, 'selected', cell['j']))
+    path = cell_path(output, cell)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, meta=np.array(json.dumps(meta)), **columns)
+    os.replace(tmp_path, path)
+
+
+def run_cells(cells, output, engine):
+    """Pool task: run cells of one (game, k, offset) group, sharing their weights."""
+    import analysis
+
+    done = []
+    with analysis.shared_weights():
+        for cell in cells:
+            started = time.perf_counter()
+            selected_df, top_df, elapsed = analysis.run_analysis(
+                cell['game_type'], cell['j'], cell['k'], cell['m'], cell['l'], cell['n'],
+                cell['last_offset'], engine=engine, workers=1)
+            write_cell(output, cell, selected_df, top_df, elapsed)
+            done.append((cell_name(cell), round(time.perf_counter() - started, 3)))
+    return done
+
+
+def schedule(cells, processes):
+    """
+    Split the cells into pool tasks: one per (game, k, offset) group, and
+    groups cut into pieces while there are fewer tasks than processes.
+    Largest tasks first, so the pool is not left waiting on one big cell.
+    """
+    groups = {}
+    for cell in cells:
+        groups.setdefault((cell['game_type'], cell['k'], cell['last_offset']), []).append(cell)
+    pieces = max(1, ceil(processes / len(groups))) if groups else 1
+
+    def cost(cell):
+        return comb(Config.GAMES[cell['game_type']]['max_number'], cell['j'])
+
+    tasks = []
+    for group in groups.values():
+        group.sort(key=cost, reverse=True)
+        size = max(1, ceil(len(group) / pieces))
+        tasks.extend(group[i:i + size] for i in range(0, len(group), size))
+    tasks.sort(key=lambda task: sum(cost(cell) for cell in task), reverse=True)
+    return tasks
+
+
+def load_grid(args):
+    grid = dict(GRID_DEFAULTS)
+    games = list(Config.GAMES)
+    if args.grid:
+        with open(args.grid) as f:
+            spec = json.load(f)
+        games = spec.pop('games', games)
+        if 'offset' in spec:
+            spec['last_offset'] = spec.pop('offset')
+        unknown = set(spec) - set(grid)
+        if unknown:
+            raise SystemExit(f"Unknown grid keys: {', '.join(sorted(unknown))}")
+        grid.update(spec)
+    flags = dict(j=(args.j, int), k=(args.k, int), m=(args.m, str), l=(args.l, int),
+                 n=(args.n, int), last_offset=(args.offset, int))
+    for name, (text, cast) in flags.items():
+        if text is not None:
+            grid[name] = parse_list(text, cast)
+    if args.games is not None:
+        games = parse_list(args.games, str)
+    for game_type in games:
+        if game_type not in Config.GAMES:
+            raise SystemExit(f"Unknown game: {game_type}")
+    if any(m not in ('min', 'avg') for m in grid['m']):
+        raise SystemExit("m must be 'min' or 'avg'")
+    return games, grid
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run analyses over a parameter grid.")
+    parser.add_argument('--output', required=True, help="directory for the cell files")
+    parser.add_argument('--grid', help="JSON file: {games: [...], j: [...], k: [...], ...}")
+    parser.add_argument('--games', help="comma-separated game types (default: all)")
+    parser.add_argument('--j')
+    parser.add_argument('--k')
+    parser.add_argument('--m')
+    parser.add_argument('--l')
+    parser.add_argument('--n')
+    parser.add_argument('--offset', help="last_offset values")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--engine', default=None,
+                        help="'numpy', 'prune', 'gray' or 'python' (default: Config.ANALYSIS_ENGINE)")
+    args = parser.parse_args(argv)
+
+    games, grid = load_grid(args)
+    os.makedirs(args.output, exist_ok=True)
+    cells = grid_cells(games, grid)
+    pending = pending_cells(cells, args.output)
+    print(f"{len(cells)} cells, {len(cells) - len(pending)} already done", flush=True)
+    if not pending:
+        return 0
+
+    failed = 0
+    tasks = schedule(pending, args.processes)
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=min(args.processes, len(tasks)), mp_context=ctx) as pool:
+        futures = {pool.submit(run_cells, task, args.output, args.engine): task for task in tasks}
+        for future in as_completed(futures):
+            try:
+                for name, seconds in future.result():
+                    print(f"done  {name}  {seconds}s", flush=True)
+            except Exception as e:
+                # Cells of the task written before the failure stay done
+                failed += 1
+                names = ', '.join(cell_name(cell) for cell in futures[future])
+                print(f"FAILED  {names}: {e!r}", file=sys.stderr, flush=True)
+    remaining = len(pending_cells(cells, args.output))
+    print(f"{len(cells) - remaining} of {len(cells)} cells done", flush=True)
+    return 1 if failed or remaining else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,377 @@
+# benchmark.py
+#
+# Offline benchmarks for the analysis engine and the database layer.
+#
+#   python benchmark.py run [--quick] [--output FILE] [--scales 1,10,100] ...
+#   python benchmark.py compare BASELINE.json CURRENT.json [--tolerance 0.15]
+#
+# Every case runs against scratch databases in a temporary directory, built
+# from the bundled CSV histories and from synthetic histories 10x-100x their
+# size, so the real databases are never touched. Each case runs in a fresh
+# process, so its peak RSS is its own. Results are written as JSON, one
+# record per case; compare exits with status 1 when a case got slower (or
+# bigger) than the baseline by more than the tolerance.
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from math import comb
+import numpy as np
+from config import Config
+
+# run_analysis parameter grids: the full grid runs on the bundled histories,
+# the scaled grid on the synthetic ones
+ANALYSIS_GRID = dict(j=[6], k=[2, 3], m=['min', 'avg'], l=[1, 1000], n=[0, 5],
+                     last_offset=[0, 10])
+SCALED_GRID = dict(j=[6], k=[3], m=['min', 'avg'], l=[1], n=[0], last_offset=[0])
+QUICK_GRID = dict(j=[6], k=[3], m=['min', 'avg'], l=[1], n=[0, 3], last_offset=[0])
+
+# Grid edits per database case, and pages read by the paging cases
+DB_OP_COUNT = 200
+QUICK_DB_OP_COUNT = 50
+PAGE_SIZE = 100
+
+# Timing differences below this many seconds are never reported as regressions
+MIN_DELTA = 0.01
+
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def grid_params(grid):
+    names = list(grid)
+    for values in itertools.product(*(grid[name] for name in names)):
+        yield dict(zip(names, values))
+
+
+def write_synthetic_csv(path, max_number, count, seed=0, chunk_size=100000):
+    """count random draws of six distinct numbers, in the bundled CSV format."""
+    rng = np.random.default_rng(seed)
+    with open(path, 'w') as f:
+        f.write('a,b,c,d,e,f\n')
+        for start in range(0, count, chunk_size):
+            size = min(chunk_size, count - start)
+            draws = np.sort(rng.random((size, max_number)).argsort(axis=1)[:, :6] + 1, axis=1)
+            np.savetxt(f, draws, fmt='%d', delimiter=',')
+
+
+def prepare_datasets(workdir, game_types, scales):
+    """
+    Config.GAMES entries for every (game type, scale): scale 1 is the
+    bundled history, larger scales are synthetic histories with scale times
+    as many draws. Databases are created by the import cases.
+    """
+    games = {}
+    for game_type in game_types:
+        base = Config.GAMES[game_type]
+        with open(base['csv_file']) as f:
+            draws = sum(1 for line in f if line.strip()) - 1
+        for scale in scales:
+            name = game_type if scale == 1 else f"{game_type}x{scale}"
+            csv_file = os.path.abspath(base['csv_file'])
+            if scale != 1:
+                csv_file = os.path.join(workdir, f"{name}.csv")
+                write_synthetic_csv(csv_file, base['max_number'], draws * scale, seed=scale)
+            games[name] = dict(base, name=name, csv_file=csv_file,
+                               db_name=os.path.join(workdir, f"{name}.db"),
+                               draws=draws * scale, scale=scale)
+    return games
+
+
+def build_cases(games, quick=False, engine=None, workers=1, repeat=3):
+    """Cases in run order: per dataset, import, index, analysis, then grid edits."""
+    cases = []
+    engine = engine or Config.ANALYSIS_ENGINE
+    op_count = QUICK_DB_OP_COUNT if quick else DB_OP_COUNT
+    for name, game in games.items():
+        if quick:
+            grid = QUICK_GRID
+        else:
+            grid = ANALYSIS_GRID if game['scale'] == 1 else SCALED_GRID
+        cases.append(dict(kind='import', name=f"import/{name}", dataset=name))
+        for k in sorted(set(grid['k'])):
+            cases.append(dict(kind='index', name=f"index/{name}/k{k}", dataset=name, k=k))
+        for params in grid_params(grid):
+            label = "j{j}-k{k}-{m}-l{l}-n{n}-o{last_offset}".format(**params)
+            cases.append(dict(kind='analysis', name=f"analysis/{name}/{label}", dataset=name,
+                              params=params, engine=engine, workers=workers, repeat=repeat))
+        for op in DB_CASES:
+            cases.append(dict(kind='db', name=f"db/{name}/{op}", dataset=name, op=op,
+                              count=op_count))
+    return cases
+
+
+def _import_case(case, game):
+    from init_database import init_db, import_draws
+
+    init_db(case['dataset']).close()
+    start = time.perf_counter()
+    imported = import_draws(case['dataset'], game['csv_file'], mode='replace')
+    seconds = time.perf_counter() - start
+    return dict(seconds=seconds, rows=imported, rows_per_sec=imported / seconds)
+
+
+def _index_case(case, game):
+    import snapshot
+
+    snap = snapshot.current(case['dataset'])
+    start = time.perf_counter()
+    snap.ranks(case['k'])
+    seconds = time.perf_counter() - start
+    return dict(seconds=seconds, rows_per_sec=game['draws'] / seconds)
+
+
+def _analysis_case(case, game):
+    from analysis import run_analysis
+
+    params = case['params']
+    runs = []
+    for _ in range(case['repeat']):
+        phases = {}
+        marks = []
+
+        def phase_callback(name):
+            marks.append((name, time.perf_counter()))
+
+        start = time.perf_counter()
+        run_analysis(game_type=case['dataset'], engine=case['engine'],
+                     workers=case['workers'], phase_callback=phase_callback, **params)
+        end = time.perf_counter()
+        for (name, t0), (_, t1) in zip(marks, marks[1:] + [(None, end)]):
+            phases[name] = t1 - t0
+        runs.append((end - start, phases))
+    seconds, phases = min(runs, key=lambda run: run[0])
+    combos = comb(game['max_number'], params['j'])
+    return dict(seconds=seconds, cold_seconds=runs[0][0], phases=phases, combos=combos,
+                combos_per_sec=combos / seconds)
+
+
+def _db_insert_draw(dataset, count, rng):
+    from database import insert_draw, get_all_draws
+
+    ids = [row['id'] for row in get_all_draws(dataset)]
+    max_number = Config.GAMES[dataset]['max_number']
+    start = time.perf_counter()
+    for _ in range(count):
+        numbers = sorted(rng.choice(max_number, 6, replace=False) + 1)
+        insert_draw([int(x) for x in numbers], dataset, after_id=int(rng.choice(ids)))
+    return time.perf_counter() - start, count
+
+
+def _db_delete_draws(dataset, count, rng):
+    from database import delete_draws, get_all_draws
+
+    ids = [row['id'] for row in get_all_draws(dataset)]
+    picked = rng.choice(ids, min(count, len(ids)), replace=False).tolist()
+    start = time.perf_counter()
+    for batch in range(0, len(picked), 10):
+        delete_draws(picked[batch:batch + 10], dataset)
+    return time.perf_counter() - start, len(picked)
+
+
+def _db_reorder(dataset, count, rng):
+    from database import reorder_draws, get_all_draws
+
+    order = [row['id'] for row in get_all_draws(dataset)]
+    for _ in range(count):
+        order.insert(int(rng.integers(len(order))), order.pop(int(rng.integers(len(order)))))
+    start = time.perf_counter()
+    reorder_draws(order, dataset)
+    return time.perf_counter() - start, 1
+
+
+def _db_page_keyset(dataset, count, rng):
+    from database import get_draws
+
+    start = time.perf_counter()
+    after = None
+    for _ in range(count):
+        rows = get_draws(dataset, limit=PAGE_SIZE, after=after)
+        if not rows:
+            break
+        after = (rows[-1]['sort_order'], rows[-1]['id'], int(rows[-1]['draw_number']))
+    return time.perf_counter() - start, count
+
+
+def _db_page_offset(dataset, count, rng):
+    from database import get_draws, count_draws
+
+    total = count_draws(dataset)
+    offsets = rng.integers(0, max(total - PAGE_SIZE, 1), count).tolist()
+    start = time.perf_counter()
+    for offset in offsets:
+        get_draws(dataset, limit=PAGE_SIZE, offset=offset)
+    return time.perf_counter() - start, count
+
+
+DB_CASES = {
+    'insert_draw': _db_insert_draw,
+    'delete_draws': _db_delete_draws,
+    'reorder_draws': _db_reorder,
+    'get_draws_keyset': _db_page_keyset,
+    'get_draws_offset': _db_page_offset,
+}
+
+
+def _db_case(case, game):
+    # Edits go to a copy, so every case starts from the imported history
+    copy = f"{game['db_name']}.{case['op']}"
+    source, target = sqlite3.connect(game['db_name']), sqlite3.connect(copy)
+    source.backup(target)
+    source.close()
+    target.close()
+    Config.GAMES[case['dataset']] = dict(game, db_name=copy)
+    try:
+        seconds, ops = DB_CASES[case['op']](case['dataset'], case['count'],
+                                            np.random.default_rng(0))
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(copy + suffix):
+                os.remove(copy + suffix)
+    return dict(seconds=seconds, ops=ops, ops_per_sec=ops / seconds)
+
+
+CASE_KINDS = {
+    'import': _import_case,
+    'index': _index_case,
+    'analysis': _analysis_case,
+    'db': _db_case,
+}
+
+
+def run_case(case, games):
+    """Run one case (in a fresh process) and return its result record."""
+    Config.GAMES.update(games)
+    game = games[case['dataset']]
+    # Snapshots (snapshot.py) go with the scratch databases
+    Config.SNAPSHOT_DIR = os.path.join(os.path.dirname(game['db_name']), 'snapshots')
+    result = CASE_KINDS[case['kind']](case, game)
+    record = dict(case)
+    record.update(result, draws=game['draws'], peak_rss_kb=peak_rss_kb())
+    return record
+
+
+def run(game_types, scales, quick=False, engine=None, workers=1, repeat=3, log=sys.stderr):
+    workdir = tempfile.mkdtemp(prefix='benchmark-')
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        games = prepare_datasets(workdir, game_types, scales)
+        for case in build_cases(games, quick, engine, workers, repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                record = pool.submit(run_case, case, games).result()
+            results.append(record)
+            print(f"{record['name']:<56} {record['seconds']:9.3f}s "
+                  f"{record['peak_rss_kb'] / 1024:8.1f} MiB", file=log)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'created': time.time(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': dict(game_types=game_types, scales=scales, quick=quick,
+                         engine=engine or Config.ANALYSIS_ENGINE, workers=workers,
+                         repeat=repeat),
+        'results': results,
+    }
+
+
+def compare(baseline, current, tolerance=0.15, memory_tolerance=0.25):
+    """
+    Lines describing every case of current against baseline, and the names
+    of the cases that regressed: slower than baseline * (1 + tolerance), or
+    with a peak RSS above baseline * (1 + memory_tolerance).
+    """
+    previous = {record['name']: record for record in baseline['results']}
+    lines = []
+    regressions = []
+    for record in current['results']:
+        name = record['name']
+        before = previous.pop(name, None)
+        if before is None:
+            lines.append(f"{name:<56} {record['seconds']:9.3f}s  (new)")
+            continue
+        ratio = record['seconds'] / before['seconds'] if before['seconds'] else float('inf')
+        memory = record['peak_rss_kb'] / before['peak_rss_kb'] if before['peak_rss_kb'] else 1.0
+        flags = []
+        if ratio > 1 + tolerance and record['seconds'] - before['seconds'] > MIN_DELTA:
+            flags.append('SLOWER')
+        if memory > 1 + memory_tolerance:
+            flags.append('MEMORY')
+        if flags:
+            regressions.append(name)
+        lines.append(f"{name:<56} {before['seconds']:9.3f}s -> {record['seconds']:9.3f}s "
+                     f"({ratio - 1:+7.1%}, rss {memory - 1:+6.1%}) {' '.join(flags)}")
+    for name in previous:
+        lines.append(f"{name:<56} (missing from current run)")
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Offline benchmarks for the analysis engine and the database layer.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="run the benchmarks and write JSON")
+    run_parser.add_argument('--output', '-o', default='-',
+                            help="JSON file to write (default: stdout)")
+    run_parser.add_argument('--games', default=','.join(Config.GAMES),
+                            help="comma-separated game types")
+    run_parser.add_argument('--scales', default=None,
+                            help="comma-separated history sizes (default 1,10,100; 1,10 with --quick)")
+    run_parser.add_argument('--quick', action='store_true',
+                            help="a small grid, for a fast check")
+    run_parser.add_argument('--engine', default=None, help="analysis engine")
+    run_parser.add_argument('--workers', type=int, default=1, help="analysis workers")
+    run_parser.add_argument('--repeat', type=int, default=None,
+                            help="runs per analysis case, the fastest is kept (default 3; 1 with --quick)")
+
+    compare_parser = commands.add_parser('compare', help="compare a run with a baseline")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--tolerance', type=float, default=0.15,
+                                help="allowed slowdown, as a fraction (default 0.15)")
+    compare_parser.add_argument('--memory-tolerance', type=float, default=0.25,
+                                help="allowed peak RSS growth, as a fraction (default 0.25)")
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        scales = args.scales or ('1,10' if args.quick else '1,10,100')
+        repeat = args.repeat or (1 if args.quick else 3)
+        report = run(args.games.split(','), [int(s) for s in scales.split(',')],
+                     quick=args.quick, engine=args.engine, workers=args.workers, repeat=repeat)
+        text = json.dumps(report, indent=2)
+        if args.output == '-':
+            print(text)
+        else:
+            with open(args.output, 'w') as f:
+                f.write(text + '\n')
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    lines, regressions = compare(baseline, current, args.tolerance, args.memory_tolerance)
+    print('\n'.join(lines))
+    if regressions:
+        print(f"\n{len(regressions)} regression(s)", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,6 @@
 # config.py (new file)
+import os
+
 class Config:
     GAMES = {
         '6_42': {
@@ -14,3 +16,68 @@ class Config:
             'csv_file': 'Toto_6_49_with_first_row.csv'
         }
     }
+
+    # Scoring engine used by analysis.run_analysis: 'numpy', 'prune', 'gray' or 'python'
+    ANALYSIS_ENGINE = 'numpy'
+
+    # Processes used to score combos (1 = score in the calling thread)
+    ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS', 1))
+    # Shards handed to each worker, so uneven shards still balance out
+    ANALYSIS_SHARDS_PER_WORKER = 4
+    # Seconds between progress/cancel checks while workers run
+    ANALYSIS_POLL_INTERVAL = 0.5
+    # Seconds between progress reports (python engine, job store, /analysis_events)
+    PROGRESS_INTERVAL = 0.5
+    # Seconds one /analysis_events response stays open before the client's
+    # EventSource reconnects (with Last-Event-ID) for the rest of the job
+    EVENT_STREAM_SECONDS = 25
+
+    # Analysis results kept by result_cache (LRU); 0 disables the cache
+    RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 16))
+    # Directory for persisting cached results across restarts (None = memory only)
+    RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR') or None
+
+    # Backtest sweeps: offsets scored together per pass over the combos,
+    # capped so the group's weight arrays stay within the byte budget
+    SWEEP_GROUP_SIZE = 8
+    SWEEP_WEIGHT_BUDGET = 256 * 1024 * 1024
+
+    # Top-l selection (topl.py): bytes of candidates kept in memory before
+    # sorted runs are spilled to .npy files, and where (None = system temp)
+    TOPL_MEMORY_BUDGET = 256 * 1024 * 1024
+    TOPL_SPILL_DIR = os.environ.get('TOPL_SPILL_DIR') or None
+
+    # n-overlap selection (analysis.pick_non_overlapping): combos the main
+    # scan keeps beyond the top-l when n > 0, the most combos one further
+    # pass over all combos keeps, and how many such passes may run
+    SELECT_HEAD_ROWS = 1 << 16
+    SELECT_PASS_ROWS = 1 << 20
+    SELECT_MAX_PASSES = 4
+
+    # Analysis jobs (jobs.py): shared store, processes per web worker,
+    # how many jobs may wait, and polling/expiry timings in seconds
+    JOB_DB = os.environ.get('JOB_DB', 'analysis_jobs.db')
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 1))
+    JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 8))
+    JOB_POLL_INTERVAL = 0.2
+    JOB_STALE_SECONDS = 300
+    JOB_RETENTION_SECONDS = 24 * 3600
+    # cProfile output of jobs submitted with profile=1 (jobs.profile_path)
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+    # Memory-mapped draw/weight snapshots shared by all processes (snapshot.py)
+    SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', 'snapshots')
+    # Rows read and validated per chunk by init_database.import_draws
+    IMPORT_CHUNK_SIZE = 50000
+    # Rows read from the database per chunk of a streamed download (exports.py)
+    EXPORT_CHUNK_SIZE = 5000
+    # Result pages (/analysis_results): default and largest page size, and
+    # the most index entries one page may read when filtering by numbers
+    RESULT_PAGE_SIZE = 50
+    RESULT_PAGE_MAX = 1000
+    RESULT_SCAN_LIMIT = 20000
+
+    # SQLite connections to the draws databases (database.py): idle
+    # connections kept per database, page cache in KiB and busy timeout
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+    DB_CACHE_KB = 16 * 1024
+    DB_BUSY_TIMEOUT = 5
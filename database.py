@@ -1,112 +1,646 @@
 # database.py
 
 import sqlite3
-import pandas as pd
+import hashlib
+import bisect
+import os
+import threading
+import time
+import uuid
+import numpy as np
 from config import Config
+import metrics
+import scoring
+
+# Connection pool
+#
+# get_db_connection hands out connections from one pool per database file.
+# close() on a pooled connection rolls back anything uncommitted and puts it
+# back, so callers keep the usual connect/.../close pattern while the
+# connection, its page cache and its prepared statements are reused.
+# Connections are in WAL mode, so readers (analysis) never block the writer
+# (grid edits) and vice versa. Pools are per process: a forked or spawned
+# worker starts with empty pools.
+#
+# Every statement goes through a TimedCursor, which times the statements
+# that take the write lock (BEGIN IMMEDIATE, or the first write of an
+# implicit transaction) into metrics: that is where SQLite waits for
+# other writers.
+
+_LOCKING_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'BEGIN IMMEDIATE',
+                       'BEGIN EXCLUSIVE')
+
+class TimedCursor(sqlite3.Cursor):
+    def _takes_lock(self, sql):
+        return (not self.connection.in_transaction
+                and sql.lstrip()[:15].upper().startswith(_LOCKING_STATEMENTS))
+
+    def execute(self, sql, parameters=()):
+        if not self._takes_lock(sql):
+            return super().execute(sql, parameters)
+        with metrics.timed('lock_wait', metrics.sqlite_lock_wait_seconds,
+                           database=self.connection.db_name):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not self._takes_lock(sql):
+            return super().executemany(sql, seq_of_parameters)
+        with metrics.timed('lock_wait', metrics.sqlite_lock_wait_seconds,
+                           database=self.connection.db_name):
+            return super().executemany(sql, seq_of_parameters)
+
+class PooledConnection(sqlite3.Connection):
+    pool = None
+    db_name = ''
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or TimedCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        if self.pool is None:
+            super().close()
+        else:
+            self.pool.release(self)
+
+    def discard(self):
+        self.pool = None
+        super().close()
+
+class ConnectionPool:
+    def __init__(self, db_path, size):
+        self.db_path = db_path
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._checked_schema = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=Config.DB_BUSY_TIMEOUT,
+                               factory=PooledConnection, check_same_thread=False,
+                               cached_statements=256)
+        conn.db_name = os.path.basename(self.db_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{Config.DB_CACHE_KB}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if not self._checked_schema:
+            try:
+                ensure_draw_indexes(conn)
+                conn.commit()
+            except sqlite3.OperationalError:
+                # No draws table yet (or the database is busy): try next time
+                conn.rollback()
+            else:
+                self._checked_schema = True
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._connect()
+        conn.pool = self
+        conn.row_factory = sqlite3.Row
+        _checked_out().add(conn)
+        return conn
+
+    def release(self, conn):
+        _checked_out().discard(conn)
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.discard()
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.discard()
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+_local = threading.local()
+
+def _checked_out():
+    if not hasattr(_local, 'conns'):
+        _local.conns = set()
+    return _local.conns
+
+def get_pool(db_path):
+    global _pools, _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            # Connections inherited through fork belong to the parent
+            _pools, _pools_pid = {}, os.getpid()
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = _pools[db_path] = ConnectionPool(db_path, Config.DB_POOL_SIZE)
+        return pool
 
 def get_db_connection(game_type='6_42'):
-    db_path = Config.GAMES[game_type]['db_name']
-    conn = sqlite3.connect(db_path, timeout=5)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return get_pool(Config.GAMES[game_type]['db_name']).acquire()
+
+def release_connections():
+    """Return connections this thread never closed (Flask teardown)."""
+    for conn in list(_checked_out()):
+        conn.close()
+
+def ensure_dataset_meta(conn):
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS dataset_meta (key TEXT PRIMARY KEY, value TEXT)"
+    )
+    # The epoch is new whenever the table is (re)created, so versions from a
+    # previous incarnation of the database can never be confused with ours.
+    conn.execute(
+        "INSERT OR IGNORE INTO dataset_meta (key, value) VALUES ('epoch', ?)",
+        (uuid.uuid4().hex,)
+    )
+    conn.execute("INSERT OR IGNORE INTO dataset_meta (key, value) VALUES ('version', '0')")
+    conn.execute(
+        "INSERT OR IGNORE INTO dataset_meta (key, value) VALUES ('modified', ?)",
+        (repr(time.time()),)
+    )
+
+def bump_data_version(conn):
+    """Mark the dataset as changed; runs inside the caller's transaction."""
+    ensure_dataset_meta(conn)
+    conn.execute(
+        "UPDATE dataset_meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'version'"
+    )
+    conn.execute("UPDATE dataset_meta SET value = ? WHERE key = 'modified'", (repr(time.time()),))
+    conn.execute("DELETE FROM dataset_meta WHERE key = 'draw_count'")
 
-def renumber_all(game_type='6_42'):
+def get_dataset_meta(game_type='6_42'):
+    """
+    The dataset_meta entries as a dict: 'version' (see get_data_version),
+    'modified' (unix time of the last write) and, if cached, 'draw_count'.
+    """
     conn = get_db_connection(game_type)
-    c = conn.cursor()
-    rows = c.execute("SELECT id FROM draws ORDER BY sort_order").fetchall()
-    for i, row in enumerate(rows, start=1):
-        draw_number = f"{i:04d}"
-        c.execute("UPDATE draws SET sort_order=?, draw_number=? WHERE id=?",
-                  (i, draw_number, row['id']))
-    conn.commit()
+    try:
+        meta = dict(conn.execute("SELECT key, value FROM dataset_meta").fetchall())
+    except sqlite3.OperationalError:
+        meta = {}
+    if not {'epoch', 'version', 'modified'} <= meta.keys():
+        ensure_dataset_meta(conn)
+        conn.commit()
+        meta = dict(conn.execute("SELECT key, value FROM dataset_meta").fetchall())
     conn.close()
+    meta['modified'] = float(meta['modified'])
+    meta['version'] = f"{meta.pop('epoch')}:{meta['version']}"
+    return meta
+
+def get_data_version(game_type='6_42'):
+    """Opaque token that changes on every write done through this module."""
+    return get_dataset_meta(game_type)['version']
+
+# Ordering
+#
+# sort_order keys are spaced SORT_GAP apart, so an insert or move can take a
+# key between its neighbours and touch a single row. When two neighbours run
+# out of room the keys are respaced, which is the only O(n) write. Draw
+# numbers are positions and are computed on read rather than stored.
+SORT_GAP = 1024
+
+def draw_columns(first_position=0):
+    """Select list of draws, numbering the selected rows from first_position + 1."""
+    return (
+        f"id, printf('%04d', {int(first_position)} + ROW_NUMBER() OVER (ORDER BY sort_order, id)) "
+        "AS draw_number, number1, number2, number3, number4, number5, number6, sort_order"
+    )
+
+def respace_sort_order(conn, ids=None):
+    """
+    Rewrite every sort_order as position * SORT_GAP, keeping the order (or
+    in the order of `ids`, which must list every draw).
+    """
+    if ids is None:
+        ids = [row[0] for row in conn.execute("SELECT id FROM draws ORDER BY sort_order, id")]
+    _write_keys(conn, [(i * SORT_GAP, draw_id) for i, draw_id in enumerate(ids, start=1)])
 
-def get_draws(game_type='6_42', limit=100, offset=0):
+def _write_keys(conn, changed):
+    """
+    Set (sort_order, id) pairs. The rows are cleared first, so a new key may
+    be one that another of the rows still holds (sort_order is UNIQUE).
+    """
+    conn.executemany("UPDATE draws SET sort_order=NULL WHERE id=?",
+                     [(draw_id,) for _, draw_id in changed])
+    conn.executemany("UPDATE draws SET sort_order=? WHERE id=?", changed)
+
+def sort_key_after(conn, after_sort):
+    """A free sort_order right after after_sort (None: after the last draw)."""
+    if after_sort is None:
+        max_so = conn.execute("SELECT MAX(sort_order) FROM draws").fetchone()[0]
+        return (max_so or 0) + SORT_GAP
+    next_so = conn.execute(
+        "SELECT MIN(sort_order) FROM draws WHERE sort_order > ?", (after_sort,)
+    ).fetchone()[0]
+    if next_so is None:
+        return after_sort + SORT_GAP
+    if next_so - after_sort < 2:
+        return None
+    return (after_sort + next_so) // 2
+
+def ensure_draw_indexes(conn):
+    unique = {row[1]: row[2] for row in conn.execute("PRAGMA index_list(draws)")}
+    if not unique.get('idx_draws_sort_order'):
+        # Older databases have a plain index, and possibly duplicate keys
+        duplicate = conn.execute(
+            "SELECT 1 FROM draws WHERE sort_order IS NOT NULL "
+            "GROUP BY sort_order HAVING COUNT(*) > 1 LIMIT 1"
+        ).fetchone()
+        if duplicate:
+            respace_sort_order(conn)
+        conn.execute("DROP INDEX IF EXISTS idx_draws_sort_order")
+        conn.execute("CREATE UNIQUE INDEX idx_draws_sort_order ON draws (sort_order)")
+    # k-subset ranks live in the snapshot (snapshot.py); drop the SQLite
+    # subset index that older databases carry
+    conn.execute("DROP TABLE IF EXISTS subset_index")
+    conn.execute("DROP TABLE IF EXISTS subset_index_meta")
+
+def get_draws(game_type='6_42', limit=100, offset=0, after=None):
+    """
+    A page of draws by (sort_order, id). after=(sort_order, id, position)
+    continues right after that draw, given its 1-based position (keyset
+    pagination); otherwise the page starts at `offset`.
+    """
     conn = get_db_connection(game_type)
-    draws = conn.execute(
-        "SELECT * FROM draws ORDER BY sort_order LIMIT ? OFFSET ?",
-        (limit, offset)
-    ).fetchall()
+    if after is None:
+        draws = conn.execute(
+            f"SELECT {draw_columns(offset)} FROM "
+            "(SELECT * FROM draws ORDER BY sort_order, id LIMIT ? OFFSET ?) "
+            "ORDER BY sort_order, id",
+            (limit, offset)
+        ).fetchall()
+    else:
+        after_sort, after_id, position = after
+        draws = conn.execute(
+            f"SELECT {draw_columns(position)} FROM "
+            "(SELECT * FROM draws WHERE (sort_order, id) > (?, ?) "
+            "ORDER BY sort_order, id LIMIT ?) "
+            "ORDER BY sort_order, id",
+            (after_sort, after_id, limit)
+        ).fetchall()
     conn.close()
     return draws
 
-def count_draws(game_type='6_42'):
+def draw_position(sort_order, draw_id, game_type='6_42'):
+    """1-based position of the draw with this (sort_order, id)."""
     conn = get_db_connection(game_type)
-    count = conn.execute("SELECT COUNT(*) as cnt FROM draws").fetchone()["cnt"]
+    position = conn.execute(
+        "SELECT COUNT(*) FROM draws WHERE (sort_order, id) <= (?, ?)", (sort_order, draw_id)
+    ).fetchone()[0]
     conn.close()
-    return count
+    return position
 
-def insert_draw(numbers, game_type='6_42', after_id=None):
-    numbers = clamp_numbers(numbers, game_type)
+def count_draws(game_type='6_42'):
+    """Number of draws, cached in dataset_meta until the next write."""
+    cached = get_dataset_meta(game_type).get('draw_count')
+    if cached is not None:
+        return int(cached)
     conn = get_db_connection(game_type)
-    c = conn.cursor()
+    try:
+        # Count and version from one read snapshot (WAL), without the write lock
+        conn.execute("BEGIN")
+        version = conn.execute(
+            "SELECT value FROM dataset_meta WHERE key = 'version'").fetchone()[0]
+        count = conn.execute("SELECT COUNT(*) as cnt FROM draws").fetchone()["cnt"]
+        conn.commit()
+        # Cache it unless a write came in meanwhile; the cache is best effort,
+        # so a busy database is not waited for
+        conn.execute("PRAGMA busy_timeout = 0")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO dataset_meta (key, value) SELECT 'draw_count', ? "
+                "WHERE (SELECT value FROM dataset_meta WHERE key = 'version') = ?",
+                (str(count), version)
+            )
+            conn.commit()
+        except sqlite3.OperationalError:
+            conn.rollback()
+        finally:
+            conn.execute(f"PRAGMA busy_timeout = {int(Config.DB_BUSY_TIMEOUT * 1000)}")
+    finally:
+        conn.close()
+    return count
 
+def _key_after_id(c, after_id):
+    """
+    A free sort_order right after draw after_id; None or an unknown id means
+    after the last draw, 0 means before the first one.
+    """
+    if after_id == 0:
+        min_so = c.execute("SELECT MIN(sort_order) FROM draws").fetchone()[0]
+        return (min_so or 0) - SORT_GAP
+    after_sort = None
     if after_id:
         row = c.execute("SELECT sort_order FROM draws WHERE id=?", (after_id,)).fetchone()
         if row:
-            after_sort = row["sort_order"]
-            c.execute("UPDATE draws SET sort_order = sort_order + 1 WHERE sort_order > ?", (after_sort,))
-            new_sort_order = after_sort + 1
-        else:
-            max_so = c.execute("SELECT MAX(sort_order) FROM draws").fetchone()[0]
-            new_sort_order = (max_so or 0) + 1
-    else:
-        max_so = c.execute("SELECT MAX(sort_order) FROM draws").fetchone()[0]
-        new_sort_order = (max_so or 0) + 1
+            after_sort = row[0]
+    key = sort_key_after(c, after_sort)
+    if key is None:
+        respace_sort_order(c)
+        after_sort = c.execute("SELECT sort_order FROM draws WHERE id=?", (after_id,)).fetchone()[0]
+        key = sort_key_after(c, after_sort)
+    return key
+
+def _insert_row(c, numbers, after_id=None):
+    c.execute('''
+        INSERT INTO draws (number1, number2, number3, number4, number5, number6, sort_order)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (*numbers, _key_after_id(c, after_id)))
+    return c.lastrowid
 
-    draw_number = "temp"
+def _update_row(c, draw_id, numbers):
     c.execute('''
-        INSERT INTO draws (draw_number, number1, number2, number3, number4, number5, number6, sort_order)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (draw_number, *numbers, new_sort_order))
+        UPDATE draws
+        SET number1=?, number2=?, number3=?, number4=?, number5=?, number6=?
+        WHERE id=?
+    ''', (*numbers, draw_id))
+
+def insert_draw(numbers, game_type='6_42', after_id=None):
+    numbers = clamp_numbers(numbers, game_type)
+    conn = get_db_connection(game_type)
+    c = conn.cursor()
+    # after_id=None or 0 both meant "append" for this function
+    draw_id = _insert_row(c, numbers, after_id or None)
+    bump_data_version(c)
     conn.commit()
     conn.close()
-
-    renumber_all(game_type)
+    return draw_id
 
 def delete_draw(draw_id, game_type='6_42'):
     conn = get_db_connection(game_type)
     conn.execute("DELETE FROM draws WHERE id = ?", (draw_id,))
+    bump_data_version(conn)
     conn.commit()
     conn.close()
-    renumber_all(game_type)
 
 def delete_draws(ids, game_type='6_42'):
     conn = get_db_connection(game_type)
     q_marks = ",".join("?" for _ in ids)
     sql = f"DELETE FROM draws WHERE id IN ({q_marks})"
     conn.execute(sql, ids)
+    bump_data_version(conn)
     conn.commit()
     conn.close()
-    renumber_all(game_type)
 
 def update_draw(draw_id, numbers, game_type='6_42'):
     numbers = clamp_numbers(numbers, game_type)
     conn = get_db_connection(game_type)
-    conn.execute('''
-        UPDATE draws
-        SET number1=?, number2=?, number3=?, number4=?, number5=?, number6=?
-        WHERE id=?
-    ''', (*numbers, draw_id))
+    _update_row(conn, draw_id, numbers)
+    bump_data_version(conn)
     conn.commit()
     conn.close()
 
+DRAW_OPS = ('update', 'insert', 'delete', 'move')
+
+def apply_draw_ops(ops, game_type='6_42'):
+    """
+    Apply an ordered list of grid edits in one transaction:
+
+        {"op": "update", "id": 12, "numbers": [...]}
+        {"op": "insert", "after_id": 12, "numbers": [...], "ref": "a"}
+        {"op": "delete", "id": 12}   (or "ids": [...])
+        {"op": "move", "id": 12, "after_id": 7}
+
+    after_id None appends, 0 puts the row first. An insert may name itself
+    with "ref"; later ops can then use that string wherever an id goes.
+    Numbers go through clamp_numbers. Returns one id per op (the new id for
+    inserts). Raises ValueError, with nothing written, on a malformed op.
+    """
+    conn = get_db_connection(game_type)
+    c = conn.cursor()
+    refs = {}
+    result_ids = []
+
+    def resolve(value, i):
+        if isinstance(value, str):
+            if value not in refs:
+                raise ValueError(f"op {i}: unknown ref {value!r}")
+            return refs[value]
+        if value is not None and not isinstance(value, int):
+            raise ValueError(f"op {i}: ids must be integers or refs")
+        return value
+
+    def numbers_of(op, i):
+        nums = op.get('numbers')
+        if not isinstance(nums, list) or len(nums) != 6 or not all(
+                n is None or isinstance(n, int) for n in nums):
+            raise ValueError(f"op {i}: numbers must be a list of 6 integers or nulls")
+        return clamp_numbers(nums, game_type)
+
+    try:
+        for i, op in enumerate(ops):
+            kind = op.get('op') if isinstance(op, dict) else None
+            if kind not in DRAW_OPS:
+                raise ValueError(f"op {i}: op must be one of {', '.join(DRAW_OPS)}")
+            if kind == 'insert':
+                numbers = numbers_of(op, i)
+                draw_id = _insert_row(c, numbers, resolve(op.get('after_id'), i))
+                if op.get('ref') is not None:
+                    if not isinstance(op['ref'], str):
+                        raise ValueError(f"op {i}: ref must be a string")
+                    refs[op['ref']] = draw_id
+                result_ids.append(draw_id)
+            elif kind == 'delete':
+                ids = op['ids'] if 'ids' in op else [op.get('id')]
+                if not isinstance(ids, list) or not ids:
+                    raise ValueError(f"op {i}: ids must be a non-empty list")
+                ids = [resolve(draw_id, i) for draw_id in ids]
+                if None in ids:
+                    raise ValueError(f"op {i}: id is required")
+                q_marks = ",".join("?" for _ in ids)
+                c.execute(f"DELETE FROM draws WHERE id IN ({q_marks})", ids)
+                result_ids.append(ids[0] if len(ids) == 1 else ids)
+            else:
+                draw_id = resolve(op.get('id'), i)
+                if draw_id is None:
+                    raise ValueError(f"op {i}: id is required")
+                if kind == 'update':
+                    numbers = numbers_of(op, i)
+                    _update_row(c, draw_id, numbers)
+                else:
+                    key = _key_after_id(c, resolve(op.get('after_id'), i))
+                    c.execute("UPDATE draws SET sort_order=? WHERE id=?", (key, draw_id))
+                result_ids.append(draw_id)
+
+        if ops:
+            bump_data_version(c)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return result_ids
+
+def draws_digest(game_type='6_42', limit=None):
+    """SHA-1 of the numbers of the first `limit` draws by sort_order."""
+    conn = get_db_connection(game_type)
+    rows = conn.execute(
+        "SELECT number1, number2, number3, number4, number5, number6 FROM draws "
+        "ORDER BY sort_order LIMIT ?",
+        (-1 if limit is None else limit,)
+    ).fetchall()
+    conn.close()
+    digest = hashlib.sha1()
+    for row in rows:
+        digest.update(repr(tuple(row)).encode())
+    return digest.hexdigest()
+
 def get_all_draws(game_type='6_42'):
     conn = get_db_connection(game_type)
-    rows = conn.execute("SELECT * FROM draws ORDER BY sort_order").fetchall()
+    rows = conn.execute(f"SELECT {draw_columns()} FROM draws ORDER BY sort_order").fetchall()
     conn.close()
     return rows
 
+def iter_draws(game_type='6_42', chunk_size=5000):
+    """
+    (total, chunks): the number of draws and a generator of lists of draw
+    rows by sort_order, read from one cursor. Both come from the same read
+    snapshot, so total always matches the rows. The connection is returned
+    once the generator is exhausted or closed.
+    """
+    conn = get_db_connection(game_type)
+    conn.execute("BEGIN")
+    total = conn.execute("SELECT COUNT(*) FROM draws").fetchone()[0]
+    cur = conn.execute(f"SELECT {draw_columns()} FROM draws ORDER BY sort_order")
+
+    def chunks():
+        try:
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            conn.close()
+    return total, chunks()
+
 def swap_sort_order(id1, id2, game_type='6_42'):
     conn = get_db_connection(game_type)
     c = conn.cursor()
     so1 = c.execute("SELECT sort_order FROM draws WHERE id=?", (id1,)).fetchone()["sort_order"]
     so2 = c.execute("SELECT sort_order FROM draws WHERE id=?", (id2,)).fetchone()["sort_order"]
-    c.execute("UPDATE draws SET sort_order=? WHERE id=?", (so2, id1))
-    c.execute("UPDATE draws SET sort_order=? WHERE id=?", (so1, id2))
+    _write_keys(c, [(so2, id1), (so1, id2)])
+    bump_data_version(c)
+    conn.commit()
+    conn.close()
+
+def _increasing_run(values):
+    """Indices of one longest strictly increasing subsequence of values."""
+    tails, tail_idx, prev = [], [], [-1] * len(values)
+    for i, v in enumerate(values):
+        pos = bisect.bisect_left(tails, v)
+        if pos == len(tails):
+            tails.append(v)
+            tail_idx.append(i)
+        else:
+            tails[pos] = v
+            tail_idx[pos] = i
+        prev[i] = tail_idx[pos - 1] if pos else -1
+    run = []
+    i = tail_idx[-1] if tail_idx else -1
+    while i != -1:
+        run.append(i)
+        i = prev[i]
+    return run[::-1]
+
+def _moved_keys(keys, staying):
+    """
+    New sort keys for a list of current keys in the wanted order, or None if
+    some gap is too small. Rows on a longest increasing run keep their key;
+    the others get keys spread over the gap after their predecessor, up to
+    the next key that stays: of a kept row, or of a row not in the list
+    (`staying` holds the keys of every draw outside the list, sorted).
+    """
+    kept = set(_increasing_run(keys))
+    staying = sorted(staying + [keys[i] for i in kept])
+    new_keys = list(keys)
+    i = 0
+    while i < len(keys):
+        if i in kept:
+            i += 1
+            continue
+        start = i
+        while i < len(keys) and i not in kept:
+            i += 1
+        count = i - start
+        if start > 0:
+            lo = new_keys[start - 1]
+            pos = bisect.bisect_right(staying, lo)
+            hi = staying[pos] if pos < len(staying) else lo + SORT_GAP * (count + 1)
+        else:
+            # Right before the first kept row (there is one: the run is never empty)
+            hi = keys[i]
+            pos = bisect.bisect_left(staying, hi)
+            lo = staying[pos - 1] if pos > 0 else hi - SORT_GAP * (count + 1)
+        if hi - lo <= count:
+            return None
+        for t in range(count):
+            new_keys[start + t] = lo + (hi - lo) * (t + 1) // (count + 1)
+    return new_keys
+
+def _full_order(new_order, current):
+    """
+    Every draw id: those of new_order in its order, each other draw right
+    after the draw that precedes it now.
+    """
+    listed = set(new_order)
+    following = {}
+    previous = None
+    for draw_id in sorted(current, key=lambda draw_id: (current[draw_id] is None,
+                                                        current[draw_id] or 0, draw_id)):
+        if draw_id in listed:
+            previous = draw_id
+        else:
+            following.setdefault(previous, []).append(draw_id)
+    order = list(following.get(None, []))
+    for draw_id in new_order:
+        order.append(draw_id)
+        order.extend(following.get(draw_id, []))
+    return order
+
+def reorder_draws(new_order, game_type='6_42'):
+    """
+    Put draws in the order of a list of ids. Only rows that actually moved
+    relative to each other get a new sort_order. Draws missing from the
+    list (added by someone else meanwhile) keep their key, and moved rows
+    never take a key between them and their neighbours.
+    """
+    conn = get_db_connection(game_type)
+    c = conn.cursor()
+    # The keys read here must still hold when the new ones are written
+    c.execute("BEGIN IMMEDIATE")
+    current = dict(c.execute("SELECT id, sort_order FROM draws").fetchall())
+    seen = set()
+    new_order = [id_val for id_val in new_order
+                 if id_val in current and not (id_val in seen or seen.add(id_val))]
+    listed = set(new_order)
+    staying = [key for draw_id, key in current.items()
+               if draw_id not in listed and key is not None]
+    keys = [current[id_val] for id_val in new_order]
+    new_keys = _moved_keys(keys, staying) if new_order else []
+    if new_keys is None:
+        # Too little room somewhere: renumber everything
+        respace_sort_order(c, _full_order(new_order, current))
+        bump_data_version(c)
+    else:
+        changed = [(key, id_val) for id_val, key, old in zip(new_order, new_keys, keys)
+                   if key != old]
+        if changed:
+            _write_keys(c, changed)
+            bump_data_version(c)
     conn.commit()
     conn.close()
-    renumber_all(game_type)
 
 def clamp_numbers(nums, game_type='6_42'):
     max_number = Config.GAMES[game_type]['max_number']
@@ -0,0 +1,107 @@
+# exports.py
+#
+# Streamed downloads. Every function here yields bytes chunk by chunk from a
+# database cursor, so an export never sits in memory as a whole. CSV is
+# written the way DataFrame.to_csv wrote it; .npy files (numpy.load) are a
+# compact format for programmatic consumers.
+import csv
+import io
+import zlib
+import numpy as np
+from config import Config
+from database import iter_draws
+from jobs import iter_result_rows, result_summary, RESULT_COLUMNS
+
+DRAW_CSV_HEADER = ['Draw', '#1', '#2', '#3', '#4', '#5', '#6']
+
+
+def csv_chunks(header, row_chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(header)
+    for rows in row_chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def npy_chunks(dtype, shape, array_chunks):
+    """An .npy file of the given shape, written from row blocks."""
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {
+        'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        'fortran_order': False,
+        'shape': shape,
+    })
+    yield header.getvalue()
+    for block in array_chunks:
+        yield np.ascontiguousarray(block, dtype=dtype).tobytes()
+
+
+def gzip_chunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def draws_csv(game_type):
+    _, chunks = iter_draws(game_type, Config.EXPORT_CHUNK_SIZE)
+    rows = ([row[1:8] for row in chunk] for chunk in chunks)
+    return csv_chunks(DRAW_CSV_HEADER, rows)
+
+
+def draws_npy(game_type):
+    """(draws, 6) uint8 array in draw order; empty cells are 0."""
+    total, chunks = iter_draws(game_type, Config.EXPORT_CHUNK_SIZE)
+    blocks = ([[n or 0 for n in row[2:8]] for row in chunk] for chunk in chunks)
+    return npy_chunks(np.uint8, (total, 6), blocks)
+
+
+def result_csv(job, kind):
+    rows = iter_result_rows(job, kind, Config.EXPORT_CHUNK_SIZE)
+    if kind == 'top':
+        return csv_chunks(RESULT_COLUMNS, rows)
+
+    def numbered():
+        number = 0
+        for chunk in rows:
+            yield [(number + i, *row) for i, row in enumerate(chunk, start=1)]
+            number += len(chunk)
+    return csv_chunks(['Number'] + RESULT_COLUMNS, numbered())
+
+
+def result_dtype(j):
+    return np.dtype([('combination', np.uint8, (j,)),
+                     ('avg_rank', np.float64),
+                     ('min_value', np.int64)])
+
+
+def combination_array(texts, j):
+    """(len(texts), j) uint8 array of combinations stored as '(1, 2, 3, ...)' text."""
+    text = ' '.join(texts).translate(str.maketrans('(),', '   '))
+    return np.array(text.split(), dtype=np.uint8).reshape(-1, j)
+
+
+def result_npy(job, kind):
+    """
+    Structured array of a result (combination, avg_rank, min_value), in
+    result order. Subset lists are left out; they are in the CSV.
+    """
+    j = job['params']['j']
+    dtype = result_dtype(j)
+    total = result_summary(job)[f'{kind}_count']
+
+    def blocks():
+        for chunk in iter_result_rows(job, kind, Config.EXPORT_CHUNK_SIZE):
+            block = np.zeros(len(chunk), dtype=dtype)
+            block['combination'] = combination_array([row[0] for row in chunk], j)
+            block['avg_rank'] = [row[1] for row in chunk]
+            block['min_value'] = [row[2] for row in chunk]
+            yield block
+    return npy_chunks(dtype, (total,), blocks())
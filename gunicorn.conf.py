@@ -0,0 +1,22 @@
+# gunicorn.conf.py
+#
+# Server settings for the web process (Procfile: gunicorn -c gunicorn.conf.py app:app).
+#
+# Some responses stay open as long as the work behind them: /analysis_sweep
+# streams a backtest while it runs and /analysis_events streams a job's
+# progress. Under the default sync worker such a request holds the worker's
+# only thread, so every other request waits behind it, and after `timeout`
+# seconds the arbiter kills the worker (WORKER TIMEOUT), cutting the stream
+# and taking the worker's JobManager pool with it. gthread workers serve
+# each request on its own thread while the main loop keeps checking in, so
+# `timeout` only fires for a worker that is really stuck.
+#
+#   WEB_CONCURRENCY   worker processes (default 1; each runs its own JobManager)
+#   GUNICORN_THREADS  request threads per worker (default 8), i.e. how many
+#                     streams and requests one worker serves at once
+import os
+
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = 120
@@ -1,5 +1,5 @@
 # init_database.py
-import pandas as pd
+import numpy as np
 import sqlite3
 import sys
 from config import Config
@@ -11,12 +11,15 @@ def init_db(game_type):
     c = conn.cursor()
 
     c.execute('DROP TABLE IF EXISTS draws')
+    c.execute('DROP TABLE IF EXISTS subset_index')
+    c.execute('DROP TABLE IF EXISTS subset_index_meta')
+    c.execute('DROP TABLE IF EXISTS dataset_meta')
 
     max_number = game_config['max_number']
     c.execute(f'''
         CREATE TABLE draws (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            draw_number TEXT,
+            draw_number TEXT,  -- unused, draw numbers are computed on read
             number1 INTEGER CHECK (number1 IS NULL OR (number1 >= 1 AND number1 <= {max_number})),
             number2 INTEGER CHECK (number2 IS NULL OR (number2 >= 1 AND number2 <= {max_number})),
             number3 INTEGER CHECK (number3 IS NULL OR (number3 >= 1 AND number3 <= {max_number})),
@@ -26,33 +29,99 @@ def init_db(game_type):
             sort_order INTEGER
         )
     ''')
+    c.execute('CREATE UNIQUE INDEX idx_draws_sort_order ON draws (sort_order)')
 
     conn.commit()
     return conn
 
-def load_csv_to_db(game_type):
-    try:
-        game_config = Config.GAMES[game_type]
-        df = pd.read_csv(game_config['csv_file'], header=None)
-        df = df.iloc[1:].reset_index(drop=True)
-        df['draw_number'] = df.index.map(lambda x: f'{x+1:04d}')
+def _validated_chunk(chunk, max_number, first_line):
+    """
+    Check one chunk of raw CSV values and return it as a row-sorted int array.
+    first_line is the 1-based CSV line of the chunk's first row, for errors.
+    """
+    import pandas as pd
+
+    for column in chunk.columns:
+        if not pd.api.types.is_numeric_dtype(chunk[column]):
+            chunk[column] = pd.to_numeric(chunk[column], errors='coerce')
+    values = chunk.to_numpy(dtype=float)
+    bad = ~np.isfinite(values).all(axis=1)
+    bad |= (values != np.round(values)).any(axis=1)
+    bad |= ((values < 1) | (values > max_number)).any(axis=1)
+    numbers = np.sort(np.nan_to_num(values).astype(np.int64), axis=1)
+    bad |= (np.diff(numbers, axis=1) == 0).any(axis=1)
+    if bad.any():
+        line = first_line + int(np.flatnonzero(bad)[0])
+        raise ValueError(
+            f"line {line}: expected 6 distinct whole numbers between 1 and {max_number}"
+        )
+    return numbers
+
+def import_draws(game_type, source, mode='replace', has_header=True, chunksize=None):
+    """
+    Bulk-load draws from a CSV (path or file object, six numbers per row).
+
+    mode='replace' swaps out the whole history, mode='append' adds the rows
+    after the current last draw. The CSV is read in chunks, each chunk is
+    validated and sorted with NumPy, and everything is written with
+    executemany inside one transaction, with gapped sort_order keys set on
+    insert. Nothing is written if any row is invalid.
+    Returns the number of imported draws.
+    """
+    import pandas as pd
+    from database import get_db_connection, bump_data_version, SORT_GAP
 
-        conn = init_db(game_type)
-        cursor = conn.cursor()
+    if mode not in ('replace', 'append'):
+        raise ValueError(f"Unknown import mode: {mode}")
+    game_config = Config.GAMES[game_type]
+    max_number = game_config['max_number']
+    chunksize = chunksize or Config.IMPORT_CHUNK_SIZE
+
+    conn = get_db_connection(game_type)
+    try:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        if mode == 'replace':
+            c.execute("DELETE FROM draws")
+            last_sort = 0
+        else:
+            last_sort = c.execute("SELECT COALESCE(MAX(sort_order), 0) FROM draws").fetchone()[0]
 
-        for index, row in df.iterrows():
-            numbers = sorted(row.iloc[:6].astype(int).tolist())
-            draw_number = row['draw_number']
-            cursor.execute('''
-                INSERT INTO draws (draw_number, number1, number2, number3, number4, number5, number6)
+        reader = pd.read_csv(source, header=None, skiprows=1 if has_header else 0,
+                             usecols=range(6), chunksize=chunksize,
+                             skip_blank_lines=True)
+        imported = 0
+        first_line = 2 if has_header else 1
+        for chunk in reader:
+            numbers = _validated_chunk(chunk, max_number, first_line)
+            first_line += len(chunk)
+            count = len(numbers)
+            rows = zip(
+                *numbers.T.tolist(),
+                range(last_sort + SORT_GAP, last_sort + (count + 1) * SORT_GAP, SORT_GAP),
+            )
+            c.executemany('''
+                INSERT INTO draws (number1, number2, number3, number4, number5, number6, sort_order)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (draw_number, *numbers))
+            ''', rows)
+            last_sort += count * SORT_GAP
+            imported += count
 
-        cursor.execute("UPDATE draws SET sort_order = id")
+        bump_data_version(c)
         conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
         conn.close()
+    return imported
 
-        print(f"Successfully loaded {len(df)} draws into {game_config['db_name']}")
+def load_csv_to_db(game_type):
+    try:
+        game_config = Config.GAMES[game_type]
+        init_db(game_type).close()
+        count = import_draws(game_type, game_config['csv_file'], mode='replace')
+        print(f"Successfully loaded {count} draws into {game_config['db_name']}")
         return True
     except Exception as e:
         print(f"Error: {str(e)}")
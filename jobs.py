@@ -0,0 +1,642 @@
+# jobs.py
+#
+# Analysis jobs live in a shared SQLite store (Config.JOB_DB), so every
+# gunicorn worker can report progress and serve results for any job.
+# Each web worker runs a JobManager: a dispatcher thread that claims queued
+# jobs from the store and runs them in a local process pool. Jobs are owned
+# by a session; one owner's jobs never cancel another owner's.
+import cProfile
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from config import Config
+import metrics
+from result_cache import result_cache, cache_key
+
+RESULT_COLUMNS = ['Combination', 'Average Rank', 'MinValue', 'Subsets']
+# Columns result_page can sort by, besides the result order (position)
+RESULT_SORTS = ('avg_rank', 'min_value')
+
+
+def number_mask(combination):
+    """Bit v set for every number v of a '(1, 2, 3, ...)' combination."""
+    mask = 0
+    for number in combination.strip('()').split(','):
+        if number.strip():
+            mask |= 1 << int(number)
+    return mask
+
+
+class QueueFull(Exception):
+    pass
+
+
+_schema_ready = False
+
+
+def get_job_db():
+    global _schema_ready
+    conn = sqlite3.connect(Config.JOB_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    if not _schema_ready:
+        init_job_db(conn)
+        _schema_ready = True
+    return conn
+
+
+def init_job_db(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            owner TEXT,
+            game_type TEXT,
+            kind TEXT,
+            params TEXT,
+            cache_key TEXT,
+            status TEXT,
+            processed INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            elapsed INTEGER,
+            error TEXT,
+            cancel_requested INTEGER DEFAULT 0,
+            result_of TEXT,
+            result_meta TEXT,
+            worker TEXT,
+            created REAL,
+            updated REAL,
+            phase TEXT,
+            rate REAL,
+            started REAL
+        )
+    ''')
+    # Columns added after the first release of the store
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+    for column, decl in (('phase', 'TEXT'), ('rate', 'REAL'), ('started', 'REAL')):
+        if column not in existing:
+            conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {decl}")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, created)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_cache_key ON jobs (cache_key, status)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS job_results (
+            job_id TEXT,
+            kind TEXT,
+            position INTEGER,
+            combination TEXT,
+            avg_rank REAL,
+            min_value INTEGER,
+            subsets TEXT,
+            numbers INTEGER,
+            PRIMARY KEY (job_id, kind, position)
+        )
+    ''')
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(job_results)")}
+    if 'numbers' not in existing:
+        conn.execute("ALTER TABLE job_results ADD COLUMN numbers INTEGER")
+        conn.executemany(
+            "UPDATE job_results SET numbers=? WHERE rowid=?",
+            [(number_mask(row[1]), row[0])
+             for row in conn.execute("SELECT rowid, combination FROM job_results")]
+        )
+    # Keyset paging by score (result_page); numbers makes them covering
+    for column in RESULT_SORTS:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS job_results_{column} ON job_results "
+                     f"(job_id, kind, {column} DESC, position, numbers)")
+    conn.commit()
+
+
+def submit_job(owner, game_type, params, kind='run', previous_job_id=None):
+    """
+    Queue an analysis and return its job id. params are run_analysis keyword
+    arguments (j, k, m, l, n, last_offset, and for an anytime run
+    budget_seconds / budget_combos). kind='update' patches the result of
+    previous_job_id with analysis.update_analysis. params['profile'] = True
+    runs the job under cProfile (see profile_path), even if a cached
+    result exists.
+
+    A finished job with the same parameters and dataset version is reused
+    without running anything. Raises QueueFull when Config.JOB_QUEUE_SIZE
+    jobs are already waiting. Anytime results depend on when the budget ran
+    out, so they are never reused, but an anytime run can reuse an exact one.
+    """
+    from database import get_data_version
+
+    key = cache_key(game_type, params['j'], params['k'], params['m'], params['l'],
+                    params['n'], params['last_offset'], get_data_version(game_type))
+    budgeted = params.get('budget_seconds') is not None or params.get('budget_combos') is not None
+    profiled = bool(params.get('profile'))
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    stored = dict(params, previous_job_id=previous_job_id)
+    conn = get_job_db()
+    try:
+        cached = None
+        if not profiled and _done_job(conn, key) is None:
+            # May unpickle from disk, so it is looked up before taking the lock
+            cached = result_cache.get(key)
+        conn.execute("BEGIN IMMEDIATE")
+        hit = None if profiled else _done_job(conn, key)
+        if hit:
+            conn.execute(
+                "INSERT INTO jobs (id, owner, game_type, kind, params, cache_key, status, "
+                "elapsed, result_of, created, updated) VALUES (?, ?, ?, ?, ?, ?, 'done', ?, ?, ?, ?)",
+                (job_id, owner, game_type, kind, json.dumps(stored), key,
+                 hit['elapsed'], hit['result_of'] or hit['id'], now, now)
+            )
+            conn.commit()
+            return job_id
+
+        queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status='queued'").fetchone()[0]
+        if cached is None and queued >= Config.JOB_QUEUE_SIZE:
+            conn.rollback()
+            raise QueueFull(f"{queued} analyses are already waiting")
+        conn.execute(
+            "INSERT INTO jobs (id, owner, game_type, kind, params, cache_key, status, "
+            "created, updated) VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+            (job_id, owner, game_type, kind, json.dumps(stored), None if budgeted else key,
+             now, now)
+        )
+        if cached is not None:
+            store_result(conn, job_id, *cached)
+        conn.commit()
+    finally:
+        conn.close()
+    return job_id
+
+
+def _done_job(conn, key):
+    """The newest finished job with this cache key (id, result_of, elapsed), or None."""
+    return conn.execute(
+        "SELECT id, result_of, elapsed FROM jobs WHERE cache_key=? AND status='done' "
+        "ORDER BY updated DESC LIMIT 1",
+        (key,)
+    ).fetchone()
+
+
+def cancel_job(job_id):
+    conn = get_job_db()
+    conn.execute(
+        "UPDATE jobs SET cancel_requested=1, updated=? WHERE id=? AND status='running'",
+        (time.time(), job_id)
+    )
+    conn.execute(
+        "UPDATE jobs SET status='cancelled', updated=? WHERE id=? AND status='queued'",
+        (time.time(), job_id)
+    )
+    conn.commit()
+    conn.close()
+
+
+def cancel_owner_jobs(owner):
+    """Cancel every queued or running job of one owner (and nobody else's)."""
+    conn = get_job_db()
+    ids = [row['id'] for row in conn.execute(
+        "SELECT id FROM jobs WHERE owner=? AND status IN ('queued', 'running')", (owner,)
+    )]
+    conn.close()
+    for job_id in ids:
+        cancel_job(job_id)
+
+
+def get_job(job_id):
+    """Job record as a dict; result_meta is taken from the job holding the rows."""
+    if not job_id:
+        return None
+    conn = get_job_db()
+    row = conn.execute(
+        "SELECT j.*, COALESCE(j.result_meta, s.result_meta) AS resolved_meta FROM jobs j "
+        "LEFT JOIN jobs s ON s.id = j.result_of WHERE j.id=?",
+        (job_id,)
+    ).fetchone()
+    conn.close()
+    if row is None:
+        return None
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+    meta = job.pop('resolved_meta')
+    job['result_meta'] = json.loads(meta) if meta else None
+    return job
+
+
+def store_result(conn, job_id, selected_df, top_df, elapsed):
+    """Write a result into the store and mark the job done (caller commits)."""
+    rows = []
+    for kind, df in (('top', top_df), ('selected', selected_df)):
+        if df is None or df.empty:
+            continue
+        for position, rec in enumerate(df[RESULT_COLUMNS].itertuples(index=False)):
+            rows.append((job_id, kind, position, rec[0], float(rec[1]), int(rec[2]), rec[3],
+                         number_mask(rec[0])))
+    conn.execute("DELETE FROM job_results WHERE job_id=?", (job_id,))
+    conn.executemany(
+        "INSERT INTO job_results (job_id, kind, position, combination, avg_rank, "
+        "min_value, subsets, numbers) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    meta = dict(top_df.attrs) if top_df is not None else {}
+    meta['has_selected'] = selected_df is not None
+    meta['top_count'] = 0 if top_df is None else len(top_df)
+    meta['selected_count'] = 0 if selected_df is None else len(selected_df)
+    conn.execute(
+        "UPDATE jobs SET status='done', elapsed=?, result_meta=?, updated=? WHERE id=?",
+        (elapsed, json.dumps(meta), time.time(), job_id)
+    )
+
+
+def load_result(job_id):
+    """(selected_df, top_df, elapsed) of a finished job, or None."""
+    import pandas as pd
+
+    job = get_job(job_id)
+    if job is None or job['status'] != 'done':
+        return None
+    source_id = job['result_of'] or job['id']
+    meta = job['result_meta'] or {}
+    conn = get_job_db()
+    frames = {}
+    for kind in ('top', 'selected'):
+        rows = conn.execute(
+            "SELECT combination, avg_rank, min_value, subsets FROM job_results "
+            "WHERE job_id=? AND kind=? ORDER BY position",
+            (source_id, kind)
+        ).fetchall()
+        frames[kind] = pd.DataFrame([tuple(r) for r in rows], columns=RESULT_COLUMNS)
+    conn.close()
+
+    top_df = frames['top']
+    top_df.attrs.update({k: v for k, v in meta.items() if k != 'has_selected'})
+    selected_df = None
+    if meta.get('has_selected'):
+        selected_df = frames['selected']
+        selected_df.insert(0, 'Number', range(1, len(selected_df) + 1))
+    return selected_df, top_df, job['elapsed']
+
+
+def iter_result_rows(job, kind, chunk_size=5000):
+    """
+    Lists of (combination, avg_rank, min_value, subsets) rows of a finished
+    job's 'top' or 'selected' result, in order, read in chunks.
+    """
+    conn = get_job_db()
+    try:
+        cur = conn.execute(
+            "SELECT combination, avg_rank, min_value, subsets FROM job_results "
+            "WHERE job_id=? AND kind=? ORDER BY position",
+            (job['result_of'] or job['id'], kind)
+        )
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
+def result_page(job, kind, sort='position', descending=True, contains=(), limit=50,
+                cursor=None):
+    """
+    One page of a finished job's 'top' or 'selected' result, read by keyset
+    from the indexed store:
+
+        {'rows': [{'number', 'combination', 'avg_rank', 'min_value',
+                   'subsets'}, ...], 'next_cursor': str or None}
+
+    sort is 'position' (the result order; number is position + 1) or one of
+    RESULT_SORTS, best first with ties in result order. descending=False
+    reverses the order. contains keeps the rows holding all of the given
+    numbers. For the next page pass next_cursor back as cursor, with the
+    same sort, order and filter.
+
+    At most Config.RESULT_SCAN_LIMIT index entries are read per call, so a
+    page costs the same however large the result is; with a selective
+    filter a page can come back short (even empty) but with a next_cursor.
+    Raises ValueError on an unknown sort or a malformed cursor.
+    """
+    if sort != 'position' and sort not in RESULT_SORTS:
+        raise ValueError(f"Unknown sort: {sort}")
+    mask = 0
+    for number in contains:
+        mask |= 1 << number
+    source_id = job['result_of'] or job['id']
+    params = [source_id, kind]
+    after = ''
+    if cursor:
+        try:
+            value, position = cursor.rsplit(':', 1)
+            value = float(value) if sort == 'avg_rank' else int(value)
+            position = int(position)
+        except ValueError:
+            raise ValueError("Invalid cursor") from None
+        # Continue after (value, position) in the direction of the scan
+        later = '>' if descending else '<'
+        if sort == 'position':
+            after = f"AND position {later} ?"
+            params.append(position)
+        else:
+            op = '<' if descending else '>'
+            after = f"AND {sort} {op}= ? AND ({sort} {op} ? OR position {later} ?)"
+            params += [value, value, position]
+    if sort == 'position':
+        order = 'position' if descending else 'position DESC'
+    else:
+        order = f"{sort} DESC, position" if descending else f"{sort}, position DESC"
+
+    conn = get_job_db()
+    try:
+        keys = conn.execute(
+            f"SELECT {sort}, position, numbers FROM job_results "
+            f"WHERE job_id=? AND kind=? {after} ORDER BY {order} LIMIT ?",
+            params + [Config.RESULT_SCAN_LIMIT]
+        )
+        hits, last, scanned = [], None, 0
+        for value, position, numbers in keys:
+            scanned += 1
+            if numbers & mask == mask:
+                if len(hits) == limit:
+                    break
+                hits.append(position)
+            last = (value, position)
+        else:
+            if scanned < Config.RESULT_SCAN_LIMIT:
+                last = None  # scanned to the end
+        rows = {}
+        if hits:
+            q_marks = ",".join("?" for _ in hits)
+            for row in conn.execute(
+                    "SELECT position, combination, avg_rank, min_value, subsets "
+                    f"FROM job_results WHERE job_id=? AND kind=? AND position IN ({q_marks})",
+                    [source_id, kind] + hits):
+                rows[row['position']] = dict(
+                    number=row['position'] + 1, combination=row['combination'],
+                    avg_rank=row['avg_rank'], min_value=row['min_value'],
+                    subsets=row['subsets'])
+    finally:
+        conn.close()
+    return {'rows': [rows[position] for position in hits],
+            'next_cursor': None if last is None else f"{last[0]!r}:{last[1]}"}
+
+
+def result_summary(job):
+    """Row counts and best scores of a finished job's result."""
+    conn = get_job_db()
+    rows = conn.execute(
+        "SELECT kind, COUNT(*) AS cnt, MAX(avg_rank) AS best_avg, MAX(min_value) AS best_min "
+        "FROM job_results WHERE job_id=? GROUP BY kind",
+        (job['result_of'] or job['id'],)
+    ).fetchall()
+    conn.close()
+    summary = {'top_count': 0, 'selected_count': 0,
+               'best_average_rank': None, 'best_min_value': None}
+    for row in rows:
+        summary[f"{row['kind']}_count"] = row['cnt']
+        if row['kind'] == 'top':
+            summary['best_average_rank'] = row['best_avg']
+            summary['best_min_value'] = row['best_min']
+    return summary
+
+
+def _update_job(conn, job_id, **fields):
+    fields['updated'] = time.time()
+    assignments = ", ".join(f"{name}=?" for name in fields)
+    conn.execute(f"UPDATE jobs SET {assignments} WHERE id=?", (*fields.values(), job_id))
+    conn.commit()
+
+
+def _heartbeat(job_id, stop):
+    """
+    Touch a running job's updated time until stop is set, so expire_jobs
+    sees a live process through phases that report no progress (select,
+    build). Runs on a thread of the pool process, with its own connection.
+    """
+    conn = get_job_db()
+    try:
+        while not stop.wait(Config.JOB_STALE_SECONDS / 4):
+            try:
+                conn.execute("UPDATE jobs SET updated=? WHERE id=? AND status='running'",
+                             (time.time(), job_id))
+                conn.commit()
+            except sqlite3.OperationalError:
+                pass  # busy: the next beat comes well before the job goes stale
+    finally:
+        conn.close()
+
+
+def profile_path(job_id):
+    """Where the cProfile stats of a profiled job are written (pstats format)."""
+    return os.path.join(Config.PROFILE_DIR, f"{job_id}.prof")
+
+
+def execute_job(job_id):
+    """
+    Run one claimed job; called in a pool process. Returns the engine and
+    run statistics (top_df.attrs['stats']) of a finished run, for the
+    dispatching process's metrics, or None.
+    """
+    from analysis import run_analysis, update_analysis
+
+    job = get_job(job_id)
+    if job is None or job['status'] != 'running':
+        return
+    conn = get_job_db()
+    interval = Config.PROGRESS_INTERVAL
+    last_write = 0.0
+    last_check = 0.0
+    cancelled = False
+    phase_started = time.time()
+
+    def phase_callback(name):
+        nonlocal phase_started
+        phase_started = time.time()
+        _update_job(conn, job_id, phase=name)
+
+    def progress_callback(processed, total):
+        nonlocal last_write
+        now = time.time()
+        if now - last_write >= interval or processed >= total:
+            last_write = now
+            rate = processed / max(now - phase_started, 1e-6)
+            _update_job(conn, job_id, processed=processed, total=total, rate=rate)
+
+    def should_stop():
+        nonlocal last_check, cancelled
+        now = time.time()
+        if not cancelled and now - last_check >= interval:
+            last_check = now
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE id=?",
+                               (job_id,)).fetchone()
+            cancelled = bool(row and row['cancel_requested'])
+        return cancelled
+
+    params = dict(job['params'])
+    previous_job_id = params.pop('previous_job_id', None)
+    profiler = cProfile.Profile() if params.pop('profile', False) else None
+    stop_heartbeat = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job_id, stop_heartbeat), daemon=True).start()
+    try:
+        if profiler:
+            profiler.enable()
+        if job['kind'] == 'update':
+            previous = load_result(previous_job_id)
+            if previous is None:
+                raise ValueError("previous analysis result is no longer available")
+            sel_df, top_df, elapsed = update_analysis(
+                previous[1], game_type=job['game_type'], **params,
+                progress_callback=progress_callback, should_stop=should_stop,
+                phase_callback=phase_callback)
+        else:
+            sel_df, top_df, elapsed = run_analysis(
+                game_type=job['game_type'], **params,
+                progress_callback=progress_callback, should_stop=should_stop,
+                phase_callback=phase_callback)
+    except Exception as e:
+        _update_job(conn, job_id, status='failed', error=str(e))
+        conn.close()
+        return None
+    finally:
+        stop_heartbeat.set()
+        if profiler:
+            profiler.disable()
+            os.makedirs(Config.PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(profile_path(job_id))
+
+    if top_df is None:
+        _update_job(conn, job_id, status='cancelled' if should_stop() else 'failed',
+                    error=None if should_stop() else "no draws to analyse")
+    else:
+        conn.execute("BEGIN IMMEDIATE")
+        store_result(conn, job_id, sel_df, top_df, elapsed)
+        conn.commit()
+        if job['cache_key']:
+            # For web processes (submit_job) once the job has expired; this
+            # pool process never looks it up, so it keeps no copy in memory
+            result_cache.put(job['cache_key'], (sel_df, top_df, elapsed), memory=False)
+    conn.close()
+    if top_df is None or 'stats' not in top_df.attrs:
+        return None
+    return dict(engine=top_df.attrs.get('engine'), stats=top_df.attrs['stats'])
+
+
+def claim_next_job(worker_id):
+    """Atomically move the oldest queued job to 'running'; returns its id or None."""
+    conn = get_job_db()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT id FROM jobs WHERE status='queued' ORDER BY created LIMIT 1"
+        ).fetchone()
+        if row is None:
+            conn.rollback()
+            return None
+        now = time.time()
+        conn.execute(
+            "UPDATE jobs SET status='running', worker=?, started=?, updated=? WHERE id=?",
+            (worker_id, now, now, row['id'])
+        )
+        conn.commit()
+        return row['id']
+    finally:
+        conn.close()
+
+
+def expire_jobs():
+    """
+    Fail running jobs whose process stopped its heartbeat (see _heartbeat),
+    and drop old results. The newest Config.RESULT_CACHE_SIZE results with a
+    cache key are kept whatever their age, so submit_job can still reuse
+    them by key; a reuse only points at the stored rows (result_of), and the
+    frames are loaded when a request asks for them (load_result).
+    """
+    now = time.time()
+    conn = get_job_db()
+    conn.execute(
+        "UPDATE jobs SET status='failed', error='worker stopped responding', updated=? "
+        "WHERE status='running' AND updated < ?",
+        (now, now - Config.JOB_STALE_SECONDS)
+    )
+    conn.execute(
+        "DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND updated < ? "
+        "AND id NOT IN (SELECT result_of FROM jobs WHERE result_of IS NOT NULL) "
+        "AND id NOT IN (SELECT id FROM jobs WHERE status='done' AND cache_key IS NOT NULL "
+        "AND result_of IS NULL ORDER BY updated DESC LIMIT ?)",
+        (now - Config.JOB_RETENTION_SECONDS, max(Config.RESULT_CACHE_SIZE, 0))
+    )
+    conn.execute("DELETE FROM job_results WHERE job_id NOT IN (SELECT id FROM jobs)")
+    conn.commit()
+    conn.close()
+
+
+class JobManager:
+    """
+    Per-process dispatcher: claims queued jobs from the shared store while
+    fewer than Config.JOB_WORKERS of its own jobs are running.
+    """
+
+    def __init__(self):
+        self.worker_id = f"{os.uname().nodename}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._running = set()
+        self._pool = None
+        self._thread = None
+
+    def ensure_started(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._dispatch, daemon=True)
+            self._thread.start()
+
+    def _dispatch(self):
+        last_expire = 0.0
+        while True:
+            try:
+                if time.time() - last_expire >= Config.JOB_STALE_SECONDS / 4:
+                    last_expire = time.time()
+                    expire_jobs()
+                while len(self._running) < Config.JOB_WORKERS:
+                    job_id = claim_next_job(self.worker_id)
+                    if job_id is None:
+                        break
+                    self._submit(job_id)
+            except sqlite3.OperationalError:
+                pass
+            time.sleep(Config.JOB_POLL_INTERVAL)
+
+    def _submit(self, job_id):
+        with self._lock:
+            self._running.add(job_id)
+            if self._pool is None:
+                ctx = multiprocessing.get_context('spawn')
+                self._pool = ProcessPoolExecutor(max_workers=Config.JOB_WORKERS,
+                                                 mp_context=ctx)
+            pool = self._pool
+        future = pool.submit(execute_job, job_id)
+        future.add_done_callback(lambda f, job_id=job_id: self._finished(job_id, f))
+
+    def _finished(self, job_id, future):
+        with self._lock:
+            self._running.discard(job_id)
+            if isinstance(future.exception(), BrokenProcessPool):
+                # A pool process died; start a fresh pool for the next job
+                self._pool = None
+        if future.exception() is None:
+            if future.result():
+                metrics.record_analysis(**future.result())
+        else:
+            conn = get_job_db()
+            conn.execute(
+                "UPDATE jobs SET status='failed', error=?, updated=? "
+                "WHERE id=? AND status='running'",
+                (str(future.exception()), time.time(), job_id)
+            )
+            conn.commit()
+            conn.close()
+
+
+job_manager = JobManager()
@@ -0,0 +1,499 @@
+# loadtest.py
+#
+# Concurrent load against the web app: grid edits, grid paging and
+# analysis progress polling, mixed the way production traffic mixes them.
+#
+#   python loadtest.py [--target client|gunicorn] [--concurrency 8]
+#                      [--duration 30] [--mix update=30,move=5,...]
+#                      [--game 6_42] [--analysis j=6,k=3,m=min,l=1000,n=5]
+#                      [--gunicorn-workers 2] [--output FILE]
+#
+# The app runs against copies of the draws databases in a temporary
+# directory (the harness and the app both work from there), so the real
+# databases are never touched. --target client drives the app in this
+# process through Flask's test client, one per simulated user thread;
+# --target gunicorn starts gunicorn on a local port and goes through HTTP.
+#
+# Simulated users pick operations at random by the mix weights:
+#   update  /update_combo_hot    new numbers for a random draw
+#   add     /add_combo_hot       empty draw after a random draw
+#   delete  /delete_combos_hot   a random draw
+#   move    /move_row_hot        the user's view of the grid, one row moved
+#   page    /combos_data         next page (cursor), or a random offset page
+#   poll    /analysis_progress   the running analysis; a finished one is
+#                                submitted again, so an analysis always runs
+# The report gives p50/p95/p99 latency, throughput and errors per route,
+# the number of "database is locked" failures, and integrity checks run
+# once the load stops: sort_order keys, draw numbers and ids as paged by
+# /combos_data, and the draw snapshot and its subset ranks against the draws.
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+import numpy as np
+from config import Config
+
+ROUTES = dict(update='/update_combo_hot', add='/add_combo_hot', delete='/delete_combos_hot',
+              move='/move_row_hot', page='/combos_data', poll='/analysis_progress')
+DEFAULT_MIX = 'update=30,add=5,delete=5,move=5,page=35,poll=20'
+DEFAULT_ANALYSIS = 'j=6,k=3,m=min,l=1000,n=5'
+
+PAGE_SIZE = 100
+LOCKED = 'database is locked'
+# Seconds to wait for gunicorn to answer
+STARTUP_TIMEOUT = 30
+
+
+def parse_pairs(text, cast):
+    pairs = {}
+    for item in text.split(','):
+        if item.strip():
+            name, _, value = item.partition('=')
+            pairs[name.strip()] = cast(value)
+    return pairs
+
+
+def percentile_ms(latencies, q):
+    return round(float(np.percentile(latencies, q)) * 1000, 2) if latencies else None
+
+
+def copy_database(source, target):
+    # The backup API also copies pages still in the WAL
+    src, dst = sqlite3.connect(source), sqlite3.connect(target)
+    src.backup(dst)
+    src.close()
+    dst.close()
+
+
+def session_cookie(headers):
+    """'name=value' of the session cookie set by a response, or None."""
+    header = headers.get('Set-Cookie')
+    if not header:
+        return None
+    cookie = SimpleCookie()
+    cookie.load(header)
+    for name, morsel in cookie.items():
+        return f"{name}={morsel.value}"
+    return None
+
+
+class AppClient:
+    """Requests through the Flask test client, in this process."""
+
+    def __init__(self, app):
+        self.client = app.test_client(use_cookies=False)
+
+    def request(self, method, path, params=None, data=None, cookie=None):
+        response = self.client.open(path, method=method, query_string=params, data=data,
+                                    headers={'Cookie': cookie} if cookie else {})
+        return response.status_code, response.get_data(), response.headers
+
+
+class HttpClient:
+    """Requests over HTTP to a running server."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def request(self, method, path, params=None, data=None, cookie=None):
+        url = self.base_url + path
+        if params:
+            url += '?' + urlencode(params, doseq=True)
+        body = None if data is None else urlencode(data, doseq=True).encode()
+        req = urllib.request.Request(url, data=body, method=method,
+                                     headers={'Cookie': cookie} if cookie else {})
+        try:
+            with urllib.request.urlopen(req, timeout=120) as response:
+                return response.status, response.read(), response.headers
+        except urllib.error.HTTPError as e:
+            return e.code, e.read(), e.headers
+
+
+def open_session(client, game):
+    """Session cookie of a new user who picked the game, as the UI does."""
+    # The status does not matter: the session is set before the page renders
+    _, _, headers = client.request('GET', f'/select_game/{game}')
+    cookie = session_cookie(headers)
+    if cookie is None:
+        raise RuntimeError(f"/select_game/{game} did not start a session")
+    return cookie
+
+
+class Grid:
+    """The draw ids in grid order, as the simulated users last saw them."""
+
+    def __init__(self, ids):
+        self.ids = list(ids)
+        self.lock = threading.Lock()
+
+    def pick(self, rng):
+        with self.lock:
+            return rng.choice(self.ids) if self.ids else None
+
+    def remove(self, draw_id):
+        with self.lock:
+            if draw_id in self.ids:
+                self.ids.remove(draw_id)
+
+    def moved(self, rng):
+        """The grid order with one random row moved, which becomes the view."""
+        with self.lock:
+            if len(self.ids) < 2:
+                return None
+            row = self.ids.pop(rng.randrange(len(self.ids)))
+            self.ids.insert(rng.randrange(len(self.ids) + 1), row)
+            return list(self.ids)
+
+
+class Analysis:
+    """The analysis the poll operations watch, resubmitted whenever it finishes."""
+
+    def __init__(self, client, params, cookie):
+        self.client = client
+        self.params = params
+        self.cookie = cookie
+        self.job_id = None
+        self.submitted = 0
+        self.finished = 0
+        self.lock = threading.Lock()
+
+    def submit(self):
+        status, body, headers = self.client.request('POST', '/analysis_run', data=self.params,
+                                                    cookie=self.cookie)
+        if status != 200:
+            raise RuntimeError(f"/analysis_run answered {status}: {body[:200]!r}")
+        self.job_id = json.loads(body)['job_id']
+        self.submitted += 1
+
+    def poll(self, client):
+        status, body, headers = client.request('GET', ROUTES['poll'],
+                                               params={'job_id': self.job_id},
+                                               cookie=self.cookie)
+        if status == 200:
+            progress = json.loads(body)
+            if not progress.get('in_progress'):
+                with self.lock:
+                    if progress.get('job_id') == self.job_id:
+                        self.finished += progress.get('done', False)
+                        self.submit()
+        return status, body
+
+    def cancel(self, timeout=60):
+        """Cancel the analysis and wait until its job has stopped."""
+        if not self.job_id:
+            return
+        self.client.request('POST', '/analysis_cancel', data={'job_id': self.job_id},
+                            cookie=self.cookie)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            status, body, _ = self.client.request('GET', ROUTES['poll'],
+                                                  params={'job_id': self.job_id},
+                                                  cookie=self.cookie)
+            if status == 200 and not json.loads(body).get('in_progress'):
+                return
+            time.sleep(0.2)
+
+
+def run_user(client, cookie, grid, analysis, game, mix, deadline, think, seed, record):
+    rng = random.Random(seed)
+    max_number = Config.GAMES[game]['max_number']
+    ops, weights = list(mix), list(mix.values())
+    cursor = None
+    while time.perf_counter() < deadline:
+        op = rng.choices(ops, weights)[0]
+        started = time.perf_counter()
+        status, body = None, b''
+        try:
+            if op == 'poll':
+                status, body = analysis.poll(client)
+            elif op == 'page':
+                params = {'limit': PAGE_SIZE}
+                if cursor and rng.random() < 0.8:
+                    params['cursor'] = cursor
+                else:
+                    params['offset'] = rng.randrange(max(1, len(grid.ids)))
+                status, body, headers = client.request('GET', ROUTES['page'], params=params,
+                                                       cookie=cookie)
+                cursor = headers.get('X-Next-Cursor')
+            else:
+                data = {}
+                if op == 'move':
+                    order = grid.moved(rng)
+                    data['new_order[]'] = order or []
+                else:
+                    draw_id = grid.pick(rng)
+                    if op == 'update':
+                        numbers = sorted(rng.sample(range(1, max_number + 1), 6))
+                        data = dict(id=draw_id, **{f'num{i}': n for i, n in enumerate(numbers, 1)})
+                    elif op == 'add':
+                        data['after_id'] = draw_id
+                    else:
+                        data['ids[]'] = [draw_id]
+                        grid.remove(draw_id)
+                status, body, _ = client.request('POST', ROUTES[op], data=data, cookie=cookie)
+        except Exception as e:
+            body = repr(e).encode()
+        record(op, time.perf_counter() - started, status, body)
+        if think:
+            time.sleep(rng.uniform(0, 2 * think))
+
+
+class Recorder:
+    def __init__(self, ops):
+        self.latencies = {op: [] for op in ops}
+        self.statuses = {op: {} for op in ops}
+        self.locked = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, op, seconds, status, body):
+        with self.lock:
+            self.latencies[op].append(seconds)
+            key = str(status) if status is not None else 'exception'
+            self.statuses[op][key] = self.statuses[op].get(key, 0) + 1
+            if LOCKED.encode() in body:
+                self.locked += 1
+
+    def count_locked(self, sender, exception, **extra):
+        # got_request_exception: the 500 body does not say why
+        if LOCKED in str(exception):
+            with self.lock:
+                self.locked += 1
+
+
+def check_integrity(client, cookie, game):
+    """Checks of the data after the load, as {name: (ok, detail)}."""
+    import scoring
+    import snapshot
+
+    checks = {}
+    conn = sqlite3.connect(Config.GAMES[game]['db_name'])
+    rows = conn.execute(
+        "SELECT id, sort_order, number1, number2, number3, number4, number5, number6 "
+        "FROM draws ORDER BY sort_order, id").fetchall()
+    conn.close()
+    keys = [row[1] for row in rows]
+    missing = sum(key is None for key in keys)
+    duplicates = len(keys) - len(set(keys))
+    checks['sort_order'] = (missing == 0 and duplicates == 0,
+                            f"{len(rows)} draws, {missing} without a key, "
+                            f"{duplicates} duplicate keys")
+
+    # Every draw exactly once, numbered 1..n in sort_order, paging by cursor
+    paged_ids, numbers, cursor = [], [], None
+    while True:
+        params = {'limit': 500}
+        if cursor:
+            params['cursor'] = cursor
+        status, body, headers = client.request('GET', ROUTES['page'], params=params,
+                                               cookie=cookie)
+        page = json.loads(body) if status == 200 else []
+        if not page:
+            break
+        paged_ids.extend(row[7] for row in page)
+        numbers.extend(int(row[0]) for row in page)
+        cursor = headers.get('X-Next-Cursor')
+    expected_ids = [row[0] for row in rows]
+    checks['draw_number'] = (numbers == list(range(1, len(rows) + 1)),
+                             f"{len(numbers)} numbered rows paged")
+    checks['paged_ids'] = (paged_ids == expected_ids,
+                           f"{len(paged_ids)} ids paged, {len(expected_ids)} in the table")
+    status, body, _ = client.request('GET', ROUTES['page'],
+                                     params={'limit': 50, 'offset': len(rows) // 2},
+                                     cookie=cookie)
+    offset_ids = [row[7] for row in json.loads(body)] if status == 200 else None
+    checks['offset_page'] = (offset_ids == expected_ids[len(rows) // 2:len(rows) // 2 + 50],
+                             "middle page by offset")
+
+    draws = [tuple(row[2:]) for row in rows]
+    max_number = Config.GAMES[game]['max_number']
+    snap = snapshot.current(game)
+    checks['snapshot'] = (snap.rows() == draws, f"{snap.count} draws in the snapshot")
+    for k in (2, 3):
+        ranks = snap.ranks(k)
+        expected = scoring.draw_rank_lists(draws, k, max_number)
+        stale = sum(not np.array_equal(row[row >= 0], want)
+                    for row, want in zip(ranks, expected))
+        checks[f'snapshot_ranks_k{k}'] = (len(ranks) == len(expected) and stale == 0,
+                                          f"{stale} draws with wrong subset ranks")
+    return checks
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(workdir, workers, log_path):
+    port = free_port()
+    repo = os.path.dirname(os.path.abspath(__file__))
+    log = open(log_path, 'wb')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{port}',
+         '--config', os.path.join(repo, 'gunicorn.conf.py'),
+         '--workers', str(workers), '--chdir', workdir, '--pythonpath', repo],
+        stdout=log, stderr=subprocess.STDOUT)
+    client = HttpClient(f'http://127.0.0.1:{port}')
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {process.returncode}, see {log_path}")
+        try:
+            if client.request('GET', '/metrics')[0] == 200:
+                return process, client
+        except OSError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("gunicorn did not start in time")
+
+
+def run(target, game, mix, analysis_params, concurrency, duration, think=0.0,
+        gunicorn_workers=2, seed=0, log=sys.stderr):
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    cwd = os.getcwd()
+    for game_type, game_config in Config.GAMES.items():
+        copy_database(game_config['db_name'], os.path.join(workdir, game_config['db_name']))
+    os.chdir(workdir)
+    # The job dispatcher thread of --target client outlives the run
+    Config.JOB_DB = os.path.abspath(Config.JOB_DB)
+    process = None
+    recorder = Recorder(ROUTES)
+    try:
+        if target == 'gunicorn':
+            log_path = os.path.join(workdir, 'gunicorn.log')
+            process, client = start_gunicorn(workdir, gunicorn_workers, log_path)
+            make_client = lambda: client
+        else:
+            from flask import got_request_exception
+            from app import app
+
+            got_request_exception.connect(recorder.count_locked, app)
+            make_client = lambda: AppClient(app)
+
+        conn = sqlite3.connect(Config.GAMES[game]['db_name'])
+        grid = Grid(row[0] for row in conn.execute("SELECT id FROM draws ORDER BY sort_order"))
+        conn.close()
+        analyst = make_client()
+        analysis = Analysis(analyst, dict(analysis_params), open_session(analyst, game))
+        analysis.submit()
+
+        print(f"{concurrency} users for {duration}s against {target}", file=log)
+        started = time.perf_counter()
+        deadline = started + duration
+        threads = []
+        for i in range(concurrency):
+            client = make_client()
+            threads.append(threading.Thread(
+                target=run_user, args=(client, open_session(client, game), grid, analysis,
+                                       game, mix, deadline, think, seed + i, recorder)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        analysis.cancel()
+
+        checks = check_integrity(analyst, analysis.cookie, game)
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+            process = None
+            with open(log_path, 'rb') as f:
+                recorder.locked += f.read().count(f"OperationalError: {LOCKED}".encode())
+    finally:
+        if process is not None:
+            process.kill()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    routes = {}
+    for op, latencies in recorder.latencies.items():
+        statuses = recorder.statuses[op]
+        errors = sum(n for status, n in statuses.items()
+                     if status == 'exception' or int(status) >= 500)
+        routes[op] = dict(route=ROUTES[op], requests=len(latencies),
+                          per_second=round(len(latencies) / elapsed, 2), errors=errors,
+                          statuses=statuses, p50_ms=percentile_ms(latencies, 50),
+                          p95_ms=percentile_ms(latencies, 95),
+                          p99_ms=percentile_ms(latencies, 99))
+    total = sum(route['requests'] for route in routes.values())
+    return {
+        'created': time.time(),
+        'target': target,
+        'game': game,
+        'concurrency': concurrency,
+        'duration': round(elapsed, 3),
+        'mix': mix,
+        'analysis': analysis_params,
+        'requests': total,
+        'per_second': round(total / elapsed, 2),
+        'errors': sum(route['errors'] for route in routes.values()),
+        'database_locked': recorder.locked,
+        'analyses': dict(submitted=analysis.submitted, finished=analysis.finished),
+        'routes': routes,
+        'integrity': {name: dict(ok=ok, detail=detail) for name, (ok, detail) in checks.items()},
+    }
+
+
+def print_report(report, out=sys.stdout):
+    print(f"{'route':<22} {'requests':>9} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'errors':>7}", file=out)
+    for route in report['routes'].values():
+        if not route['requests']:
+            continue
+        print(f"{route['route']:<22} {route['requests']:>9} {route['per_second']:>8} "
+              f"{route['p50_ms']:>8} {route['p95_ms']:>8} {route['p99_ms']:>8} "
+              f"{route['errors']:>7}", file=out)
+    print(f"\n{report['requests']} requests, {report['per_second']} req/s, "
+          f"{report['errors']} errors, {report['database_locked']} 'database is locked', "
+          f"analyses {report['analyses']['finished']} finished / "
+          f"{report['analyses']['submitted']} submitted", file=out)
+    for name, check in report['integrity'].items():
+        print(f"{'ok  ' if check['ok'] else 'FAIL'} {name}: {check['detail']}", file=out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent load test of the web app.")
+    parser.add_argument('--target', choices=['client', 'gunicorn'], default='client')
+    parser.add_argument('--game', default='6_42', choices=list(Config.GAMES))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30, help="seconds of load")
+    parser.add_argument('--think', type=float, default=0.0,
+                        help="mean pause between a user's requests, in seconds")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="operation=weight,...")
+    parser.add_argument('--analysis', default=DEFAULT_ANALYSIS,
+                        help="parameters of the polled analysis (form fields)")
+    parser.add_argument('--gunicorn-workers', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the report as JSON")
+    args = parser.parse_args(argv)
+
+    mix = parse_pairs(args.mix, float)
+    unknown = set(mix) - set(ROUTES)
+    if unknown:
+        parser.error(f"unknown operations in --mix: {', '.join(sorted(unknown))}")
+    report = run(args.target, args.game, mix, parse_pairs(args.analysis, str),
+                 args.concurrency, args.duration, think=args.think,
+                 gunicorn_workers=args.gunicorn_workers, seed=args.seed)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0 if all(check['ok'] for check in report['integrity'].values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,326 @@
+# metrics.py
+#
+# Process-local metrics, served in the Prometheus text format by /metrics.
+# Every gunicorn worker keeps its own registry; analysis jobs run in pool
+# processes and hand their run statistics back to the worker that
+# dispatched them (jobs.JobManager), which records them here.
+#
+# RunStats collects the timings and counters of one unit of work (an
+# analysis run, a request). While it is active for a thread, timed() and
+# count() anywhere below record into it. Timings are exclusive: a timed()
+# block nested in another is only counted once, in the inner one.
+import gc
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300)
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+               for _, v in pairs)
+    return '{' + ','.join(f'{n}="{v}"' for (n, _), v in zip(pairs, escaped)) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_label_text(self.labels, key)} {_number(value)}"]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def _samples(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            labels = _label_text(self.labels, key, [('le', _number(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _label_text(self.labels, key)
+        lines.append(f"{self.name}_sum{labels} {_number(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, labels, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, labels, **kwargs)
+            return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text, labels=()):
+        return self._get(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_text, labels, buckets=buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def peak_rss_bytes():
+    """The process's lifetime peak RSS (high-water mark)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def rss_bytes():
+    """The process's current RSS, or None where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def gc_collections():
+    return sum(generation['collections'] for generation in gc.get_stats())
+
+
+class RunStats:
+    """
+    Exclusive seconds per timed() name, count() totals, and the peak RSS
+    over the run's own RSS baseline. Pool processes run job after job, so
+    the lifetime high-water mark only belongs to this run if it rose during
+    it; otherwise the peak is the highest RSS read at the end of a timed()
+    block.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.counts = {}
+        self._stack = []
+        self._started = time.perf_counter()
+        self._gc_start = gc_collections()
+        self._rss_start = rss_bytes()
+        self._rss_peak = self._rss_start
+        self._hwm_start = peak_rss_bytes()
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self._stack:
+            outer, since = self._stack[-1]
+            self.seconds[outer] = self.seconds.get(outer, 0.0) + now - since
+        self._stack.append((name, now))
+
+    def exit(self):
+        now = time.perf_counter()
+        name, since = self._stack.pop()
+        self.seconds[name] = self.seconds.get(name, 0.0) + now - since
+        self._sample_rss()
+        if self._stack:
+            self._stack[-1] = (self._stack[-1][0], now)
+        return now - since
+
+    def count(self, name, amount=1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def elapsed(self):
+        return time.perf_counter() - self._started
+
+    def _sample_rss(self):
+        rss = rss_bytes()
+        if rss is not None and (self._rss_peak is None or rss > self._rss_peak):
+            self._rss_peak = rss
+
+    def peak_rss_increase(self):
+        """Bytes the RSS rose above its level at the start of the run, at its peak."""
+        self._sample_rss()
+        hwm = peak_rss_bytes()
+        if self._rss_start is None:
+            return hwm - self._hwm_start
+        peak = hwm if hwm > self._hwm_start else self._rss_peak
+        return max(peak - self._rss_start, 0)
+
+    def as_dict(self):
+        """JSON-friendly summary, with the total and the collector/memory readings."""
+        return dict(seconds={name: round(s, 6) for name, s in self.seconds.items()},
+                    counts=dict(self.counts, gc_collections=gc_collections() - self._gc_start),
+                    total_seconds=round(self.elapsed(), 6),
+                    peak_rss_bytes=self.peak_rss_increase())
+
+
+_local = threading.local()
+
+
+def current():
+    """The RunStats active for this thread, or None."""
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def activate(stats):
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    _local.stack.append(stats)
+
+
+def deactivate(stats):
+    stack = getattr(_local, 'stack', [])
+    if stats in stack:
+        stack.remove(stats)
+
+
+@contextmanager
+def collecting(stats):
+    activate(stats)
+    try:
+        yield stats
+    finally:
+        deactivate(stats)
+
+
+@contextmanager
+def timed(name, histogram=None, **labels):
+    """
+    Time a block into the active RunStats (if any) and, if given, into a
+    registry histogram.
+    """
+    stats = current()
+    start = time.perf_counter()
+    if stats is not None:
+        stats.enter(name)
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.exit()
+        if histogram is not None:
+            histogram.observe(time.perf_counter() - start, **labels)
+
+
+def count(name, amount=1):
+    stats = current()
+    if stats is not None:
+        stats.count(name, amount)
+
+
+# Metrics recorded by the web process
+
+request_seconds = registry.histogram(
+    'lotto_http_request_seconds', "Request latency until the response is returned",
+    ('route', 'method', 'status'))
+request_lock_wait_seconds = registry.histogram(
+    'lotto_http_request_sqlite_lock_wait_seconds',
+    "Time a request spent waiting for SQLite write locks", ('route',))
+sqlite_lock_wait_seconds = registry.histogram(
+    'lotto_sqlite_lock_wait_seconds',
+    "Time to take a SQLite write lock (first write of a transaction)", ('database',))
+analysis_runs = registry.counter(
+    'lotto_analysis_runs_total', "Analysis runs finished", ('engine',))
+analysis_phase_seconds = registry.histogram(
+    'lotto_analysis_phase_seconds', "Analysis time per phase", ('phase',))
+analysis_seconds = registry.histogram(
+    'lotto_analysis_seconds', "Analysis wall time", ('engine',))
+analysis_combos = registry.counter(
+    'lotto_analysis_combos_total', "Combos covered by analysis runs")
+analysis_combos_per_second = registry.gauge(
+    'lotto_analysis_combos_per_second', "Enumeration throughput of the last run", ('engine',))
+analysis_events = registry.counter(
+    'lotto_analysis_events_total',
+    "Analysis counters: top-l admissions, replacements and spills, gc collections",
+    ('event',))
+analysis_peak_rss_bytes = registry.gauge(
+    'lotto_analysis_peak_rss_bytes',
+    "Peak RSS increase of the last analysis over the RSS its process had when it started")
+
+
+def record_analysis(stats, engine):
+    """Fold the stats of one run_analysis call (RunStats.as_dict()) into the registry."""
+    analysis_runs.inc(engine=engine)
+    analysis_seconds.observe(stats['total_seconds'], engine=engine)
+    for phase, seconds in stats['seconds'].items():
+        analysis_phase_seconds.observe(seconds, phase=phase)
+    counts = dict(stats['counts'])
+    combos = counts.pop('combos', 0)
+    analysis_combos.inc(combos)
+    enumerate_seconds = stats['seconds'].get('enumerate')
+    if combos and enumerate_seconds:
+        analysis_combos_per_second.set(combos / enumerate_seconds, engine=engine)
+    for event, amount in counts.items():
+        analysis_events.inc(amount, event=event)
+    analysis_peak_rss_bytes.set(stats['peak_rss_bytes'])
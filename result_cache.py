@@ -0,0 +1,101 @@
+# result_cache.py
+import hashlib
+import json
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from config import Config
+
+
+def cache_key(game_type, j, k, m, l, n, last_offset, data_version):
+    """
+    Key of one analysis result. data_version comes from
+    database.get_data_version, so any write to the draws gives new keys.
+    """
+    params = json.dumps([game_type, j, k, m, l, n, last_offset, data_version])
+    return hashlib.sha1(params.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    LRU cache of run_analysis results (selected_df, top_df, elapsed).
+    With a directory, entries are also pickled there so they survive
+    restarts and are shared by every process using the same directory.
+    """
+
+    def __init__(self, max_entries=16, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.pkl")
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        self._remember(key, value)
+        return value
+
+    def put(self, key, value, memory=True):
+        """
+        Cache a result. memory=False only writes the directory, for a
+        process that will not read the entry back itself.
+        """
+        if self.max_entries <= 0:
+            return
+        if memory:
+            self._remember(key, value)
+        if self.directory:
+            tmp = self._path(key) + f".{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._path(key))
+            self._trim_directory()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.directory:
+            for name in os.listdir(self.directory):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(self.directory, name))
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _trim_directory(self):
+        files = [os.path.join(self.directory, name)
+                 for name in os.listdir(self.directory) if name.endswith('.pkl')]
+        if len(files) <= self.max_entries:
+            return
+        files.sort(key=lambda path: os.path.getmtime(path))
+        for path in files[:len(files) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+result_cache = ResultCache(Config.RESULT_CACHE_SIZE, Config.RESULT_CACHE_DIR)
@@ -0,0 +1,508 @@
+# scoring.py
+import itertools
+from math import comb
+import numpy as np
+
+# Combos are generated as a fixed "prefix" (iterated in Python) followed by a
+# block of precomputed "tails" (a NumPy array), so each Python step emits
+# thousands of combos at once.
+TAIL_WIDTH = 4
+DEFAULT_BATCH_SIZE = 1 << 17
+
+
+def rank_dtype(max_number, k):
+    return np.int32 if comb(max_number, k) < 2 ** 31 else np.int64
+
+
+def rank_table(max_number, k):
+    """
+    table[v, i] = C(v - 1, i + 1), so the colexicographic rank of a sorted
+    k-subset (a_0 < ... < a_{k-1}) of 1..max_number is sum(table[a_i, i]).
+    Ranks run from 0 to C(max_number, k) - 1.
+    """
+    dtype = rank_dtype(max_number, k)
+    table = np.zeros((max_number + 1, max(k, 1)), dtype=dtype)
+    for v in range(1, max_number + 1):
+        for i in range(k):
+            table[v, i] = comb(v - 1, i + 1)
+    return table
+
+
+def rank_subset(subset):
+    """Colex rank of a sorted tuple of distinct numbers (1-based)."""
+    return sum(comb(a - 1, i + 1) for i, a in enumerate(subset))
+
+
+def unrank_subset(rank, k):
+    """Inverse of rank_subset."""
+    subset = []
+    for i in range(k, 0, -1):
+        v = i
+        while comb(v, i) <= rank:
+            v += 1
+        subset.append(v)
+        rank -= comb(v - 1, i)
+    return tuple(reversed(subset))
+
+
+def subset_positions(j, k):
+    """Index tuples of the k-subsets of a j-combo, in itertools order."""
+    return np.array(list(itertools.combinations(range(j), k)), dtype=np.intp).reshape(-1, k)
+
+
+def rank_rows(values, table):
+    """
+    values: integer array (..., k) of sorted numbers.
+    Returns the colex ranks with shape values.shape[:-1].
+    """
+    k = values.shape[-1]
+    ranks = table[values[..., 0], 0]
+    for i in range(1, k):
+        ranks = ranks + table[values[..., i], i]
+    return ranks
+
+
+def draw_subset_ranks(numbers, k, max_number):
+    """Ranks of the k-subsets of one draw; None values and duplicates are ignored."""
+    row = sorted({x for x in numbers if x is not None and 1 <= x <= max_number})
+    return [rank_subset(s) for s in itertools.combinations(row, k)]
+
+
+def draw_rank_lists(rows, k, max_number):
+    """
+    Ranks of the k-subsets of every row, as one int32 array per row.
+    Rows of six distinct numbers are ranked in a single vectorized pass.
+    """
+    result = [None] * len(rows)
+    regular = []
+    for idx, row in enumerate(rows):
+        vals = [x for x in row if x is not None]
+        if len(vals) == 6 and len(set(vals)) == 6:
+            regular.append(idx)
+        else:
+            result[idx] = np.array(draw_subset_ranks(row, k, max_number), dtype=np.int32)
+
+    if regular:
+        draws = np.sort(np.array([tuple(rows[i]) for i in regular], dtype=np.int64), axis=1)
+        ranks = rank_rows(draws[:, subset_positions(6, k)], rank_table(max_number, k))
+        ranks = ranks.astype(np.int32)
+        for i, idx in enumerate(regular):
+            result[idx] = ranks[i]
+    return result
+
+
+def last_seen_from_rank_lists(rank_lists, k, max_number):
+    """
+    For every k-subset rank, the index of the last list containing it,
+    or -1 if it never appears.
+    """
+    last_seen = np.full(comb(max_number, k), -1, dtype=np.int64)
+    if not rank_lists:
+        return last_seen
+    counts = np.array([len(r) for r in rank_lists], dtype=np.int64)
+    if counts.sum() == 0:
+        return last_seen
+    ranks = np.concatenate(rank_lists).astype(np.int64)
+    positions = np.repeat(np.arange(len(rank_lists), dtype=np.int64), counts)
+    np.maximum.at(last_seen, ranks, positions)
+    return last_seen
+
+
+def last_seen_from_rank_matrix(ranks, size):
+    """
+    last_seen_from_rank_lists for a (rows, width) rank array padded with -1,
+    over a subset rank space of the given size.
+    """
+    last_seen = np.full(size, -1, dtype=np.int64)
+    ranks = np.asarray(ranks)
+    valid = ranks >= 0
+    positions = np.broadcast_to(np.arange(len(ranks), dtype=np.int64)[:, None], ranks.shape)
+    np.maximum.at(last_seen, ranks[valid].astype(np.int64), positions[valid])
+    return last_seen
+
+
+def build_last_seen(rows, k, max_number):
+    """
+    For every k-subset rank, the index of the last row (in the given order)
+    containing it, or -1 if it never appears.
+    """
+    return last_seen_from_rank_lists(draw_rank_lists(rows, k, max_number), k, max_number)
+
+
+def weights_from_last_seen(last_seen, draw_count):
+    """
+    Weight of a subset = how many draws ago it was last seen
+    (0 for the most recent draw, and 0 for subsets never seen).
+    """
+    weights = np.where(last_seen >= 0, (draw_count - 1) - last_seen, 0)
+    return weights.astype(np.int32)
+
+
+def build_weights(rows, k, max_number):
+    return weights_from_last_seen(build_last_seen(rows, k, max_number), len(rows))
+
+
+def _combo_layout(max_number, j):
+    """(tail width, prefix width, tails array, tail_start) for iter_combo_batches."""
+    t = min(j, TAIL_WIDTH)
+    p = j - t
+    tails = np.array(list(itertools.combinations(range(1, max_number + 1), t)),
+                     dtype=np.uint8).reshape(-1, t)
+    # tail_start[v] = first tail whose smallest number is > v
+    tail_start = np.searchsorted(tails[:, 0], np.arange(max_number + 1), side='right')
+    return t, p, tails, tail_start
+
+
+def combo_shards(max_number, j, count):
+    """
+    Split the lexicographic combo sequence into at most `count` contiguous
+    shards of roughly equal size. Each shard is a (lo, hi) range of prefixes
+    (or of tail rows when j <= TAIL_WIDTH) accepted by iter_combo_batches.
+    """
+    t, p, tails, tail_start = _combo_layout(max_number, j)
+    if p == 0:
+        sizes = np.ones(len(tails), dtype=np.int64)
+    else:
+        last = [prefix[-1] for prefix in itertools.combinations(range(1, max_number - t + 1), p)]
+        sizes = len(tails) - tail_start[np.array(last, dtype=np.intp)]
+    cumulative = np.cumsum(sizes)
+    total = int(cumulative[-1]) if len(cumulative) else 0
+    bounds = [0]
+    for i in range(1, count):
+        cut = int(np.searchsorted(cumulative, total * i // count, side='right'))
+        if cut > bounds[-1]:
+            bounds.append(cut)
+    bounds.append(len(sizes))
+    return [(lo, hi) for lo, hi in zip(bounds, bounds[1:]) if hi > lo]
+
+
+def iter_combo_batches(max_number, j, batch_size=DEFAULT_BATCH_SIZE, shard=None):
+    """
+    Yield uint8 arrays of shape (b, j) holding every j-combination of
+    1..max_number exactly once, in lexicographic order. With a shard from
+    combo_shards, only that contiguous part of the sequence is produced.
+    """
+    t, p, tails, tail_start = _combo_layout(max_number, j)
+    if p == 0:
+        lo, hi = shard or (0, len(tails))
+        for start in range(lo, hi, batch_size):
+            yield tails[start:min(start + batch_size, hi)]
+        return
+
+    prefixes = itertools.combinations(range(1, max_number - t + 1), p)
+    if shard:
+        prefixes = itertools.islice(prefixes, shard[0], shard[1])
+    pending = []
+    pending_rows = 0
+    for prefix in prefixes:
+        block_tails = tails[tail_start[prefix[-1]]:]
+        block = np.empty((len(block_tails), j), dtype=np.uint8)
+        block[:, :p] = prefix
+        block[:, p:] = block_tails
+        pending.append(block)
+        pending_rows += len(block)
+        if pending_rows >= batch_size:
+            yield pending[0] if len(pending) == 1 else np.concatenate(pending)
+            pending = []
+            pending_rows = 0
+    if pending:
+        yield np.concatenate(pending)
+
+
+def batch_ranks(combos, positions, table):
+    """Ranks of the k-subsets of each combo, shape (b, C(j, k))."""
+    return rank_rows(combos[:, positions], table)
+
+
+def score_ranks(ranks, weights):
+    """(sums, mins) of the weights of each row of subset ranks."""
+    vals = weights[ranks]
+    return vals.sum(axis=1, dtype=np.int64), vals.min(axis=1).astype(np.int64)
+
+
+def score_batch(combos, weights, positions, table):
+    """
+    Returns (sums, mins) of the subset weights of each combo in the batch.
+    """
+    return score_ranks(batch_ranks(combos, positions, table), weights)
+
+
+def top_indices(keys, l):
+    """
+    Indices of the l best keys, ordered by key descending and then by
+    position ascending (earlier entries win ties).
+    """
+    if len(keys) > l:
+        kth = np.partition(keys, len(keys) - l)[len(keys) - l]
+        above = np.flatnonzero(keys > kth)
+        ties = np.flatnonzero(keys == kth)[:l - len(above)]
+        idx = np.concatenate([above, ties])
+    else:
+        idx = np.arange(len(keys))
+    order = np.lexsort((idx, -keys[idx]))
+    return idx[order]
+
+
+def merge_top(top_keys, top_combos, keys, combos, l):
+    """
+    Merge a batch of (keys, combos) into the current sorted top-l.
+    The batch must come after the current entries in enumeration order.
+    """
+    if len(top_keys) >= l:
+        mask = keys > top_keys[-1]
+        if not mask.any():
+            return top_keys, top_combos
+        keys = keys[mask]
+        combos = combos[mask]
+    if len(keys) > l:
+        idx = top_indices(keys, l)
+        keys = keys[idx]
+        combos = combos[idx]
+    all_keys = np.concatenate([top_keys, keys])
+    all_combos = np.concatenate([top_combos, combos])
+    idx = top_indices(all_keys, l)
+    return all_keys[idx], all_combos[idx]
+
+
+def seed_threshold(weights, max_number, j, k, m, l, sample_size=1 << 16, seed=0):
+    """
+    The l-th best key among a random sample of combos. The final top-l
+    threshold can never be lower, so it is a safe starting cutoff for pruning.
+    Returns None when the sample is smaller than l.
+    """
+    total = comb(max_number, j)
+    if l > min(sample_size, total):
+        return None
+    rng = np.random.default_rng(seed)
+    picks = np.argsort(rng.random((sample_size, max_number)), axis=1)[:, :j] + 1
+    combos = np.unique(np.sort(picks, axis=1).astype(np.uint8), axis=0)
+    if l > len(combos):
+        return None
+    sums, mins = score_batch(combos, weights, subset_positions(j, k), rank_table(max_number, k))
+    keys = sums if m == 'avg' else mins
+    return int(np.sort(keys)[-l])
+
+
+def best_weight_above(weights, max_number, k):
+    """
+    best[x] = largest weight of a subset whose largest number is > x, i.e.
+    of ranks >= C(x, k); 0 for x = max_number.
+    """
+    suffix_max = np.maximum.accumulate(weights[::-1])[::-1]
+    best = np.zeros(max_number + 1, dtype=np.int64)
+    for x in range(max_number):
+        best[x] = suffix_max[comb(x, k)]
+    return best
+
+
+def iter_pruned_batches(weights, max_number, j, k, m, threshold,
+                        seed=None, batch_size=1 << 12, flat_width=3):
+    """
+    Depth-first enumeration of j-combos in lexicographic order that skips
+    every subtree whose best possible key cannot reach the top-l.
+
+    threshold() returns the current l-th best key (or None while the top-l
+    is not full); a prefix is dropped once its bound is <= that key, because
+    later combos lose ties. seed is a key some l combos are known to reach,
+    so prefixes bounded strictly below it are dropped from the start.
+
+    For m='min' the bound is the running minimum of the prefix's k-subset
+    weights (adding numbers only adds subsets). For m='avg' it is the
+    running sum plus, for each subset still to come, the largest weight of
+    any subset containing a number above the prefix.
+
+    Once only flat_width numbers are left to choose, the remaining
+    completions of a prefix are scored as one vectorized block instead.
+
+    Yields (combos, sums, mins, covered) for the surviving leaves, in lex
+    order; covered counts the combos scored or skipped since the last batch
+    (batches may be empty when whole subtrees were skipped).
+    """
+    table = rank_table(max_number, k)
+    subsets_per_combo = comb(j, k)
+    if m == 'avg':
+        best_above = best_weight_above(weights, max_number, k)
+        remaining = np.array([subsets_per_combo - comb(d, k) for d in range(j + 1)],
+                             dtype=np.int64)
+
+    # subtree[d][x] = number of j-combos below a prefix of size d ending at x
+    subtree = np.array([[comb(max_number - x, j - d) if x <= max_number else 0
+                         for x in range(max_number + 1)] for d in range(j + 1)],
+                       dtype=np.int64)
+    out_combos, out_sums, out_mins = [], [], []
+    out_rows = 0
+    covered = 0
+    positions = subset_positions(j, k)
+    flat_width = max(1, min(flat_width, j))
+    tails = np.array(list(itertools.combinations(range(1, max_number + 1), flat_width)),
+                     dtype=np.uint8).reshape(-1, flat_width)
+    tail_start = np.searchsorted(tails[:, 0], np.arange(max_number + 1), side='right')
+    inf = np.iinfo(np.int64).max
+
+    def cutoff():
+        current = threshold()
+        if current is None:
+            return None if seed is None else seed - 1
+        if seed is not None and seed - 1 > current:
+            return seed - 1
+        return current
+
+    def finish(prefix):
+        nonlocal out_rows, covered
+        d = len(prefix)
+        block_tails = tails[tail_start[prefix[-1]] if prefix else 0:]
+        block = np.empty((len(block_tails), j), dtype=np.uint8)
+        block[:, :d] = prefix
+        block[:, d:] = block_tails
+        sums, mins = score_batch(block, weights, positions, table)
+        covered += len(block)
+        cut = cutoff()
+        if cut is not None:
+            keep = (sums if m == 'avg' else mins) > cut
+            block, sums, mins = block[keep], sums[keep], mins[keep]
+        if len(block):
+            out_combos.append(block)
+            out_sums.append(sums)
+            out_mins.append(mins)
+            out_rows += len(block)
+
+    def descend(prefix, sub, prefix_sum, prefix_min):
+        nonlocal out_rows, covered
+        d = len(prefix)
+        if j - d == flat_width:
+            finish(prefix)
+            return
+        lo = prefix[-1] + 1 if prefix else 1
+        hi = max_number - (j - d - 1)
+        if lo > hi:
+            return
+        xs = np.arange(lo, hi + 1)
+        if len(sub[k - 1]):
+            vals = weights[sub[k - 1][:, None] + table[xs, k - 1][None, :]]
+            sums = prefix_sum + vals.sum(axis=0, dtype=np.int64)
+            mins = np.minimum(prefix_min, vals.min(axis=0).astype(np.int64))
+        else:
+            sums = np.full(len(xs), prefix_sum, dtype=np.int64)
+            mins = np.full(len(xs), prefix_min, dtype=np.int64)
+
+        cut = cutoff()
+        if cut is not None:
+            if m == 'avg':
+                bound = sums + remaining[d + 1] * best_above[xs]
+            else:
+                bound = mins
+            keep = bound > cut
+            covered += int(subtree[d + 1][xs[~keep]].sum())
+            xs, sums, mins = xs[keep], sums[keep], mins[keep]
+
+        if d == j - 1:
+            if len(xs):
+                leaf = np.empty((len(xs), j), dtype=np.uint8)
+                leaf[:, :d] = prefix
+                leaf[:, d] = xs
+                out_combos.append(leaf)
+                out_sums.append(sums)
+                out_mins.append(mins)
+                out_rows += len(xs)
+                covered += len(xs)
+            return
+
+        for x, s, mn in zip(xs.tolist(), sums.tolist(), mins.tolist()):
+            child = [sub[0]]
+            for i in range(1, k):
+                child.append(np.concatenate([sub[i], sub[i - 1] + table[x, i - 1]]))
+            yield from descend(prefix + (x,), child, s, mn)
+            if out_rows >= batch_size or covered >= batch_size << 8:
+                yield from flush()
+
+    def flush():
+        nonlocal out_combos, out_sums, out_mins, out_rows, covered
+        if out_rows:
+            yield (np.concatenate(out_combos), np.concatenate(out_sums),
+                   np.concatenate(out_mins), covered)
+        elif covered:
+            yield (np.empty((0, j), dtype=np.uint8), np.empty(0, dtype=np.int64),
+                   np.empty(0, dtype=np.int64), covered)
+        out_combos, out_sums, out_mins = [], [], []
+        out_rows = 0
+        covered = 0
+
+    dtype = table.dtype
+    empty = [np.zeros(1, dtype=dtype)] + [np.empty(0, dtype=dtype) for _ in range(k - 1)]
+    yield from descend((), empty, 0, inf)
+    yield from flush()
+
+
+def revolving_door(n, t):
+    """
+    Yield (combo, out, in) for every t-combination of 0..n-1 in
+    revolving-door order (Knuth, TAOCP 7.2.1.3, Algorithm R): each combo
+    is the one before with the number `out` swapped for `in` (both None
+    for the first). combo is a sorted list.
+    """
+    # c[1..t] is the combo, c[t + 1] = n and c[t + 2] are sentinels
+    c = [0] + list(range(t)) + [n, 0]
+    yield c[1:t + 1], None, None
+    if t == 0 or t >= n:
+        return
+    if t == 1:
+        for v in range(1, n):
+            yield [v], v - 1, v
+        return
+    while True:
+        # R3: the easy case moves c[1] only
+        if t % 2:
+            if c[1] + 1 < c[2]:
+                c[1] += 1
+                yield c[1:t + 1], c[1] - 1, c[1]
+                continue
+            step = 'decrease'
+        else:
+            if c[1] > 0:
+                c[1] -= 1
+                yield c[1:t + 1], c[1] + 1, c[1]
+                continue
+            step = 'increase'
+        i = 2
+        while True:
+            if step == 'decrease':
+                # R4: here c[i] == c[i - 1] + 1
+                if c[i] >= i:
+                    out = c[i]
+                    c[i] = c[i - 1]
+                    c[i - 1] = i - 2
+                    yield c[1:t + 1], out, i - 2
+                    break
+                i += 1
+            # R5: here c[i - 1] == i - 2
+            if c[i] + 1 < c[i + 1]:
+                out = c[i - 1]
+                c[i - 1] = c[i]
+                c[i] += 1
+                yield c[1:t + 1], out, c[i]
+                break
+            i += 1
+            if i > t:
+                return
+            step = 'decrease'
+
+
+def lex_ranks(combos, max_number):
+    """
+    Lexicographic ranks of sorted combos (b, j) of 1..max_number, i.e.
+    their positions in iter_combo_batches order.
+    """
+    b, j = combos.shape
+    # before[i, v] = combos whose number i is <= v, among those sharing
+    # the numbers before it: sum of C(max_number - u, j - i - 1), u = 1..v
+    before = np.zeros((j, max_number + 1), dtype=np.int64)
+    for i in range(j):
+        before[i, 1:] = np.cumsum([comb(max_number - u, j - i - 1)
+                                   for u in range(1, max_number + 1)])
+    values = combos.astype(np.intp)
+    ranks = np.zeros(b, dtype=np.int64)
+    previous = np.zeros(b, dtype=np.intp)
+    for i in range(j):
+        ranks += before[i, values[:, i] - 1] - before[i, previous]
+        previous = values[:, i]
+    return ranks
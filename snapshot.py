@@ -0,0 +1,201 @@
+# snapshot.py
+#
+# Read-only binary snapshots of a game's draws and k-subset weights. Every
+# process maps the same files with mmap (numpy.load(mmap_mode='r')), so web
+# workers and job processes share one copy through the page cache instead of
+# each reading SQLite rows into Python objects.
+#
+# SNAPSHOT_DIR/<game>/<data version>/ holds
+#   draws.npy         (draws, 6) uint8 by sort_order, empty cells 0
+#   ranks_k<k>.npy    (draws, C(6, k)) int32 colex ranks of each draw's
+#                     k-subsets, padded with -1 (draws with empty or repeated
+#                     numbers have fewer)
+#   weights_k<k>.npy  int32 weights over all draws, by colex rank
+#                     (scoring.weights_from_last_seen)
+# Each file is written under a temporary name and renamed into place, and
+# never changes afterwards. Every write through database.py bumps the data
+# version, so the first reader after a change builds the new snapshot (the
+# draws and their version are read in one transaction) and removes the
+# older ones; processes that still map an old file keep a valid mapping.
+#
+# ranks_k<k>.npy is the game's k-subset index (what run_analysis, its
+# last_offset variant and run_sweep read instead of rescanning the draws).
+# It is rebuilt once per data version rather than patched by each write:
+# the numpy build takes a few milliseconds per game and k, less than the
+# SQLite index it replaced spent on every grid edit.
+import hashlib
+import os
+import shutil
+import tempfile
+from math import comb
+import numpy as np
+from config import Config
+from database import get_db_connection, get_data_version
+import metrics
+import scoring
+
+# game_type -> the newest Snapshot this process has opened
+_snapshots = {}
+
+
+def _dir_name(version):
+    return version.replace(':', '-')
+
+
+def _load(path):
+    """The read-only memmap of a snapshot file, or None if it does not exist."""
+    try:
+        return np.load(path, mmap_mode='r')
+    except FileNotFoundError:
+        return None
+
+
+def _write(path, array):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def rank_matrix(draws, k, max_number):
+    """
+    (draws, C(6, k)) int32 colex ranks of the k-subsets of every draw, in
+    scoring.draw_rank_lists order, padded with -1.
+    """
+    ranks = np.full((len(draws), comb(6, k)), -1, dtype=np.int32)
+    values = np.sort(draws.astype(np.int64), axis=1)
+    regular = (values[:, 0] >= 1) & (np.diff(values, axis=1) > 0).all(axis=1)
+    ranks[regular] = scoring.rank_rows(values[regular][:, scoring.subset_positions(6, k)],
+                                       scoring.rank_table(max_number, k))
+    for i in np.flatnonzero(~regular):
+        row = scoring.draw_subset_ranks([int(x) or None for x in draws[i]], k, max_number)
+        ranks[i, :len(row)] = row
+    return ranks
+
+
+class Snapshot:
+    """One game's draws at one data version; arrays are loaded on first use."""
+
+    def __init__(self, game_type, version, path, draws):
+        self.game_type = game_type
+        self.version = version
+        self.path = path
+        self.draws = draws
+        self.max_number = Config.GAMES[game_type]['max_number']
+        self._arrays = {}
+        self._digests = {}
+
+    @property
+    def count(self):
+        return len(self.draws)
+
+    def rows(self, limit=None):
+        """The first `limit` draws as tuples of six numbers, None for empty cells."""
+        return [tuple(x or None for x in row) for row in self.draws[:limit].tolist()]
+
+    def digest(self, limit=None):
+        """database.draws_digest(game_type, limit), computed from the snapshot."""
+        limit = self.count if limit is None else min(limit, self.count)
+        if limit not in self._digests:
+            digest = hashlib.sha1()
+            for row in self.rows(limit):
+                digest.update(repr(row).encode())
+            self._digests[limit] = digest.hexdigest()
+        return self._digests[limit]
+
+    def ranks(self, k):
+        return self._array(f'ranks_k{k}.npy',
+                           lambda: rank_matrix(self.draws, k, self.max_number))
+
+    def weights(self, k, count=None):
+        """
+        k-subset weights over the first `count` draws (default: all). Those
+        over all draws are part of the snapshot; the others are computed
+        from the stored ranks.
+        """
+        count = self.count if count is None else count
+        if count == self.count:
+            return self._array(f'weights_k{k}.npy', lambda: self._weights(k, count))
+        with metrics.timed('index'):
+            return self._weights(k, count)
+
+    def _weights(self, k, count):
+        last_seen = scoring.last_seen_from_rank_matrix(self.ranks(k)[:count],
+                                                       comb(self.max_number, k))
+        return scoring.weights_from_last_seen(last_seen, count)
+
+    def _array(self, name, build):
+        array = self._arrays.get(name)
+        if array is None:
+            path = os.path.join(self.path, name)
+            array = _load(path)
+            if array is None:
+                with metrics.timed('index'):
+                    array = build()
+                try:
+                    _write(path, array)
+                except OSError:
+                    # Removed by a newer snapshot meanwhile: use it unshared
+                    return array
+                mapped = _load(path)
+                array = array if mapped is None else mapped
+            self._arrays[name] = array
+        return array
+
+
+def _read_draws(game_type):
+    """(data version, (draws, 6) uint8 array), read in one transaction."""
+    get_data_version(game_type)  # creates dataset_meta if needed
+    conn = get_db_connection(game_type)
+    try:
+        conn.execute("BEGIN")
+        meta = dict(conn.execute(
+            "SELECT key, value FROM dataset_meta WHERE key IN ('epoch', 'version')"
+        ).fetchall())
+        rows = conn.execute(
+            "SELECT number1, number2, number3, number4, number5, number6 FROM draws "
+            "ORDER BY sort_order"
+        ).fetchall()
+    finally:
+        conn.close()
+    draws = np.array([[n or 0 for n in row] for row in rows], dtype=np.uint8).reshape(-1, 6)
+    return f"{meta['epoch']}:{meta['version']}", draws
+
+
+def _prune(game_dir, keep):
+    """Remove the snapshots of a game that are older than `keep`."""
+    keep_mtime = os.stat(keep).st_mtime
+    for name in os.listdir(game_dir):
+        path = os.path.join(game_dir, name)
+        try:
+            stale = path != keep and os.path.isdir(path) and os.stat(path).st_mtime < keep_mtime
+        except OSError:
+            continue  # removed by another process
+        if stale:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def current(game_type):
+    """The snapshot of the game's current data version, built if needed."""
+    version = get_data_version(game_type)
+    snap = _snapshots.get(game_type)
+    if snap is not None and snap.version == version:
+        return snap
+    game_dir = os.path.join(Config.SNAPSHOT_DIR, game_type)
+    path = os.path.join(game_dir, _dir_name(version))
+    draws = _load(os.path.join(path, 'draws.npy'))
+    if draws is None:
+        version, draws = _read_draws(game_type)
+        path = os.path.join(game_dir, _dir_name(version))
+        os.makedirs(path, exist_ok=True)
+        _write(os.path.join(path, 'draws.npy'), draws)
+        _prune(game_dir, path)
+        mapped = _load(os.path.join(path, 'draws.npy'))
+        draws = draws if mapped is None else mapped
+    snap = _snapshots[game_type] = Snapshot(game_type, version, path, draws)
+    return snap
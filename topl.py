@@ -0,0 +1,214 @@
+# topl.py
+#
+# Top-l selection over a stream of scored combos, for l from 1 to millions.
+# Order is the same as scoring.top_indices / merge_top: key descending, and
+# on equal keys the combo enumerated first wins.
+import os
+import shutil
+import tempfile
+import numpy as np
+from config import Config
+import metrics
+import scoring
+
+
+def run_dtype(j):
+    return np.dtype([('key', np.int64), ('seq', np.int64), ('combo', np.uint8, (j,))])
+
+
+def sort_rows(rows):
+    return rows[np.lexsort((rows['seq'], -rows['key']))]
+
+
+def _spilled(run):
+    return isinstance(run, np.memmap)
+
+
+class TopL:
+    """
+    The l best (key, combo) pairs of everything passed to add().
+
+    seq is the enumeration position of a combo (add() numbers each batch
+    on from seq_base), so ties resolve the same however the work was split.
+    Every batch is cut to its own top-l with a partial selection before it
+    is buffered, and a histogram of the kept keys gives the current l-th
+    best key: later combos must beat it to get in. A buffer that outgrows
+    memory_rows is sorted into a run, and runs go to .npy files once they
+    no longer fit in memory either. iter_sorted() merges the runs block by
+    block and streams the result, best first.
+
+    ordered=False is for callers whose seqs do not grow from one add() to
+    the next: a key equal to the l-th best may then still win its tie.
+    """
+
+    def __init__(self, l, j, memory_rows=None, spill_dir=None, seq_base=0, ordered=True):
+        self.l = l
+        self.j = j
+        self.ordered = ordered
+        self.dtype = run_dtype(j)
+        if memory_rows is None:
+            memory_rows = max(1, Config.TOPL_MEMORY_BUDGET // self.dtype.itemsize)
+        self.memory_rows = memory_rows
+        self.spill_dir = spill_dir if spill_dir is not None else Config.TOPL_SPILL_DIR
+        self._tmpdir = None
+        self._buffer = []
+        self._buffered = 0
+        self._runs = []
+        self._counts = np.zeros(0, dtype=np.int64)
+        self._kth = None
+        self._next_seq = seq_base
+
+    def threshold(self):
+        """The l-th best key so far, or None while fewer than l are kept."""
+        return self._kth
+
+    def add(self, keys, combos, seqs=None):
+        with metrics.timed('topl'):
+            self._add(keys, combos, seqs)
+
+    def _add(self, keys, combos, seqs):
+        if seqs is None:
+            seqs = np.arange(self._next_seq, self._next_seq + len(keys), dtype=np.int64)
+            self._next_seq += len(keys)
+        elif not self.ordered:
+            # top_indices breaks ties by position
+            order = np.argsort(seqs, kind='stable')
+            keys, combos, seqs = keys[order], combos[order], seqs[order]
+        if self._kth is not None:
+            # Equal keys lose to the combos already kept
+            mask = keys > self._kth if self.ordered else keys >= self._kth
+            if not mask.any():
+                return
+            keys, combos, seqs = keys[mask], combos[mask], seqs[mask]
+        if len(keys) > self.l:
+            idx = np.sort(scoring.top_indices(keys, self.l))
+            keys, combos, seqs = keys[idx], combos[idx], seqs[idx]
+        rows = np.empty(len(keys), dtype=self.dtype)
+        rows['key'] = keys
+        rows['seq'] = seqs
+        rows['combo'] = combos
+        metrics.count('topl_admitted', len(rows))
+        self._buffer.append(rows)
+        self._buffered += len(rows)
+        self._count(rows['key'], 1)
+        if self._buffered > self.memory_rows:
+            self._flush()
+
+    def spill_path(self):
+        """This selection's spill directory, created on first use."""
+        if self._tmpdir is None:
+            self._tmpdir = tempfile.mkdtemp(prefix='topl-', dir=self.spill_dir)
+        return self._tmpdir
+
+    def export(self):
+        """
+        Kept rows as sorted runs for another TopL's adopt(): arrays, or
+        paths of spilled runs. The files are handed over with them.
+        """
+        self._flush()
+        runs = [run.filename if _spilled(run) else run for run in self._runs]
+        self._runs = []
+        self._tmpdir = None
+        return runs
+
+    def adopt(self, runs):
+        """Take over the runs exported by a TopL over a later part of the enumeration."""
+        with metrics.timed('topl'):
+            for run in runs:
+                if isinstance(run, str):
+                    run = np.load(run, mmap_mode='r')
+                self._runs.append(run)
+                self._count(np.asarray(run['key']), 1)
+            self._spill_if_needed()
+
+    def iter_sorted(self, chunk_rows=1 << 16):
+        """
+        Yield (keys, combos) blocks of the final top-l, best first. The
+        spill files are removed once the stream is exhausted or closed.
+        """
+        try:
+            with metrics.timed('topl'):
+                self._flush()
+            runs = self._runs
+            offsets = [0] * len(runs)
+            emitted = 0
+            while emitted < self.l:
+                with metrics.timed('topl'):
+                    rows = self._merge_step(runs, offsets, chunk_rows)
+                if rows is None:
+                    break
+                rows = rows[:self.l - emitted]
+                emitted += len(rows)
+                if len(rows):
+                    yield rows['key'], rows['combo']
+        finally:
+            self.close()
+
+    def _merge_step(self, runs, offsets, chunk_rows):
+        """The next final rows of the merge (advancing offsets), or None at the end."""
+        blocks = [run[pos:pos + chunk_rows] for run, pos in zip(runs, offsets)]
+        if not any(len(b) for b in blocks):
+            return None
+        # Everything up to the smallest last row of a block whose run
+        # goes on is final: no later row of any run can precede it.
+        bound = None
+        for run, pos, block in zip(runs, offsets, blocks):
+            if len(block) and pos + len(block) < len(run):
+                last = (-int(block['key'][-1]), int(block['seq'][-1]))
+                bound = last if bound is None else min(bound, last)
+        taken = []
+        for i, block in enumerate(blocks):
+            if bound is not None and len(block):
+                neg = -block['key']
+                before = (neg < bound[0]) | ((neg == bound[0]) & (block['seq'] <= bound[1]))
+                block = block[:int(before.sum())]
+            offsets[i] += len(block)
+            taken.append(np.asarray(block))
+        return sort_rows(np.concatenate(taken))
+
+    def close(self):
+        self._buffer = []
+        self._runs = []
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+    def _count(self, keys, sign):
+        if not len(keys):
+            return
+        counts = np.bincount(keys, minlength=len(self._counts))
+        if len(counts) > len(self._counts):
+            self._counts = np.concatenate(
+                [self._counts, np.zeros(len(counts) - len(self._counts), dtype=np.int64)])
+        self._counts[:len(counts)] += sign * counts
+        above = np.cumsum(self._counts[::-1])
+        if above[-1] >= self.l:
+            self._kth = len(self._counts) - 1 - int(np.searchsorted(above, self.l))
+
+    def _trim(self, rows):
+        """Sort rows and drop those that can no longer make the top-l."""
+        rows = sort_rows(rows)
+        keep = len(rows) if self._kth is None else int(np.searchsorted(-rows['key'], -self._kth, side='right'))
+        keep = min(keep, self.l)
+        self._count(rows['key'][keep:], -1)
+        metrics.count('topl_replaced', len(rows) - keep)
+        return rows[:keep]
+
+    def _flush(self):
+        if self._buffer:
+            rows = np.concatenate(self._buffer)
+            self._buffer = []
+            self._buffered = 0
+            self._runs.append(self._trim(rows))
+        self._spill_if_needed()
+
+    def _spill_if_needed(self):
+        in_memory = [run for run in self._runs if not _spilled(run)]
+        if sum(len(run) for run in in_memory) <= self.memory_rows:
+            return
+        spilled = [run for run in self._runs if _spilled(run)]
+        rows = self._trim(np.concatenate(in_memory))
+        path = os.path.join(self.spill_path(), f"run{len(os.listdir(self.spill_path()))}.npy")
+        np.save(path, rows)
+        metrics.count('topl_spills')
+        self._runs = spilled + [np.load(path, mmap_mode='r')]